@@ -32,12 +32,15 @@ class Quasiparticle:
         self._power_spectrum_wave_vector = None
         self._power_spectrum_direct = None
         self._power_spectrum_partials = None
+        self._autocorrelation_phonon = None
         self._bands = None
         self._renormalized_bands = None
         self._renormalized_force_constants = None
         self._commensurate_points_data = None
+        self._batch_eigenvectors = None
         self._temperature = None
         self._force_constants_qha = None
+        self._initial_guess = fitting.initial_guess.InitialGuess(dynamic.structure)
         self._parameters = parameters.Parameters()
         self.crop_trajectory(last_steps)
         #  print('Using {0} time steps for calculation'.format(len(self.dynamic.velocity)))
@@ -61,9 +64,11 @@ class Quasiparticle:
         self._power_spectrum_direct = None
         self._power_spectrum_wave_vector = None
         self._power_spectrum_phonon = None
+        self._autocorrelation_phonon = None
 
     def power_spectra_clear(self):
         self._power_spectrum_phonon = None
+        self._autocorrelation_phonon = None
         self._power_spectrum_wave_vector = None
         self._power_spectrum_direct = None
         self.force_constants_clear()
@@ -93,17 +98,27 @@ class Quasiparticle:
     def write_to_xfs_file(self, file_name):
         reading.write_xsf_file(file_name, self.dynamic.structure)
 
-    def save_velocity_hdf5(self, file_name, save_trajectory=True):
+    def save_velocity_hdf5(self, file_name, save_trajectory=True, compression=None, real=False,
+                           single_precision=False):
         if save_trajectory:
             trajectory = self.dynamic.trajectory
         else:
             trajectory = None
 
+        # Store the atom indices only if part of the supercell atoms were read
+        atom_indices = self.dynamic.get_atom_indices()
+        if len(atom_indices) == self.dynamic.get_number_of_supercell_atoms():
+            atom_indices = None
+
         reading.save_data_hdf5(file_name,
                                self.dynamic.get_time(),
                                self.dynamic.get_supercell_matrix(),
                                velocity=self.dynamic.velocity,
-                               trajectory=trajectory)
+                               trajectory=trajectory,
+                               atom_indices=atom_indices,
+                               compression=compression,
+                               real=real,
+                               single_precision=single_precision)
 
         print("Velocity saved in file " + file_name)
 
@@ -431,57 +446,40 @@ class Quasiparticle:
         bands = self.get_band_ranges_and_labels()
         band_ranges = bands['ranges']
 
-        _bands = pho_interface.obtain_phonon_dispersion_bands(self.dynamic.structure,
-                                                              band_ranges,
-                                                              NAC=self.parameters.use_NAC,
-                                                              band_connection=band_connection,
-                                                              band_resolution=self.parameters.band_resolution)
+        # Harmonic, renormalized and linewidth limits bands are calculated together on the same path
+        force_constants_list = [None, renormalized_force_constants]
+
+        if with_linewidths:
+            data = self.get_commensurate_points_data()
+            renormalized_frequencies = data['frequencies']
+            eigenvectors = data['eigenvectors']
+            linewidths = data['linewidths']
+            fc_supercell = data['fc_supercell']
+
+            force_constants_list += pho_interface.get_renormalized_force_constants_batch(
+                [renormalized_frequencies + linewidths / 2, renormalized_frequencies - linewidths / 2],
+                eigenvectors,
+                self.dynamic.structure,
+                fc_supercell,
+                symmetrize=self.parameters.symmetrize)
+
+        band_sets = pho_interface.obtain_phonon_dispersion_bands_batch(self.dynamic.structure,
+                                                                       band_ranges,
+                                                                       force_constants_list,
+                                                                       NAC=self.parameters.use_NAC,
+                                                                       band_connection=band_connection,
+                                                                       band_resolution=self.parameters.band_resolution)
+        _bands, _renormalized_bands = band_sets[:2]
 
         if interconnect_bands:
             # reconnect_frequencies(_bands)
             reconnect_eigenvectors(_bands)
 
-        _renormalized_bands = pho_interface.obtain_phonon_dispersion_bands(self.dynamic.structure,
-                                                                           band_ranges,
-                                                                           force_constants=renormalized_force_constants,
-                                                                           NAC=self.parameters.use_NAC,
-                                                                           band_connection=band_connection,
-                                                                           band_resolution=self.parameters.band_resolution)
         if band_connection:
             set_order(_bands, _renormalized_bands)
 
-        data = self.get_commensurate_points_data()
-        renormalized_frequencies = data['frequencies']
-        eigenvectors = data['eigenvectors']
-        linewidths = data['linewidths']
-        fc_supercell = data['fc_supercell']
-
-        sup_lim = pho_interface.get_renormalized_force_constants(renormalized_frequencies + linewidths / 2,
-                                                                 eigenvectors,
-                                                                 self.dynamic.structure,
-                                                                 fc_supercell,
-                                                                 symmetrize=self.parameters.symmetrize)
-
-        inf_lim = pho_interface.get_renormalized_force_constants(renormalized_frequencies - linewidths / 2,
-                                                                 eigenvectors,
-                                                                 self.dynamic.structure,
-                                                                 fc_supercell,
-                                                                 symmetrize=self.parameters.symmetrize)
-
         if with_linewidths:
-            renormalized_bands_s = pho_interface.obtain_phonon_dispersion_bands(self.dynamic.structure,
-                                                                                band_ranges,
-                                                                                force_constants=sup_lim,
-                                                                                NAC=self.parameters.use_NAC,
-                                                                                band_connection=band_connection,
-                                                                                band_resolution=self.parameters.band_resolution)
-
-            renormalized_bands_i = pho_interface.obtain_phonon_dispersion_bands(self.dynamic.structure,
-                                                                                band_ranges,
-                                                                                force_constants=inf_lim,
-                                                                                NAC=self.parameters.use_NAC,
-                                                                                band_connection=band_connection,
-                                                                                band_resolution=self.parameters.band_resolution)
+            renormalized_bands_s, renormalized_bands_i = band_sets[2:]
 
             if band_connection:
                 set_order(_bands, renormalized_bands_s)
@@ -521,27 +519,30 @@ class Quasiparticle:
 
         data = self.get_commensurate_points_data()
 
-        renormalized_frequencies = data['frequencies']
         eigenvectors = data['eigenvectors']
         linewidths = data['linewidths']
         fc_supercell = data['fc_supercell']
 
-        linewidths_fc = pho_interface.get_renormalized_force_constants(linewidths,
-                                                                   eigenvectors,
-                                                                   self.dynamic.structure,
-                                                                   fc_supercell,
-                                                                   symmetrize=self.parameters.symmetrize)
+        # Frequencies and linewidths force constants share the eigenvectors (built in one call)
+        frequency_sets = [linewidths]
+        if self._renormalized_force_constants is None:
+            frequency_sets.append(data['frequencies'])
+
+        force_constants_list = pho_interface.get_renormalized_force_constants_batch(frequency_sets,
+                                                                                    eigenvectors,
+                                                                                    self.dynamic.structure,
+                                                                                    fc_supercell,
+                                                                                    symmetrize=self.parameters.symmetrize)
+        linewidths_fc = force_constants_list[0]
+        if self._renormalized_force_constants is None:
+            self._renormalized_force_constants = force_constants_list[1]
 
         _, _, linewidths_mesh = pho_interface.obtain_phonopy_mesh_from_force_constants(self.dynamic.structure,
                                                                                        force_constants=linewidths_fc,
                                                                                        mesh=self.parameters.mesh_phonopy,
                                                                                        NAC=None)
 
-        frequencies_fc = pho_interface.get_renormalized_force_constants(renormalized_frequencies,
-                                                                        eigenvectors,
-                                                                        self.dynamic.structure,
-                                                                        fc_supercell,
-                                                                        symmetrize=self.parameters.symmetrize)
+        frequencies_fc = self.get_renormalized_force_constants()
 
         qpoints, multiplicity, frequencies_mesh = pho_interface.obtain_phonopy_mesh_from_force_constants(self.dynamic.structure,
                                                                                         force_constants=frequencies_fc,
@@ -632,6 +633,33 @@ class Quasiparticle:
             self._vq = projection.project_onto_phonon(self.get_vc(), self.get_eigenvectors())
         return self._vq
 
+    def _get_vq_equivalent_q_points(self):
+        # Phonon projections of the wave vectors equivalent by symmetry to the current one (one at a time).
+        # The current wave vector and its cached projections are not changed. Eigenvectors already
+        # calculated for all commensurate points (see get_commensurate_points_data) are reused
+        q_points_equivalent = pho_interface.get_equivalent_q_points_by_symmetry(self.get_reduced_q_vector(),
+                                                                                self.dynamic.structure)
+        reciprocal_cell = 2.0 * np.pi * np.linalg.inv(self.dynamic.structure.get_primitive_cell()).T
+        for q_point in q_points_equivalent:
+            if np.allclose(q_point, self.get_reduced_q_vector()):
+                yield self.get_vq()
+                continue
+
+            print("Projecting into wave vector {}".format(q_point))
+            vc = projection.project_onto_wave_vector(self.dynamic,
+                                                     np.dot(q_point, reciprocal_cell),
+                                                     project_on_atom=self.parameters.project_on_atom)
+            eigenvectors = None
+            if self._batch_eigenvectors is not None:
+                q_points, batch_eigenvectors = self._batch_eigenvectors
+                index = np.where(np.all(np.isclose(q_points, q_point), axis=1))[0]
+                if len(index) > 0:
+                    eigenvectors = batch_eigenvectors[index[0]]
+            if eigenvectors is None:
+                eigenvectors = pho_interface.obtain_eigenvectors_and_frequencies(self.dynamic.structure, q_point,
+                                                                                 print_data=False)[0]
+            yield projection.project_onto_phonon(vc, eigenvectors)
+
     def plot_vq(self, modes=None):
         if not modes:
             modes = [0]
@@ -705,19 +733,8 @@ class Quasiparticle:
             print("Calculating phonon projection power spectra")
 
             if self.parameters.use_symmetry:
-                initial_reduced_q_point = self.get_reduced_q_vector()
-                power_spectrum_phonon = []
-                q_points_equivalent = pho_interface.get_equivalent_q_points_by_symmetry(self.get_reduced_q_vector(),
-                                                                                        self.dynamic.structure)
-                #                print(q_points_equivalent)
-                for q_point in q_points_equivalent:
-                    self.set_reduced_q_vector(q_point)
-                    power_spectrum_phonon.append(
-                        (power_spectrum_functions[self.parameters.power_spectra_algorithm])[0](self.get_vq(),
-                                                                                               self.dynamic,
-                                                                                               self.parameters))
-
-                self.set_reduced_q_vector(initial_reduced_q_point)
+                power_spectrum_phonon = [(power_spectrum_functions[self.parameters.power_spectra_algorithm])[0](
+                    vq, self.dynamic, self.parameters) for vq in self._get_vq_equivalent_q_points()]
                 self._power_spectrum_phonon = np.average(power_spectrum_phonon, axis=0)
             else:
                 self._power_spectrum_phonon = (
@@ -727,6 +744,25 @@ class Quasiparticle:
 
         return self._power_spectrum_phonon
 
+    def get_autocorrelation_phonon(self):
+        if self._autocorrelation_phonon is None:
+            print("Calculating phonon projection autocorrelations")
+
+            time_step = self.dynamic.get_time_step_average()
+            if self.parameters.use_symmetry:
+                autocorrelation_phonon = [fitting.estimators.get_autocorrelations(vq, time_step)
+                                          for vq in self._get_vq_equivalent_q_points()]
+                self._autocorrelation_phonon = np.average(autocorrelation_phonon, axis=0)
+            else:
+                self._autocorrelation_phonon = fitting.estimators.get_autocorrelations(self.get_vq(), time_step)
+
+        return self._autocorrelation_phonon
+
+    def _use_autocorrelation(self):
+        # Time domain estimator selected (no power spectra needed)
+        return issubclass(fitting.fitting_functions.fitting_functions[self.parameters.fitting_function],
+                          fitting.estimators.Autocorrelation_envelope)
+
     def get_power_spectrum_wave_vector(self):
 
         if self._power_spectrum_wave_vector is None:
@@ -774,7 +810,7 @@ class Quasiparticle:
             if projected_atom_type >= 0:
                 print('Power spectrum projected onto atom type {0}'.format(projected_atom_type))
                 supercell = self.dynamic.get_supercell_matrix()
-                atom_types = np.array(self.dynamic.structure.get_atom_type_index(supercell=supercell))
+                atom_types = np.array(self.dynamic.structure.get_atom_type_index(supercell=supercell))[self.dynamic.get_atom_indices()]
                 atom_indices = np.argwhere(atom_types == projected_atom_type).flatten()
                 if len(atom_indices) == 0:
                     print('Atom type {0} does not exist'.format(projected_atom_type))
@@ -842,10 +878,23 @@ class Quasiparticle:
     def phonon_individual_analysis(self):
         print("Peak analysis analysis")
 
-        fitting.phonon_fitting_analysis(self.get_power_spectrum_phonon(),
+        thermal_expansion_shift = self.get_qha_shift(self.get_reduced_q_vector())
+        guess_positions, guess_widths = self.get_initial_guess(self.get_reduced_q_vector(), self.get_frequencies(),
+                                                               thermal_expansion_shift=thermal_expansion_shift)
+
+        if self._use_autocorrelation():
+            power_spectrum, autocorrelation = None, self.get_autocorrelation_phonon()
+        else:
+            power_spectrum, autocorrelation = self.get_power_spectrum_phonon(), None
+
+        fitting.phonon_fitting_analysis(power_spectrum,
                                         self.parameters.frequency_range,
                                         harmonic_frequencies=self.get_frequencies(),
-                                        thermal_expansion_shift=self.get_qha_shift(self.get_reduced_q_vector()),
+                                        thermal_expansion_shift=thermal_expansion_shift,
+                                        guess_positions=guess_positions,
+                                        guess_widths=guess_widths,
+                                        autocorrelations=autocorrelation,
+                                        time_step=self.dynamic.get_time_step_average(),
                                         show_plots=not self.parameters.silent,
                                         fitting_function_type=self.parameters.fitting_function,
                                         use_degeneracy=self.parameters.use_symmetry,
@@ -1081,11 +1130,11 @@ class Quasiparticle:
         if self._commensurate_points_data is None:
 
             if auto_range:
-                # Get range from harmonic DOS
-                phonopy_dos = pho_interface.obtain_phonopy_dos(self.dynamic.structure,
-                                                               mesh=self.parameters.mesh_phonopy)
+                # Get range from harmonic DOS (cached)
+                max_frequency = pho_interface.obtain_phonopy_max_frequency(self.dynamic.structure,
+                                                                           mesh=self.parameters.mesh_phonopy)
 
-                self.set_frequency_limits([0, np.max(phonopy_dos[0][-1]) * 1.2])
+                self.set_frequency_limits([0, max_frequency * 1.2])
                 print('set frequency range: {} - {}'.format(self.get_frequency_range()[0],
                                                             self.get_frequency_range()[-1]))
 
@@ -1100,41 +1149,89 @@ class Quasiparticle:
 
             initial_reduced_q_vector = self.get_reduced_q_vector()
 
-            renormalized_frequencies = []
-            frequency_shifts = []
-            eigenvectors = []
-            linewidths = []
-            q_points_list = []
+            # Harmonic eigenvectors and frequencies of all commensurate points (shared by projection and
+            # force constants renormalization)
+            eigenvectors, harmonic_frequencies = pho_interface.obtain_eigenvectors_and_frequencies_batch(
+                self.dynamic.structure, com_points, print_data=False)
+            self._batch_eigenvectors = (np.array(com_points), eigenvectors)
 
-            for i, reduced_q_vector in enumerate(com_points):
+            # Only irreducible points are analyzed, the others are filled from their equivalent point
+            if self.parameters.use_symmetry:
+                mapping = pho_interface.get_commensurate_points_stars(self.dynamic.structure,
+                                                                      com_points)['mapping']
+            else:
+                mapping = np.arange(len(com_points))
 
-                print("\nQ-point: {0} / {1}      {2}".format(i + 1, len(com_points), reduced_q_vector))
+            renormalized_frequencies = np.zeros_like(harmonic_frequencies)
+            linewidths = np.zeros_like(harmonic_frequencies)
 
-                self.set_reduced_q_vector(reduced_q_vector)
-                eigenvectors.append(self.get_eigenvectors())
+            # Power spectra (or autocorrelations) of the irreducible points (fitted together afterwards)
+            power_spectra = {}
+            autocorrelations = {}
+            guesses = {}
+            for i, reduced_q_vector in enumerate(com_points):
 
-                q_points_equivalent = pho_interface.get_equivalent_q_points_by_symmetry(reduced_q_vector,
-                                                                                        self.dynamic.structure)
-                q_index = _vector_in_list(q_points_equivalent, q_points_list)
-                q_points_list.append(reduced_q_vector)
+                print("\nQ-point: {0} / {1}      {2}".format(i + 1, len(com_points), reduced_q_vector))
 
-                if q_index != 0 and self.parameters.use_symmetry:
-                    renormalized_frequencies.append(renormalized_frequencies[q_index])
-                    linewidths.append(linewidths[q_index])
-                    frequency_shifts.append(frequency_shifts[q_index])
+                if mapping[i] != i:
+                    print('Skipped, equivalent to {0}'.format(com_points[mapping[i]]))
+                    continue
 
-                    print('Skipped, equivalent to {0}'.format(q_points_list[q_index]))
+                self.set_reduced_q_vector(reduced_q_vector)
+                self._eigenvectors = eigenvectors[i]
+                self._frequencies = harmonic_frequencies[i]
+                print("Harmonic frequencies (THz):")
+                print(self._frequencies)
+
+                if self._use_autocorrelation():
+                    autocorrelations[i] = fitting.get_fitting_power_spectra(self.get_autocorrelation_phonon(),
+                                                                            harmonic_frequencies[i],
+                                                                            use_degeneracy=self.parameters.use_symmetry)
                     continue
 
+                power_spectra[i] = fitting.get_fitting_power_spectra(self.get_power_spectrum_phonon(),
+                                                                     harmonic_frequencies[i],
+                                                                     use_degeneracy=self.parameters.use_symmetry)
+                guesses[i] = self.get_initial_guess(reduced_q_vector, harmonic_frequencies[i],
+                                                    thermal_expansion_shift=self.get_qha_shift(reduced_q_vector))
+
+            # Batch fitting of all phonons of all irreducible points
+            if self._use_autocorrelation():
+                irreducible = sorted(autocorrelations.keys())
+                fitted_functions = fitting.estimators.fit_autocorrelations(
+                    self.dynamic.get_time_step_average(),
+                    np.hstack([autocorrelations[i] for i in irreducible]),
+                    np.hstack([harmonic_frequencies[i] for i in irreducible]))
+            else:
+                irreducible = sorted(power_spectra.keys())
+                guess_positions = np.hstack([guesses[i][0] for i in irreducible])
+                guess_widths = np.hstack([guesses[i][1] for i in irreducible])
+
+                fitted_functions = fitting.batch_fitting.fit_power_spectra(
+                    self.parameters.frequency_range,
+                    np.hstack([power_spectra[i] for i in irreducible]),
+                    fitting_function_type=self.parameters.fitting_function,
+                    guess_positions=guess_positions,
+                    guess_widths=guess_widths)
+            number_of_modes = harmonic_frequencies.shape[1]
+
+            for n, i in enumerate(irreducible):
+                reduced_q_vector = com_points[i]
+                print("\nFitting Q-point: {0}".format(reduced_q_vector))
+
                 self.set_reduced_q_vector(reduced_q_vector)
+                self._eigenvectors = eigenvectors[i]
+                self._frequencies = harmonic_frequencies[i]
 
-                data = fitting.phonon_fitting_analysis(self.get_power_spectrum_phonon(),
+                data = fitting.phonon_fitting_analysis(power_spectra.get(i),
                                                        self.parameters.frequency_range,
-                                                       harmonic_frequencies=self.get_frequencies(),
+                                                       harmonic_frequencies=harmonic_frequencies[i],
                                                        thermal_expansion_shift=self.get_qha_shift(reduced_q_vector),
                                                        show_plots=False,
                                                        fitting_function_type=self.parameters.fitting_function,
-                                                       use_degeneracy=self.parameters.use_symmetry)
+                                                       use_degeneracy=False,
+                                                       fitted_functions=fitted_functions[n * number_of_modes:
+                                                                                         (n + 1) * number_of_modes])
 
                 positions = data['positions']
                 widths = data['widths']
@@ -1147,13 +1244,13 @@ class Quasiparticle:
                     widths[1] = 0.
                     widths[2] = 0.
 
-                renormalized_frequencies.append(positions)
-                linewidths.append(widths)
-                frequency_shifts.append(np.array(positions) - self.get_frequencies())
+                renormalized_frequencies[i] = positions
+                linewidths[i] = widths
 
-            renormalized_frequencies = np.array(renormalized_frequencies)
-            linewidths = np.array(linewidths)
-            frequency_shifts = np.array(frequency_shifts)
+            renormalized_frequencies = renormalized_frequencies[mapping]
+            linewidths = linewidths[mapping]
+            frequency_shifts = renormalized_frequencies - harmonic_frequencies[mapping]
+            q_points_list = list(np.array(com_points))
 
             # To be deprecated
             if self.parameters.save_renormalized_frequencies:
@@ -1168,6 +1265,7 @@ class Quasiparticle:
                                               'q_points': q_points_list,
                                               'fc_supercell': fc_supercell}
 
+            self._batch_eigenvectors = None
             self.set_reduced_q_vector(initial_reduced_q_vector)
 
         return self._commensurate_points_data
@@ -1385,6 +1483,22 @@ class Quasiparticle:
         self._force_constants_qha = pho_interface.get_force_constants_from_file(fc_qha_file,
                                                                                 fc_supercell=self.dynamic.structure.get_supercell_phonon())
 
+    # Fitting initial guess methods
+    def set_initial_guess(self, quasiparticle_data):
+        """
+        Use previous results (e.g. previous temperature) as initial guess of the peak fittings
+        :param quasiparticle_data: see get_commensurate_points_data or reading.read_quasiparticle_data_from_file
+        """
+        self._initial_guess = fitting.initial_guess.InitialGuess(self.dynamic.structure, quasiparticle_data)
+
+    def load_initial_guess(self, filename='quasiparticles_data.yaml'):
+        self.set_initial_guess(reading.read_quasiparticle_data_from_file(filename))
+
+    def get_initial_guess(self, reduced_q_vector, harmonic_frequencies, thermal_expansion_shift=None):
+        # Peak positions and widths initial guess (harmonic frequencies if no previous results are set)
+        return self._initial_guess.get_guess(reduced_q_vector, harmonic_frequencies,
+                                             thermal_expansion_shift=thermal_expansion_shift)
+
     def get_qha_shift(self, reduced_q_vector):
         if self._force_constants_qha is not None:
             import copy
@@ -1396,12 +1510,3 @@ class Quasiparticle:
             return qha_frequencies - self.get_frequencies()
         else:
             return None
-
-
-# Support functions
-def _vector_in_list(vector_test_list, vector_full_list):
-    for vector_test in vector_test_list:
-        for i, vector_full in enumerate(vector_full_list):
-            if (vector_full == vector_test).all():
-                return i
-    return 0
@@ -1,7 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.integrate import simps
-from dynaphopy.analysis.fitting import fitting_functions
+from dynaphopy.analysis.fitting import fitting_functions, batch_fitting, initial_guess, estimators
 
 h_planck = 4.135667662e-3  # eV/ps
 h_planck_bar = h_planck/(2.0*np.pi)  # eV/ps
@@ -32,36 +32,69 @@ def average_phonon(index, data, degeneracy):
             return np.average([data[:, j] for j in degeneracy[i]], axis=0)
 
 
+def get_fitting_power_spectra(original, harmonic_frequencies=None, use_degeneracy=True):
+    """
+    Power spectra used in the peak fitting (averaged over degenerate phonons)
+    :param original: phonon power spectra [frequency, phonon] (or autocorrelations [lag, phonon])
+    :return: power spectra [frequency, phonon]
+    """
+    if not use_degeneracy:
+        return np.array(original)
+
+    degeneracy = degenerate_sets(harmonic_frequencies)
+    return np.array([average_phonon(i, original, degeneracy) for i in range(original.shape[1])]).T
+
+
 def phonon_fitting_analysis(original, ps_frequencies,
                             harmonic_frequencies=None,
                             thermal_expansion_shift=None,
                             fitting_function_type=0,
                             show_plots=True,
                             use_degeneracy=True,
-                            show_occupancy=True):
+                            show_occupancy=True,
+                            print_data=True,
+                            fitted_functions=None,
+                            guess_positions=None,
+                            guess_widths=None,
+                            autocorrelations=None,
+                            time_step=None):
+    """
+    Fit the peaks of the phonon power spectra (all phonons are fitted at once, see batch_fitting)
+    :param original: phonon power spectra [frequency, phonon] (None if autocorrelations are used)
+    :param fitted_functions: fitting function objects of each phonon already fitted
+                             (e.g. several q-points fitted together with batch_fitting.fit_power_spectra)
+    :param guess_positions: initial peak positions of each phonon (see initial_guess.InitialGuess)
+    :param guess_widths: initial peak widths of each phonon (see initial_guess.InitialGuess)
+    :param autocorrelations: phonon autocorrelations [lag, phonon] (see estimators.get_autocorrelations),
+                             if given the peaks are estimated from them in the time domain
+    :param time_step: time step of the autocorrelations (ps)
+    """
 
     widths = []
     positions = []
     errors = []
     dt_Q2_s = []
 
-    for i in range(original.shape[1]):
-
-        if use_degeneracy:
-            degeneracy = degenerate_sets(harmonic_frequencies)
-            power_spectrum = average_phonon(i, original, degeneracy)
+    power_spectra = None
+    if original is not None:
+        power_spectra = get_fitting_power_spectra(original, harmonic_frequencies, use_degeneracy=use_degeneracy)
+
+    if fitted_functions is None:
+        if autocorrelations is not None:
+            fitted_functions = estimators.fit_autocorrelations(time_step,
+                                                               get_fitting_power_spectra(autocorrelations,
+                                                                                         harmonic_frequencies,
+                                                                                         use_degeneracy=use_degeneracy),
+                                                               harmonic_frequencies)
         else:
-            power_spectrum = original[:, i]
-
-        guess_height = np.max(power_spectrum)
-        guess_position = ps_frequencies[np.argmax(power_spectrum)]
+            fitted_functions = batch_fitting.fit_power_spectra(ps_frequencies, power_spectra,
+                                                               fitting_function_type=fitting_function_type,
+                                                               guess_positions=guess_positions,
+                                                               guess_widths=guess_widths)
 
-        Fitting_function_class = fitting_functions.fitting_functions[fitting_function_type]
-        fitting_function = Fitting_function_class(ps_frequencies,
-                                                  power_spectrum,
-                                                  guess_height=guess_height,
-                                                  guess_position=guess_position)
+    for i in range(len(fitted_functions)):
 
+        fitting_function = fitted_functions[i]
         fitting_parameters = fitting_function.get_fitting()
 
         if not fitting_parameters['all_good']:
@@ -69,7 +102,8 @@ def phonon_fitting_analysis(original, ps_frequencies,
             widths.append(0)
             errors.append(0)
             dt_Q2_s.append(0)
-            print ('Warning: Fitting not successful in peak #{0}'.format(i+1))
+            if print_data:
+                print ('Warning: Fitting not successful in peak #{0}'.format(i+1))
             continue
 
         position = fitting_parameters['peak_position']
@@ -79,7 +113,14 @@ def phonon_fitting_analysis(original, ps_frequencies,
         maximum = fitting_parameters['maximum']
         error = fitting_parameters['global_error']
 
-        total_integral = simps(power_spectrum, x=ps_frequencies)
+        if power_spectra is not None:
+            power_spectrum = power_spectra[:, i]
+            total_integral = simps(power_spectrum, x=ps_frequencies)
+            guess_height = np.max(power_spectrum)
+        else:
+            power_spectrum = None
+            total_integral = area
+            guess_height = maximum
 
         # Calculated properties
         dt_Q2_lor = 2 * area
@@ -108,34 +149,36 @@ def phonon_fitting_analysis(original, ps_frequencies,
             pass
 
         #Print section
-        print ('\nPeak # {0}'.format(i+1))
-        print ('----------------------------------------------')
-        print ('Width                      {0:15.6f} THz'.format(width))
-        print ('Position                   {0:15.6f} THz'.format(position))
-        print ('Area (<K>)    ({0:.10s}) {1:15.6f} eV'.format(fitting_function.curve_name, area))  # Kinetic energy
-        print ('Area (<K>)    (Total)      {0:15.6f} eV'.format(total_integral))   # 1/2 Kinetic energy
-        print ('<|dQ/dt|^2>                {0:15.6f} eV'.format(dt_Q2_lor))        # Kinetic energy
-        # print '<|dQ/dt|^2> (tot):        ', dt_Q2_tot, 'eV'        # Kinetic energy
-        # print '<|Q|^2> (lor):          ', Q2_lor, 'eV' #  potential energy
-        # print '<|Q|^2> (tot):          ', Q2_tot, 'eV' #  potential energy
-        if show_occupancy:
-            print ('Occupation number          {0:15.6f}'.format(occupancy_lor))
-            print ('Fit temperature            {0:15.6f} K'.format(fit_temperature))
-            #print ('Fit temperature (Total)    {0:15.6f} K'.format(fit_temperature_tot))
-
-        print ('Base line                  {0:15.6f} eV * ps'.format(base_line))
-        print ('Maximum height             {0:15.6f} eV * ps'.format(maximum))
-        print ('Fitting global error       {0:15.6f}'.format(error))
-
-        if 'asymmetry' in fitting_parameters:
-            asymmetry = fitting_parameters['asymmetry']
-            print ('Peak asymmetry             {0:15.6f}'.format(asymmetry))
-
-        if harmonic_frequencies is not None:
-            print ('Frequency shift            {0:15.6f} THz'.format(position - harmonic_frequencies[i]))
+        if print_data:
+            print ('\nPeak # {0}'.format(i+1))
+            print ('----------------------------------------------')
+            print ('Width                      {0:15.6f} THz'.format(width))
+            print ('Position                   {0:15.6f} THz'.format(position))
+            print ('Area (<K>)    ({0:.10s}) {1:15.6f} eV'.format(fitting_function.curve_name, area))  # Kinetic energy
+            print ('Area (<K>)    (Total)      {0:15.6f} eV'.format(total_integral))   # 1/2 Kinetic energy
+            print ('<|dQ/dt|^2>                {0:15.6f} eV'.format(dt_Q2_lor))        # Kinetic energy
+            # print '<|dQ/dt|^2> (tot):        ', dt_Q2_tot, 'eV'        # Kinetic energy
+            # print '<|Q|^2> (lor):          ', Q2_lor, 'eV' #  potential energy
+            # print '<|Q|^2> (tot):          ', Q2_tot, 'eV' #  potential energy
+            if show_occupancy:
+                print ('Occupation number          {0:15.6f}'.format(occupancy_lor))
+                print ('Fit temperature            {0:15.6f} K'.format(fit_temperature))
+                #print ('Fit temperature (Total)    {0:15.6f} K'.format(fit_temperature_tot))
+
+            print ('Base line                  {0:15.6f} eV * ps'.format(base_line))
+            print ('Maximum height             {0:15.6f} eV * ps'.format(maximum))
+            print ('Fitting global error       {0:15.6f}'.format(error))
+
+            if 'asymmetry' in fitting_parameters:
+                asymmetry = fitting_parameters['asymmetry']
+                print ('Peak asymmetry             {0:15.6f}'.format(asymmetry))
+
+            if harmonic_frequencies is not None:
+                print ('Frequency shift            {0:15.6f} THz'.format(position - harmonic_frequencies[i]))
 
         if thermal_expansion_shift is not None:
-            print ('Frequency shift (+T. exp.) {0:15.6f} THz'.format(position - harmonic_frequencies[i] + thermal_expansion_shift[i]))
+            if print_data:
+                print ('Frequency shift (+T. exp.) {0:15.6f} THz'.format(position - harmonic_frequencies[i] + thermal_expansion_shift[i]))
             position += thermal_expansion_shift[i]
 
         positions.append(position)
@@ -155,8 +198,9 @@ def phonon_fitting_analysis(original, ps_frequencies,
             plt.text(position+width, guess_height/2, 'Width: ' + "{:10.4f}".format(width),
                      fontsize=12)
 
-            plt.plot(ps_frequencies, power_spectrum,
-                     label='Power spectrum')
+            if power_spectrum is not None:
+                plt.plot(ps_frequencies, power_spectrum,
+                         label='Power spectrum')
 
             plt.plot(ps_frequencies, fitting_function.get_curve(ps_frequencies),
                      label=fitting_function.curve_name,
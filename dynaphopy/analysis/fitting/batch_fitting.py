@@ -0,0 +1,164 @@
+import numpy as np
+
+from dynaphopy.analysis.fitting import fitting_functions
+
+
+def _evaluate(fitting_function, frequencies, parameters):
+    # Fitting function of all columns [column, frequency]
+    return fitting_function._function(frequencies[None, :], *parameters.T[:, :, None])
+
+
+def _get_jacobian(fitting_function, frequencies, parameters, values):
+    # Jacobian of all columns [column, frequency, parameter]
+    if hasattr(fitting_function, '_jacobian'):
+        return fitting_function._jacobian(frequencies[None, :], *parameters.T[:, :, None])
+
+    # Forward differences (as MINPACK)
+    steps = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(parameters), 1.0)
+    jacobian = np.zeros(values.shape + (parameters.shape[1],))
+    for k in range(parameters.shape[1]):
+        displaced = np.array(parameters)
+        displaced[:, k] += steps[:, k]
+        jacobian[:, :, k] = (_evaluate(fitting_function, frequencies, displaced) - values) / steps[:, k, None]
+    return jacobian
+
+
+def levenberg_marquardt(fitting_function, frequencies, power_spectra, initial_parameters,
+                        max_iterations=200,
+                        ftol=1.49012e-08,
+                        xtol=1.49012e-08):
+    """
+    Least squares fit of all power spectra columns at the same time (vectorized Levenberg-Marquardt).
+    Each column has its own damping and is removed from the iterations when it is converged.
+    :param fitting_function: fitting function object (see fitting_functions)
+    :param frequencies: frequencies (THz)
+    :param power_spectra: power spectra [frequency, column]
+    :param initial_parameters: initial parameters [column, parameter]
+    :return: parameters [column, parameter], covariances [column, parameter, parameter], converged [column]
+    """
+    frequencies = np.array(frequencies, dtype=float)
+    data = np.array(power_spectra, dtype=float).T
+    parameters = np.array(initial_parameters, dtype=float)
+
+    residuals = _evaluate(fitting_function, frequencies, parameters) - data
+    cost = np.sum(residuals ** 2, axis=1)
+    damping = np.full(len(parameters), 1e-3)
+    converged = np.zeros(len(parameters), dtype=bool)
+
+    with np.errstate(all='ignore'):
+        for iteration in range(max_iterations):
+            active = np.where(~converged & np.isfinite(cost) & (damping < 1e16))[0]
+            if len(active) == 0:
+                break
+
+            jacobian = _get_jacobian(fitting_function, frequencies, parameters[active],
+                                     residuals[active] + data[active])
+            normal_matrix = np.matmul(jacobian.transpose((0, 2, 1)), jacobian)
+            gradient = np.matmul(jacobian.transpose((0, 2, 1)), residuals[active, :, None])[:, :, 0]
+
+            diagonal = np.maximum(np.diagonal(normal_matrix, axis1=1, axis2=2), 1e-30)
+            damped_matrix = normal_matrix + (damping[active, None] * diagonal)[:, :, None] * np.identity(diagonal.shape[1])
+
+            steps = np.zeros_like(gradient)
+            solvable = np.all(np.isfinite(damped_matrix), axis=(1, 2)) & np.all(np.isfinite(gradient), axis=1)
+            try:
+                steps[solvable] = np.linalg.solve(damped_matrix[solvable], -gradient[solvable, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                for i in np.where(solvable)[0]:
+                    try:
+                        steps[i] = np.linalg.solve(damped_matrix[i], -gradient[i])
+                    except np.linalg.LinAlgError:
+                        solvable[i] = False
+
+            new_parameters = parameters[active] + steps
+            new_residuals = _evaluate(fitting_function, frequencies, new_parameters) - data[active]
+            new_cost = np.sum(new_residuals ** 2, axis=1)
+
+            improved = solvable & np.isfinite(new_cost) & (new_cost < cost[active])
+            # Actual and predicted (linear model) relative reductions of the cost (as MINPACK ftol test)
+            reduction = (cost[active] - new_cost) / np.maximum(cost[active], 1e-300)
+            predicted = (-2 * np.sum(steps * gradient, axis=1) -
+                         np.einsum('mi,mij,mj->m', steps, normal_matrix, steps)) / np.maximum(cost[active], 1e-300)
+            small_step = (np.linalg.norm(steps, axis=1) <=
+                          xtol * (np.linalg.norm(parameters[active], axis=1) + xtol))
+
+            # Accepted steps decrease the damping, rejected steps increase it
+            updated = active[improved]
+            parameters[updated] = new_parameters[improved]
+            residuals[updated] = new_residuals[improved]
+            cost[updated] = new_cost[improved]
+            damping[active] = np.where(improved, damping[active] / 10, damping[active] * 10)
+
+            converged[active] = (improved & (((reduction <= ftol) & (np.abs(predicted) <= ftol)) | small_step)) | (~improved & small_step & solvable)
+
+    # Covariances from the Jacobian at the solution
+    covariances = np.full((len(parameters), parameters.shape[1], parameters.shape[1]), np.inf)
+    if converged.any():
+        with np.errstate(all='ignore'):
+            jacobian = _get_jacobian(fitting_function, frequencies, parameters[converged],
+                                     residuals[converged] + data[converged])
+        for i, column in enumerate(np.where(converged)[0]):
+            covariances[column] = fitting_functions.get_covariance_from_jacobian(jacobian[i], residuals[column])
+
+    return parameters, covariances, converged
+
+
+def fit_power_spectra(ps_frequencies, power_spectra,
+                      fitting_function_type=0,
+                      guess_positions=None,
+                      guess_heights=None,
+                      guess_widths=None):
+    """
+    Fit all power spectra columns with one batched fit (see levenberg_marquardt).
+    Columns that do not converge are fitted individually (curve_fit) when get_fitting is called.
+    :param ps_frequencies: frequencies (THz)
+    :param power_spectra: power spectra [frequency, column]
+    :param fitting_function_type: fitting function (see fitting_functions)
+    :param guess_positions: initial peak positions for each column (default or NaN: maximum of the power spectra)
+    :param guess_heights: initial peak heights for each column (default: power spectra at guess_positions)
+    :param guess_widths: initial peak widths for each column (NaN: default of the fitting function)
+    :return: list of fitting function objects (one for each column, see get_fitting)
+    """
+    ps_frequencies = np.array(ps_frequencies)
+    power_spectra = np.array(power_spectra, dtype=float).reshape((len(ps_frequencies), -1))
+    number_of_columns = power_spectra.shape[1]
+
+    maximum_positions = ps_frequencies[np.argmax(power_spectra, axis=0)]
+    if guess_positions is None:
+        guess_positions = maximum_positions
+    else:
+        guess_positions = np.where(np.isnan(guess_positions), maximum_positions, guess_positions)
+    if guess_heights is None:
+        guess_heights = [np.interp(guess_positions[i], ps_frequencies, power_spectra[:, i])
+                         for i in range(number_of_columns)]
+    if guess_widths is None:
+        guess_widths = np.full(number_of_columns, np.nan)
+
+    Fitting_function_class = fitting_functions.fitting_functions[fitting_function_type]
+    functions = [Fitting_function_class(ps_frequencies,
+                                        power_spectra[:, i],
+                                        guess_height=guess_heights[i],
+                                        guess_position=guess_positions[i],
+                                        guess_width=None if np.isnan(guess_widths[i]) else guess_widths[i])
+                 for i in range(number_of_columns)]
+
+    # Fit-free estimators (see estimators) are evaluated for all columns at once
+    if hasattr(Fitting_function_class, '_get_batch_estimates'):
+        estimates = Fitting_function_class._get_batch_estimates(ps_frequencies, power_spectra,
+                                                                guess_positions=guess_positions,
+                                                                guess_widths=guess_widths)
+        for i, function in enumerate(functions):
+            function._estimates = {key: value[i] for key, value in estimates.items()}
+        return functions
+
+    # Same initial parameters as the individual fits
+    initial_parameters = [function._get_initial_parameters() for function in functions]
+
+    parameters, covariances, converged = levenberg_marquardt(functions[0], ps_frequencies,
+                                                             power_spectra, initial_parameters)
+
+    for i in np.where(converged)[0]:
+        functions[i]._fit_params = parameters[i]
+        functions[i]._fit_covariances = covariances[i]
+
+    return functions
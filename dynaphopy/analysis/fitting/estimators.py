@@ -0,0 +1,360 @@
+import numpy as np
+
+from dynaphopy.power_spectrum import unit_conversion
+
+
+def _get_half_maximum_width(frequencies, power_spectra, k, base_line):
+    # Maximum (local quadratic refinement at index k of each column) and width at half maximum
+    # (linear interpolation of the crossings at both sides)
+    number_of_frequencies, number_of_columns = power_spectra.shape
+    columns = np.arange(number_of_columns)
+    indices = np.arange(number_of_frequencies)[:, None]
+    step = frequencies[1] - frequencies[0]
+
+    k = np.clip(k, 1, number_of_frequencies - 2)
+    y_left, y_center, y_right = power_spectra[k - 1, columns], power_spectra[k, columns], power_spectra[k + 1, columns]
+    curvature = y_left - 2 * y_center + y_right
+    with np.errstate(all='ignore'):
+        delta = np.where(curvature < 0, 0.5 * (y_left - y_right) / curvature, 0.0)
+    delta = np.clip(delta, -0.5, 0.5)
+    position = frequencies[k] + delta * step
+    maximum = y_center - 0.25 * (y_left - y_right) * delta
+
+    half_maximum = base_line + (maximum - base_line) / 2
+    below = power_spectra < half_maximum
+    left = np.max(np.where(below & (indices < k), indices, -1), axis=0)
+    right = np.min(np.where(below & (indices > k), indices, number_of_frequencies), axis=0)
+    found = (left >= 0) & (right < number_of_frequencies) & (maximum > base_line)
+
+    left = np.clip(left, 0, number_of_frequencies - 2)
+    right = np.clip(right, 1, number_of_frequencies - 1)
+    with np.errstate(all='ignore'):
+        left_crossing = frequencies[left] + step * ((half_maximum - power_spectra[left, columns]) /
+                                                    (power_spectra[left + 1, columns] - power_spectra[left, columns]))
+        right_crossing = frequencies[right] - step * ((half_maximum - power_spectra[right, columns]) /
+                                                      (power_spectra[right - 1, columns] - power_spectra[right, columns]))
+    width = np.where(found, right_crossing - left_crossing, np.nan)
+
+    return position, maximum, width, found
+
+
+def get_moment_estimates(frequencies, power_spectra, window=3.0, guess_positions=None, guess_widths=None,
+                         tolerance=1e-8, max_iterations=100):
+    """
+    Fit-free peak estimates of all power spectra columns at the same time. The maximum is located by a
+    local quadratic interpolation and the width at half maximum (linear interpolation of the crossings)
+    defines a window around it. The peak position is the first moment of the spectrum (over the base line)
+    in the window, and the width and area those of the Lorentzian with the same zeroth and second moments.
+    :param frequencies: frequencies (THz) (evenly spaced)
+    :param power_spectra: power spectra [frequency, column]
+    :param window: half size of the integration window in units of the peak width
+    :param guess_positions: initial peak positions of each column (NaN: maximum of the power spectrum).
+                            The maximum is searched within window widths of the initial position
+    :param guess_widths: initial peak widths of each column (NaN: width at half maximum)
+    :param tolerance: convergence tolerance of the position and width (relative to the frequency step)
+    :param max_iterations: maximum number of iterations of the moment equations
+    :return: dictionary of arrays [column] with the same keys as get_fitting of the fitting functions
+    """
+    frequencies = np.array(frequencies, dtype=float)
+    power_spectra = np.array(power_spectra, dtype=float).reshape((len(frequencies), -1))
+    number_of_columns = power_spectra.shape[1]
+    step = frequencies[1] - frequencies[0]
+
+    if guess_positions is None:
+        guess_positions = np.full(number_of_columns, np.nan)
+    if guess_widths is None:
+        guess_widths = np.full(number_of_columns, np.nan)
+    guess_positions = np.array(guess_positions, dtype=float).reshape(number_of_columns)
+    guess_widths = np.array(guess_widths, dtype=float).reshape(number_of_columns)
+
+    base_line = np.min(power_spectra, axis=0)
+
+    k = np.argmax(power_spectra, axis=0)
+    position, maximum, width, found = _get_half_maximum_width(frequencies, power_spectra, k, base_line)
+
+    # Maximum nearest to the initial positions
+    guessed = ~np.isnan(guess_positions)
+    if guessed.any():
+        search_size = window * np.where(np.isnan(guess_widths), width, guess_widths)
+        in_search = (np.abs(frequencies[:, None] - guess_positions) <= search_size) & guessed
+        guessed &= in_search.any(axis=0)
+        k = np.where(guessed, np.argmax(np.where(in_search, power_spectra, -np.inf), axis=0), k)
+
+        # Up to the local maximum (if it is out of the search range)
+        columns = np.arange(number_of_columns)
+        for i in range(len(frequencies)):
+            neighbours = np.clip(k[:, None] + [-1, 0, 1], 0, len(frequencies) - 1)
+            climb = neighbours[columns, np.argmax(power_spectra[neighbours, columns[:, None]], axis=1)]
+            if (climb == k).all():
+                break
+            k = climb
+        position, maximum, width, found = _get_half_maximum_width(frequencies, power_spectra, k, base_line)
+
+    width = np.where(found & ~np.isnan(guess_widths), guess_widths, width)
+
+    # Moments in a symmetric window around the peak (they average the noise of the spectrum,
+    # the half maximum width is only used as initial guess)
+    spectra = power_spectra - base_line
+    with np.errstate(all='ignore'):
+        for i in range(max_iterations):
+            previous_position, previous_width = np.array(position), np.array(width)
+
+            window_size = np.minimum(np.minimum(position - frequencies[0], frequencies[-1] - position),
+                                     window * width)
+            # Frequencies at the window edges are partially included (continuous in position and size)
+            in_window = np.clip((window_size - np.abs(frequencies[:, None] - position)) / step + 0.5, 0, 1)
+            zeroth_moment = np.trapz(in_window * spectra, frequencies, axis=0)
+            position += np.trapz(in_window * spectra * (frequencies[:, None] - position),
+                                 frequencies, axis=0) / zeroth_moment
+            second_moment = np.trapz(in_window * spectra * (frequencies[:, None] - position) ** 2,
+                                     frequencies, axis=0) / zeroth_moment
+
+            # Lorentzian: second_moment = b^2 * (r - atan(r)) / atan(r), r = window_size / b (fixed point)
+            half_width = width / 2
+            for j in range(max_iterations):
+                ratio = window_size / half_width
+                previous_half_width = half_width
+                half_width = np.sqrt(second_moment * np.arctan(ratio) / (ratio - np.arctan(ratio)))
+                if not (np.abs(half_width - previous_half_width) > tolerance * step).any():
+                    break
+            width = np.where(found, 2 * half_width, np.nan)
+
+            if not ((np.abs(position - previous_position) > tolerance * step) |
+                    (np.abs(width - previous_width) > tolerance * step)).any():
+                break
+
+        area = zeroth_moment / (2.0 / np.pi * np.arctan(window_size / half_width))
+
+        # Deviation from the estimated Lorentzian in the window
+        lorentzian = (area / (np.pi * width / 2 * (1.0 + (2 * (frequencies[:, None] - position) / width) ** 2)) +
+                      base_line)
+        deviation = np.sqrt(np.sum(in_window * (power_spectra - lorentzian) ** 2, axis=0) /
+                            np.maximum(np.sum(in_window, axis=0), 1))
+        global_error = deviation / np.sqrt(area)
+
+    all_good = found & np.isfinite(width) & (width > 0) & np.isfinite(area) & (area > 0) & np.isfinite(global_error)
+
+    return {'maximum': maximum,
+            'width': width,
+            'peak_position': position,
+            'global_error': global_error,
+            'area': area,
+            'base_line': base_line,
+            'all_good': all_good}
+
+
+def get_autocorrelations(vq, time_step):
+    """
+    Autocorrelation functions of the phonon projections (FFT, zero padded to avoid circular correlation).
+    Only the positive frequency part is kept, so their Fourier transforms are the power spectra
+    of the positive frequency range.
+    :param vq: phonon projections [time, phonon]
+    :param time_step: time step of the projections (ps)
+    :return: autocorrelations [lag, phonon] (eV) up to half of the trajectory length
+    """
+    vq = np.array(vq, dtype=complex).reshape((len(vq), -1))
+    number_of_steps = len(vq)
+
+    transform = np.fft.fft(vq, n=2 * number_of_steps, axis=0)
+    transform[np.fft.fftfreq(2 * number_of_steps) <= 0] = 0
+
+    number_of_lags = max(number_of_steps // 2, 1)
+    autocorrelations = np.fft.ifft(np.abs(transform) ** 2, axis=0)[:number_of_lags]
+
+    # Unbiased estimate (each lag is averaged over the overlapping steps only)
+    autocorrelations /= (number_of_steps - np.arange(number_of_lags))[:, None]
+
+    return autocorrelations * unit_conversion
+
+
+def get_autocorrelations_from_power_spectra(frequencies, power_spectra):
+    """
+    Autocorrelation functions from the power spectra (inverse Fourier transform on the frequency grid)
+    :param frequencies: frequencies (THz) (evenly spaced)
+    :param power_spectra: power spectra [frequency, column]
+    :return: time step (ps), autocorrelations [lag, column] up to half of the grid period
+    """
+    frequencies = np.array(frequencies, dtype=float)
+    power_spectra = np.array(power_spectra, dtype=float).reshape((len(frequencies), -1))
+    step = frequencies[1] - frequencies[0]
+
+    time_step = 1.0 / (len(frequencies) * step)
+    lags = np.arange(max(len(frequencies) // 2, 1)) * time_step
+
+    return time_step, np.dot(np.exp(2j * np.pi * np.outer(lags, frequencies)), power_spectra) * step
+
+
+def _weighted_linear_fit(x, y, weights):
+    # Weighted least squares line of all columns: slopes, intercepts and standard errors of the slopes
+    weights = weights / np.sum(weights, axis=0)
+    x_mean = np.sum(weights * x, axis=0)
+    y_mean = np.sum(weights * y, axis=0)
+    x_variance = np.sum(weights * (x - x_mean) ** 2, axis=0)
+
+    slope = np.sum(weights * (x - x_mean) * (y - y_mean), axis=0) / x_variance
+    intercept = y_mean - slope * x_mean
+
+    number_of_points = np.sum(weights > 0, axis=0)
+    residuals = np.sum(weights * (y - intercept - slope * x) ** 2, axis=0)
+    slope_error = np.sqrt(residuals / (x_variance * np.maximum(number_of_points - 2, 1)))
+
+    return slope, intercept, slope_error
+
+
+def get_envelope_estimates(time_step, autocorrelations, frequencies, window=1.0):
+    """
+    Peak estimates from the autocorrelation functions of all columns at the same time. The autocorrelations
+    are demodulated by the reference frequencies. The decay rate of the (exponential) envelope gives the
+    linewidth and the drift of the phase the shift of the peak from the reference frequency.
+    :param time_step: time step of the autocorrelations (ps)
+    :param autocorrelations: autocorrelations [lag, column] (see get_autocorrelations)
+    :param frequencies: reference frequencies of each column (THz) (e.g. harmonic frequencies)
+    :param window: the envelope is fitted until it decays by a factor exp(window)
+    :return: dictionary of arrays [column] with the same keys as get_fitting of the fitting functions
+    """
+    autocorrelations = np.array(autocorrelations, dtype=complex).reshape((len(autocorrelations), -1))
+    frequencies = np.array(frequencies, dtype=float)
+    lags = np.arange(len(autocorrelations))[:, None] * time_step
+
+    demodulated = autocorrelations * np.exp(-2j * np.pi * lags * frequencies)
+    envelope = np.abs(demodulated)
+
+    # Fitting window: from the origin to the first lag below the threshold (at least 3 lags)
+    below = envelope < envelope[0] * np.exp(-window)
+    cut = np.where(below.any(axis=0), np.argmax(below, axis=0), len(lags))
+    in_window = np.arange(len(lags))[:, None] < np.maximum(cut, 3)
+    weights = np.where(in_window, envelope ** 2, 0)
+
+    with np.errstate(all='ignore'):
+        # Lorentzian peak: phase = 2 * pi * shift * t, envelope = area * exp(-pi * width * t)
+        drift, phase, drift_error = _weighted_linear_fit(lags, np.unwrap(np.angle(demodulated), axis=0), weights)
+
+        # The envelope is taken from the in-phase part (the noise of the modulus does not average to zero)
+        in_phase = np.real(demodulated * np.exp(-1j * (phase + drift * lags)))
+        weights = np.where(in_phase > 0, weights, 0)
+        decay, log_area, decay_error = _weighted_linear_fit(lags, np.log(np.abs(in_phase)), weights)
+
+        # Lifetimes longer than the autocorrelations cannot be resolved
+        width = np.maximum(-decay, 1.0 / lags[-1, 0]) / np.pi
+        position = frequencies + drift / (2 * np.pi)
+        area = np.exp(log_area)
+        maximum = 2 * area / (np.pi * width)
+        global_error = np.average([decay_error / np.pi, drift_error / (2 * np.pi)], axis=0) / np.sqrt(area)
+
+    all_good = np.isfinite(width) & (width > 0) & np.isfinite(position) & np.isfinite(area) & (area > 0)
+
+    return {'maximum': maximum,
+            'width': width,
+            'peak_position': position,
+            'global_error': global_error,
+            'area': area,
+            'base_line': np.zeros_like(area),
+            'all_good': all_good}
+
+
+class Spectral_moments:
+    """
+    Fit-free estimator (see get_moment_estimates). The initial position and width are used to locate the
+    peak and as initial values of the moment equations (the height is not needed).
+    """
+    def __init__(self,
+                 test_frequencies_range,
+                 power_spectrum,
+                 guess_position=None,
+                 guess_height=None,
+                 guess_width=None):
+
+        self.test_frequencies_range = test_frequencies_range
+        self.power_spectrum = power_spectrum
+        self.guess_pos = guess_position
+        self.guess_height = guess_height
+        self.guess_width = guess_width
+
+        self._estimates = None
+
+        self.curve_name = 'Spectral moments'
+
+    @staticmethod
+    def _get_batch_estimates(test_frequencies_range, power_spectra, guess_positions=None, guess_widths=None):
+        # Estimates of all columns at once (used by batch_fitting.fit_power_spectra)
+        return get_moment_estimates(test_frequencies_range, power_spectra,
+                                    guess_positions=guess_positions, guess_widths=guess_widths)
+
+    def get_estimates(self):
+        if self._estimates is None:
+            guess_position = np.nan if self.guess_pos is None else self.guess_pos
+            guess_width = np.nan if self.guess_width is None else self.guess_width
+            estimates = self._get_batch_estimates(self.test_frequencies_range, self.power_spectrum,
+                                                  guess_positions=[guess_position], guess_widths=[guess_width])
+            self._estimates = {key: value[0] for key, value in estimates.items()}
+        return self._estimates
+
+    def get_fitting(self):
+        estimates = self.get_estimates()
+        if not estimates['all_good']:
+            return {'all_good': False}
+
+        return {'maximum': estimates['maximum'],
+                'width': estimates['width'],
+                'peak_position': estimates['peak_position'],
+                'global_error': estimates['global_error'],
+                'area': estimates['area'],
+                'base_line': estimates['base_line'],
+                'all_good': True}
+
+    def get_curve(self, frequency_range):
+        # Lorentzian with the estimated parameters
+        estimates = self.get_estimates()
+        half_width = estimates['width']/2
+        return (estimates['area']/(np.pi*half_width*(1.0+((frequency_range - estimates['peak_position'])/half_width)**2)) +
+                estimates['base_line'])
+
+
+class Autocorrelation_envelope(Spectral_moments):
+    """
+    Time domain estimator (see get_envelope_estimates). The autocorrelations are usually calculated
+    directly from the phonon projections (see fit_autocorrelations), if this class is used with power
+    spectra they are obtained from them by an inverse Fourier transform and demodulated by the initial
+    position (default: maximum of the power spectrum). The initial width and height are not needed.
+    """
+    def __init__(self,
+                 test_frequencies_range,
+                 power_spectrum,
+                 guess_position=None,
+                 guess_height=None,
+                 guess_width=None):
+
+        Spectral_moments.__init__(self, test_frequencies_range, power_spectrum,
+                                  guess_position=guess_position,
+                                  guess_height=guess_height,
+                                  guess_width=guess_width)
+        self.curve_name = 'Autocorrelation envelope'
+
+    @staticmethod
+    def _get_batch_estimates(test_frequencies_range, power_spectra, guess_positions=None, guess_widths=None):
+        power_spectra = np.array(power_spectra, dtype=float).reshape((len(test_frequencies_range), -1))
+        reference_frequencies = np.array(test_frequencies_range)[np.argmax(power_spectra, axis=0)]
+        if guess_positions is not None:
+            reference_frequencies = np.where(np.isnan(guess_positions), reference_frequencies, guess_positions)
+
+        time_step, autocorrelations = get_autocorrelations_from_power_spectra(test_frequencies_range, power_spectra)
+        return get_envelope_estimates(time_step, autocorrelations, reference_frequencies)
+
+
+def fit_autocorrelations(time_step, autocorrelations, harmonic_frequencies):
+    """
+    Peak estimates of all autocorrelation columns at once (no power spectra or frequency grid needed)
+    :param time_step: time step of the autocorrelations (ps)
+    :param autocorrelations: autocorrelations [lag, column] (see get_autocorrelations)
+    :param harmonic_frequencies: harmonic frequencies of each column (THz) used in the demodulation
+    :return: list of Autocorrelation_envelope objects (one for each column, see get_fitting)
+    """
+    estimates = get_envelope_estimates(time_step, autocorrelations, harmonic_frequencies)
+
+    functions = []
+    for i in range(len(harmonic_frequencies)):
+        function = Autocorrelation_envelope(None, None)
+        function._estimates = {key: value[i] for key, value in estimates.items()}
+        functions.append(function)
+
+    return functions
@@ -1,6 +1,8 @@
 import numpy as np
 from scipy.optimize import curve_fit, minimize_scalar
 
+from dynaphopy.analysis.fitting.estimators import Spectral_moments, Autocorrelation_envelope
+
 h_planck = 4.135667662e-3  # eV/ps
 h_planck_bar = 6.58211951e-4  # eV/ps
 kb_boltzmann = 8.6173324e-5  # eV/K
@@ -12,17 +14,46 @@ def get_standard_errors_from_covariance(covariance):
     #return np.sqrt(np.trace(covariance))
 
 
+def get_covariance_from_jacobian(jacobian, residuals):
+    """
+    Covariance of the fitted parameters (J^T J)^-1 * s^2 from the Jacobian at the solution (as curve_fit)
+    :param jacobian: Jacobian [frequency, parameter]
+    :param residuals: fitting residuals [frequency]
+    :return: covariance matrix (inf if it can not be determined)
+    """
+    number_of_parameters = jacobian.shape[-1]
+    covariance = np.full((number_of_parameters, number_of_parameters), np.inf)
+
+    if len(residuals) <= number_of_parameters:
+        return covariance
+
+    s_sq = np.sum(np.square(residuals)) / (len(residuals) - number_of_parameters)
+    try:
+        covariance = np.linalg.inv(np.dot(jacobian.T, jacobian)) * s_sq
+    except np.linalg.LinAlgError:
+        pass
+
+    return covariance
+
+
+def _stack_derivatives(*derivatives):
+    # Jacobian [..., parameter] with the shape of the broadcasted arguments
+    return np.stack(np.broadcast_arrays(*derivatives), axis=-1)
+
+
 class Lorentzian:
     def __init__(self,
                  test_frequencies_range,
                  power_spectrum,
                  guess_position=None,
-                 guess_height=None):
+                 guess_height=None,
+                 guess_width=None):
 
         self.test_frequencies_range = test_frequencies_range
         self.power_spectrum = power_spectrum
         self.guess_pos = guess_position
         self.guess_height = guess_height
+        self.guess_width = guess_width
 
         self._fit_params = None
         self._fit_covariances = None
@@ -39,18 +70,35 @@ class Lorentzian:
         """
         return c/(np.pi*b*(1.0+((x - a)/b)**2))+d
 
+    def _jacobian(self, x, a, b, c, d):
+        """Derivatives of the Lorentzian function with respect to a, b, c and d"""
+        u = (x - a)/b
+        shape = 1.0/(np.pi*b*(1.0+u**2))
+        lorentzian = c*shape
+        return _stack_derivatives(2*u*lorentzian/(b*(1.0+u**2)),
+                                  -lorentzian*(1.0-u**2)/(b*(1.0+u**2)),
+                                  shape,
+                                  np.ones_like(lorentzian))
+
+    def _get_initial_parameters(self):
+        # Peak width is 2*b
+        width_parameter = 0.1 if self.guess_width is None else self.guess_width/2.0
+        return [self.guess_pos, width_parameter, self.guess_height, 0.0]
+
     def get_fitting_parameters(self):
 
         if self._fit_params is None:
             if self.guess_pos is None or self.guess_height is None:
                 fit_params, fit_covariances = curve_fit(self._function,
                                                         self.test_frequencies_range,
-                                                        self.power_spectrum)
+                                                        self.power_spectrum,
+                                                        jac=self._jacobian)
             else:
                 fit_params, fit_covariances = curve_fit(self._function,
                                                         self.test_frequencies_range,
                                                         self.power_spectrum,
-                                                        p0=[self.guess_pos, 0.1, self.guess_height, 0.0])
+                                                        jac=self._jacobian,
+                                                        p0=self._get_initial_parameters())
             self._fit_covariances = fit_covariances
             self._fit_params = fit_params
 
@@ -99,12 +147,14 @@ class Lorentzian_asymmetric:
                  test_frequencies_range,
                  power_spectrum,
                  guess_position=None,
-                 guess_height=None):
+                 guess_height=None,
+                 guess_width=None):
 
         self.test_frequencies_range = test_frequencies_range
         self.power_spectrum = power_spectrum
         self.guess_pos = guess_position
         self.guess_height = guess_height
+        self.guess_width = guess_width
 
         self._fit_params = None
         self._fit_covariances = None
@@ -131,18 +181,42 @@ class Lorentzian_asymmetric:
         """
         return c/(np.pi*self._g_a(x, a, b, s)*(1.0+((x-a)/(self._g_a(x, a, b, s)))**2))+d
 
+    def _jacobian(self, x, a, b, c, d, s):
+        """Derivatives of the Lorentzian asymmetric function with respect to a, b, c, d and s"""
+        v = x - a
+        g = self._g_a(x, a, b, s)
+        q = g**2 + v**2
+        logistic = 0.5*(1.0 + np.tanh(s*v/2))  # exp(s*v)/(1+exp(s*v))
+
+        df_dg = c/np.pi*(v**2 - g**2)/q**2
+        df_dv = -2*c*g*v/(np.pi*q**2)
+        dg_dv = -g*s*logistic
+
+        return _stack_derivatives(-(df_dv + df_dg*dg_dv),
+                                  df_dg*2.0/(1.0+np.exp(s*v)),
+                                  g/(np.pi*q),
+                                  np.ones_like(q),
+                                  -df_dg*g*v*logistic)
+
+    def _get_initial_parameters(self):
+        # Peak width is 2*b
+        width_parameter = 0.1 if self.guess_width is None else self.guess_width/2.0
+        return [self.guess_pos, width_parameter, self.guess_height, 0.0, 0.0]
+
     def get_fitting_parameters(self):
 
         if self._fit_params is None:
             if self.guess_pos is None or self.guess_height is None:
                 fit_params, fit_covariances = curve_fit(self._function,
                                                         self.test_frequencies_range,
-                                                        self.power_spectrum)
+                                                        self.power_spectrum,
+                                                        jac=self._jacobian)
             else:
                 fit_params, fit_covariances = curve_fit(self._function,
                                                         self.test_frequencies_range,
                                                         self.power_spectrum,
-                                                        p0=[self.guess_pos, 0.1, self.guess_height, 0.0, 0.0])
+                                                        jac=self._jacobian,
+                                                        p0=self._get_initial_parameters())
             self._fit_covariances = fit_covariances
             self._fit_params = fit_params
 
@@ -199,12 +273,14 @@ class Damped_harmonic:
                  test_frequencies_range,
                  power_spectrum,
                  guess_position=None,
-                 guess_height=None):
+                 guess_height=None,
+                 guess_width=None):
 
         self.test_frequencies_range = test_frequencies_range
         self.power_spectrum = power_spectrum
         self.guess_pos = guess_position
         self.guess_height = guess_height
+        self.guess_width = guess_width
 
         self._fit_params = None
         self._fit_covariances = None
@@ -221,18 +297,33 @@ class Damped_harmonic:
         """
         return c/((a**2-x**2)**2 + (b*x)**2)+d
 
+    def _jacobian(self, x, a, b, c, d):
+        """Derivatives of the damped harmonic oscillator function with respect to a, b, c and d"""
+        denominator = (a**2-x**2)**2 + (b*x)**2
+        return _stack_derivatives(-4*a*c*(a**2-x**2)/denominator**2,
+                                  -2*b*c*x**2/denominator**2,
+                                  1.0/denominator,
+                                  np.ones_like(denominator))
+
+    def _get_initial_parameters(self):
+        # Peak width is |b|
+        width_parameter = 0.1 if self.guess_width is None else self.guess_width
+        return [self.guess_pos, width_parameter, self.guess_height, 0.0]
+
     def get_fitting_parameters(self):
 
         if self._fit_params is None:
             if self.guess_pos is None or self.guess_height is None:
                 fit_params, fit_covariances = curve_fit(self._function,
                                                         self.test_frequencies_range,
-                                                        self.power_spectrum)
+                                                        self.power_spectrum,
+                                                        jac=self._jacobian)
             else:
                 fit_params, fit_covariances = curve_fit(self._function,
                                                         self.test_frequencies_range,
                                                         self.power_spectrum,
-                                                        p0=[self.guess_pos, 0.1, self.guess_height, 0.0])
+                                                        jac=self._jacobian,
+                                                        p0=self._get_initial_parameters())
             self._fit_covariances = fit_covariances
             self._fit_params = fit_params
 
@@ -287,12 +378,14 @@ class Gaussian_function:
                  test_frequencies_range,
                  power_spectrum,
                  guess_position=None,
-                 guess_height=None):
+                 guess_height=None,
+                 guess_width=None):
 
         self.test_frequencies_range = test_frequencies_range
         self.power_spectrum = power_spectrum
         self.guess_pos = guess_position
         self.guess_height = guess_height
+        self.guess_width = guess_width
 
         self._fit_params = None
         self._fit_covariances = None
@@ -309,18 +402,34 @@ class Gaussian_function:
         """
         return c/b*np.sqrt(2*np.pi)*np.exp(-(x-a)**2/(2*b**2))+d
 
+    def _jacobian(self, x, a, b, c, d):
+        """Derivatives of the Gaussian PDF function with respect to a, b, c and d"""
+        shape = np.sqrt(2*np.pi)/b*np.exp(-(x-a)**2/(2*b**2))
+        gaussian = c*shape
+        return _stack_derivatives(gaussian*(x-a)/b**2,
+                                  gaussian*(-1.0/b + (x-a)**2/b**3),
+                                  shape,
+                                  np.ones_like(gaussian))
+
+    def _get_initial_parameters(self):
+        # Peak width is |b|
+        width_parameter = 0.1 if self.guess_width is None else self.guess_width
+        return [self.guess_pos, width_parameter, self.guess_height, 0.0]
+
     def get_fitting_parameters(self):
 
         if self._fit_params is None:
             if self.guess_pos is None or self.guess_height is None:
                 fit_params, fit_covariances = curve_fit(self._function,
                                                         self.test_frequencies_range,
-                                                        self.power_spectrum)
+                                                        self.power_spectrum,
+                                                        jac=self._jacobian)
             else:
                 fit_params, fit_covariances = curve_fit(self._function,
                                                         self.test_frequencies_range,
                                                         self.power_spectrum,
-                                                        p0=[self.guess_pos, 0.1, self.guess_height, 0.0])
+                                                        jac=self._jacobian,
+                                                        p0=self._get_initial_parameters())
             self._fit_covariances = fit_covariances
             self._fit_params = fit_params
 
@@ -368,11 +477,12 @@ class Gaussian_function:
         return self._function(frequency_range, *self.get_fitting_parameters()[0])
 
 
-
 fitting_functions = {
     0: Lorentzian,
     1: Lorentzian_asymmetric,
     2: Damped_harmonic,
+    3: Spectral_moments,
+    4: Autocorrelation_envelope,
 }
 
 # Test for automatic detection (order can change)
@@ -0,0 +1,142 @@
+import numpy as np
+
+import dynaphopy.interface.phonopy_link as pho_interface
+
+
+class InitialGuess:
+    """
+    Initial peak positions and widths of the phonon peak fitting taken from previous results
+    (e.g. a previous temperature of a temperature sweep). For each wave vector the guess is taken from
+    the results of the same wave vector (or equivalent by symmetry), from the frequency shifts and
+    linewidths of the nearest wave vector or, if there are no close results, from the harmonic frequencies.
+    """
+
+    def __init__(self, structure=None, quasiparticle_data=None, tolerance=1e-5, neighbour_distance=0.15):
+        """
+        :param structure: Structure object (used to find wave vectors equivalent by symmetry)
+        :param quasiparticle_data: previous results (see Quasiparticle.get_commensurate_points_data or
+                                   read_quasiparticle_data_from_file)
+        :param tolerance: tolerance used to compare wave vectors (reduced coordinates)
+        :param neighbour_distance: maximum distance (reduced coordinates) to use the results of another wave vector
+        """
+        self._structure = structure
+        self._tolerance = tolerance
+        self._neighbour_distance = neighbour_distance
+
+        self._q_points = np.zeros((0, 3))
+        self._frequencies = []
+        self._linewidths = []
+        self._frequency_shifts = []
+
+        if quasiparticle_data is not None:
+            self.add_data(quasiparticle_data)
+
+    def add_data(self, quasiparticle_data):
+        """
+        Add results (results of wave vectors already stored are replaced)
+        :param quasiparticle_data: dictionary with q_points, frequencies, linewidths and frequency_shifts
+        """
+        for i, q_point in enumerate(np.array(quasiparticle_data['q_points'], dtype=float)):
+            index = self._find_q_point(q_point, use_symmetry=False)
+            if index is None:
+                self._q_points = np.vstack([self._q_points, q_point])
+                self._frequencies.append(None)
+                self._linewidths.append(None)
+                self._frequency_shifts.append(None)
+                index = len(self._q_points) - 1
+
+            self._frequencies[index] = np.array(quasiparticle_data['frequencies'][i], dtype=float)
+            self._linewidths[index] = np.array(quasiparticle_data['linewidths'][i], dtype=float)
+            self._frequency_shifts[index] = np.array(quasiparticle_data['frequency_shifts'][i], dtype=float)
+
+    def _find_q_point(self, reduced_q_vector, use_symmetry=True):
+        # Index of the stored wave vector equal (up to a reciprocal lattice vector) or equivalent by symmetry
+        if len(self._q_points) == 0:
+            return None
+
+        difference = self._q_points - reduced_q_vector
+        difference -= np.around(difference)
+        equal = np.where((np.abs(difference) < self._tolerance).all(axis=1))[0]
+        if len(equal) > 0:
+            return equal[0]
+
+        if use_symmetry and self._structure is not None:
+            stars = pho_interface.get_commensurate_points_stars(self._structure,
+                                                                np.vstack([reduced_q_vector, self._q_points]),
+                                                                tolerance=self._tolerance)
+            equivalent = np.where(stars['mapping'][1:] == 0)[0]
+            if len(equivalent) > 0:
+                return equivalent[0]
+
+        return None
+
+    def _find_neighbour(self, reduced_q_vector):
+        # Index of the nearest stored wave vector (within neighbour_distance)
+        if len(self._q_points) == 0:
+            return None
+
+        difference = self._q_points - reduced_q_vector
+        difference -= np.around(difference)
+        distances = np.linalg.norm(difference, axis=1)
+        if np.min(distances) > self._neighbour_distance:
+            return None
+
+        return int(np.argmin(distances))
+
+    def _get_mode_mapping(self, index, harmonic_frequencies):
+        # Stored modes matched to the requested ones by their harmonic frequencies (mode order can differ,
+        # e.g. at wave vectors equivalent by symmetry or from another calculation)
+        stored_harmonic_frequencies = self._frequencies[index] - self._frequency_shifts[index]
+        if len(stored_harmonic_frequencies) != len(harmonic_frequencies):
+            return None
+
+        mapping = np.zeros(len(harmonic_frequencies), dtype=int)
+        mapping[np.argsort(harmonic_frequencies, kind='mergesort')] = np.argsort(stored_harmonic_frequencies,
+                                                                                kind='mergesort')
+        return mapping
+
+    def get_guess(self, reduced_q_vector, harmonic_frequencies, thermal_expansion_shift=None):
+        """
+        :param reduced_q_vector: wave vector in reduced coordinates
+        :param harmonic_frequencies: harmonic frequencies of the wave vector (THz)
+        :param thermal_expansion_shift: frequency shifts added to the fitted peak positions (see
+                                        phonon_fitting_analysis), removed from the guess
+        :return: peak positions and widths of each phonon in the power spectra (NaN if not available)
+        """
+        from dynaphopy.analysis.fitting import degenerate_sets
+
+        harmonic_frequencies = np.array(harmonic_frequencies, dtype=float)
+        positions = np.array(harmonic_frequencies)
+        widths = np.full(len(harmonic_frequencies), np.nan)
+
+        if thermal_expansion_shift is not None:
+            positions += thermal_expansion_shift
+
+        index = self._find_q_point(reduced_q_vector)
+        same_q_point = index is not None
+        if not same_q_point:
+            index = self._find_neighbour(reduced_q_vector)
+
+        mapping = None if index is None else self._get_mode_mapping(index, harmonic_frequencies)
+        if mapping is not None:
+            if same_q_point:
+                positions = self._frequencies[index][mapping]
+            else:
+                positions = harmonic_frequencies + self._frequency_shifts[index][mapping]
+            widths = self._linewidths[index][mapping]
+
+        if thermal_expansion_shift is not None:
+            positions -= thermal_expansion_shift
+
+        # Fixed or failed results (zero) are not used
+        positions[positions <= 0] = np.nan
+        widths[widths <= 0] = np.nan
+
+        # Same guess for degenerate phonons
+        for degenerate_set in degenerate_sets(harmonic_frequencies):
+            for values in [positions, widths]:
+                available = [i for i in degenerate_set if not np.isnan(values[i])]
+                if len(available) > 0:
+                    values[degenerate_set] = np.average(values[available])
+
+        return positions, widths
@@ -0,0 +1,234 @@
+import numpy as np
+
+import dynaphopy.parameters as parameters
+import dynaphopy.interface.phonopy_link as pho_interface
+import dynaphopy.analysis.fitting as fitting
+from dynaphopy.power_spectrum.streaming import StreamingPowerSpectrum
+
+
+def average_power_spectra(analyses):
+    """
+    Average the power spectra of independent in-situ analyses (e.g. generate_lammps_ensemble)
+    :param analyses: list of InSituAnalysis objects (same wave vectors, modes and frequency range)
+    :return: list of averaged power spectra for each wave vector, list of their standard errors
+    """
+    power_spectra = np.array([analysis.get_power_spectra() for analysis in analyses])
+
+    average = np.average(power_spectra, axis=0)
+    if len(analyses) > 1:
+        error = np.std(power_spectra, axis=0, ddof=1) / np.sqrt(len(analyses))
+    else:
+        error = np.zeros_like(average)
+
+    return list(average), list(error)
+
+
+class InSituAnalysis:
+    """
+    Phonon power spectra calculated while the MD is running (see generate_lammps_trajectory).
+    Each block of velocities is projected onto the phonon modes of the requested wave vectors
+    and accumulated in a StreamingPowerSpectrum, so the trajectory is never stored.
+    """
+
+    def __init__(self, structure, reduced_q_vectors,
+                 frequency_range=None,
+                 modes=None):
+        """
+        :param structure: Structure object (with force constants)
+        :param reduced_q_vectors: list of wave vectors in reduced coordinates of the primitive cell
+        :param frequency_range: frequencies (THz) where the power spectra are evaluated
+        :param modes: indices of the phonon modes (branches) to be analyzed (None: all)
+        """
+        self._structure = structure
+        self._reduced_q_vectors = np.array(reduced_q_vectors, dtype=float).reshape((-1, 3))
+
+        if frequency_range is None:
+            frequency_range = parameters.Parameters().frequency_range
+        self._frequency_range = np.array(frequency_range)
+
+        self._eigenvectors = []
+        self._frequencies = []
+        for reduced_q_vector in self._reduced_q_vectors:
+            eigenvectors, frequencies = pho_interface.obtain_eigenvectors_and_frequencies(structure,
+                                                                                          reduced_q_vector,
+                                                                                          print_data=False)
+            if modes is not None:
+                eigenvectors = eigenvectors[modes]
+                frequencies = np.array(frequencies)[modes]
+            self._eigenvectors.append(eigenvectors)
+            self._frequencies.append(frequencies)
+
+        self._eigenvectors = np.array(self._eigenvectors)
+        self._frequencies = np.array(self._frequencies)
+
+        self._phase_factors = None
+        self._atom_type = None
+        self._time_step = None
+        self._accumulator = None
+        self._convergence_history = []
+
+    def initialize(self, supercell, time_step):
+        """
+        Prepare the projection for the MD supercell (called by the MD driver)
+        :param supercell: MD supercell in units of the unit cell (see Dynamics.get_supercell_matrix)
+        :param time_step: time between the velocity samples (ps)
+        """
+        structure = self._structure
+        primitive_cell = structure.get_primitive_cell()
+
+        q_vectors = np.dot(self._reduced_q_vectors, 2 * np.pi * np.linalg.inv(primitive_cell).T)
+        positions = structure.get_positions(supercell)
+        masses = np.array(structure.get_masses(supercell=supercell))
+        self._atom_type = np.array(structure.get_atom_type_index(supercell=supercell))
+
+        # Mass weighting, wave vector phase and normalization (as projection.project_onto_wave_vector)
+        number_of_primitive_cells = len(masses) / structure.get_number_of_primitive_atoms()
+        self._phase_factors = (np.exp(-1j * np.dot(q_vectors, positions.T)) *
+                               np.sqrt(masses) / np.sqrt(number_of_primitive_cells))
+
+        self._time_step = time_step
+        number_of_channels = self._eigenvectors.shape[0] * self._eigenvectors.shape[1]
+        self._accumulator = StreamingPowerSpectrum(time_step,
+                                                   self._frequency_range[1] - self._frequency_range[0],
+                                                   number_of_channels=number_of_channels)
+
+    def project_block(self, velocity):
+        """
+        Project a block of velocities onto the phonon modes
+        :param velocity: velocities of shape (steps, atoms, 3) in dynaphopy atom order
+        :return: phonon coordinate velocities of shape (steps, q-vectors, modes)
+        """
+        number_of_primitive_atoms = self._eigenvectors.shape[2]
+
+        vc = np.zeros((velocity.shape[0], len(self._phase_factors), number_of_primitive_atoms,
+                       velocity.shape[2]), dtype=complex)
+        for i in range(number_of_primitive_atoms):
+            atoms = np.where(self._atom_type == i)[0]
+            vc[:, :, i, :] = np.einsum('qa,tak->tqk', self._phase_factors[:, atoms], velocity[:, atoms])
+
+        return np.einsum('tqik,qmik->tqm', vc, self._eigenvectors.conj())
+
+    def add_block(self, velocity):
+        """
+        Add a block of velocities to the power spectra
+        :param velocity: velocities of shape (steps, atoms, 3) in dynaphopy atom order
+        """
+        if self._accumulator is None:
+            print('In-situ analysis not initialized')
+            exit()
+
+        vq = self.project_block(velocity)
+        self._accumulator.add_data(vq.reshape((vq.shape[0], -1)))
+
+    def get_number_of_samples(self):
+        return 0 if self._accumulator is None else self._accumulator.get_number_of_samples()
+
+    def get_time_step(self):
+        return self._time_step
+
+    def get_frequency_range(self):
+        return self._frequency_range
+
+    def get_reduced_q_vectors(self):
+        return self._reduced_q_vectors
+
+    def get_frequencies(self):
+        # Harmonic frequencies of the analyzed modes [q-vector, mode]
+        return self._frequencies
+
+    def get_mean_square_velocity(self):
+        # Running average of |vq|^2 [q-vector, mode]
+        return self._accumulator.get_mean_square().reshape(self._frequencies.shape)
+
+    def get_power_spectra(self, error=False):
+        """
+        :param error: if True also return the standard error of the power spectra
+        :return: list of power spectra (frequencies, modes) for each wave vector [and their errors]
+        """
+        shape = (len(self._frequency_range),) + self._frequencies.shape
+
+        if error:
+            power_spectra, errors = self._accumulator.get_power_spectrum(self._frequency_range, error=True)
+            return (list(power_spectra.reshape(shape).transpose((1, 0, 2))),
+                    list(errors.reshape(shape).transpose((1, 0, 2))))
+
+        power_spectra = self._accumulator.get_power_spectrum(self._frequency_range)
+        return list(power_spectra.reshape(shape).transpose((1, 0, 2)))
+
+    def get_fitting(self, fitting_function_type=0):
+        """
+        Fit the current power spectra (see phonon_fitting_analysis)
+        :param fitting_function_type: fitting function (see fitting_functions)
+        :return: dictionary with peak positions and widths (THz) of shape [q-vector, mode]
+        """
+        power_spectra = [fitting.get_fitting_power_spectra(power_spectrum, frequencies)
+                         for power_spectrum, frequencies in zip(self.get_power_spectra(), self._frequencies)]
+
+        # Previous convergence check results (or the harmonic frequencies) are used as initial guess
+        if self._convergence_history:
+            guess_positions, guess_widths = np.array(self._convergence_history[-1], dtype=float).reshape((2, -1))
+        else:
+            guess_positions = np.array(self._frequencies, dtype=float).flatten()
+            guess_widths = np.full(len(guess_positions), np.nan)
+
+        # Failed fittings (zero) and non-positive frequencies are not used (maximum of the power spectra)
+        guess_positions[guess_positions <= 0] = np.nan
+        guess_widths[guess_widths <= 0] = np.nan
+
+        # All modes of all wave vectors are fitted together
+        number_of_modes = self._frequencies.shape[1]
+        fitted_functions = fitting.batch_fitting.fit_power_spectra(self._frequency_range,
+                                                                   np.hstack(power_spectra),
+                                                                   fitting_function_type=fitting_function_type,
+                                                                   guess_positions=guess_positions,
+                                                                   guess_widths=guess_widths)
+
+        positions = []
+        widths = []
+        for i, (power_spectrum, frequencies) in enumerate(zip(power_spectra, self._frequencies)):
+            data = fitting.phonon_fitting_analysis(power_spectrum, self._frequency_range,
+                                                   harmonic_frequencies=frequencies,
+                                                   fitting_function_type=fitting_function_type,
+                                                   show_plots=False,
+                                                   use_degeneracy=False,
+                                                   print_data=False,
+                                                   fitted_functions=fitted_functions[i * number_of_modes:
+                                                                                     (i + 1) * number_of_modes])
+            positions.append(data['positions'])
+            widths.append(data['widths'])
+
+        return {'positions': np.array(positions),
+                'widths': np.array(widths)}
+
+    def check_convergence(self, tolerance, window=3, fitting_function_type=0):
+        """
+        Fit the current power spectra and check if the peak positions and widths are converged
+        :param tolerance: maximum change (THz) allowed in positions and widths
+        :param window: number of consecutive checks that have to be within tolerance
+        :param fitting_function_type: fitting function (see fitting_functions)
+        :return: True if converged (all fittings successful in the last window checks)
+        """
+        if self._accumulator is None or self._accumulator.get_number_of_segments() == 0:
+            return False
+
+        data = self.get_fitting(fitting_function_type=fitting_function_type)
+        self._convergence_history.append(np.array([data['positions'], data['widths']]))
+
+        if len(self._convergence_history) <= window:
+            return False
+
+        history = np.array(self._convergence_history[-window - 1:])
+
+        # Failed fittings (zero or NaN position/width) are not converged. Acoustic modes
+        # at Gamma (zero harmonic frequency) can not be fitted and are not checked
+        tracked = np.abs(self._frequencies) > 1e-2
+        failed = np.any(~np.isfinite(history) | (history == 0), axis=1)
+        if not np.any(tracked) or np.any(failed[:, tracked]):
+            return False
+
+        change = np.max(np.abs(history[1:] - history[:-1])[:, :, tracked])
+        return bool(change < tolerance)
+
+    def get_convergence_history(self):
+        # Peak positions and widths at each convergence check [check, (positions, widths), q-vector, mode]
+        return np.array(self._convergence_history)
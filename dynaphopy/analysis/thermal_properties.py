@@ -10,108 +10,146 @@ h_bar = 6.626070040e-22  # J * ps
 warnings.simplefilter("ignore")
 
 
+def _get_reduced_frequency(temperature, frequency):
+    # x = h*freq/(k_b*T) on the (temperature, frequency) grid
+    temperature = np.array(temperature, dtype=float).ravel()
+    frequency = np.array(frequency, dtype=float)
+    return h_bar * frequency[None, :] / (k_b * temperature[:, None])
+
+
+def _get_occupation(x):
+    # Bose-Einstein occupation n(x) for x > 0 (0 elsewhere)
+    positive = x > 0
+    n = np.zeros_like(x)
+    n[positive] = 1.0 / np.expm1(x[positive])
+    return n
+
+
+def _get_mean_occupation(x):
+    # n(x) + 1/2 = coth(x/2)/2 (also defined for negative x, 0 at x = 0)
+    nonzero = x != 0
+    occupation = np.zeros_like(x)
+    occupation[nonzero] = 0.5 / np.tanh(x[nonzero] / 2)
+    return occupation
+
+
+def _integrate(values, frequency, temperature):
+    # Integrate over frequencies keeping the shape of temperature (scalar or array)
+    result = integrate.simps(values, frequency, axis=-1)
+    if np.ndim(temperature) == 0:
+        return result[0]
+    return result.reshape(np.shape(temperature))
+
+
 def get_dos(temp, frequency, power_spectrum, n_size, bose_einstein_statistics=False):
+    """
+    DoS from the power spectrum (temp can be an array of temperatures: returns [temperature, frequency])
+    """
 
     conversion_factor = 1.60217662e-19 # eV -> J
 
-    def n(temp, freq):
-        return pow(np.exp(freq*h_bar/(k_b*temp))-1, -1)
+    temperature = np.array(temp, dtype=float).ravel()
+    x = _get_reduced_frequency(temperature, frequency)
 
     if bose_einstein_statistics:
-        def energy(freq, temp):
-            return h_bar*freq*(0.5+n(temp, freq))
+        energy = h_bar * np.array(frequency, dtype=float)[None, :] * _get_mean_occupation(x)
     else:
-        def energy(freq, temp):
-            return k_b * temp
+        energy = np.repeat(k_b * temperature[:, None], x.shape[1], axis=1)
 
-    dos = np.nan_to_num([2.0*conversion_factor*power_spectrum[i]/(energy(freq, temp)*n_size)
-                         for i, freq in enumerate(frequency)])
-    return dos
+    dos = np.zeros_like(x)
+    nonzero = energy != 0
+    dos[nonzero] = (2.0 * conversion_factor * np.broadcast_to(power_spectrum, x.shape)[nonzero] /
+                    (energy[nonzero] * n_size))
 
+    if np.ndim(temp) == 0:
+        return dos[0]
+    return dos.reshape(np.shape(temp) + (x.shape[1],))
 
-def get_total_energy(temperature, frequency, dos):
 
-    def n(temp, freq):
-        return pow(np.exp(freq*h_bar/(k_b*temp))-1, -1)
+def get_total_energy(temperature, frequency, dos):
 
-    total_energy = np.nan_to_num([dos[i] * h_bar * freq * (0.5 + n(temperature, freq))
-                                 for i, freq in enumerate(frequency)])
+    x = _get_reduced_frequency(temperature, frequency)
+    total_energy = dos * h_bar * np.array(frequency)[None, :] * _get_mean_occupation(x)
 
-    total_energy = integrate.simps(total_energy, frequency) * N_a / 1000  # KJ/K/mol
+    total_energy = _integrate(total_energy, frequency, temperature) * N_a / 1000  # KJ/K/mol
     return total_energy
 
 
 def get_free_energy(temperature, frequency, dos):
 
-    free_energy = np.nan_to_num([dos[i] * k_b * temperature * np.log(2 * np.sinh(h_bar * freq / (2 * k_b * temperature)))
-                                 for i, freq in enumerate(frequency)])
+    x = _get_reduced_frequency(temperature, frequency)
+    temperature_grid = np.array(temperature, dtype=float).reshape((-1, 1))
+
+    # log(2*sinh(x/2)) = x/2 + log(1-exp(-x)) for x > 0
+    positive = x > 0
+    free_energy = np.zeros_like(x)
+    free_energy[positive] = x[positive] / 2 + np.log(-np.expm1(-x[positive]))
+    free_energy *= dos * k_b * temperature_grid
 
-    free_energy[0] = 0
-    free_energy = integrate.simps(free_energy, frequency) * N_a / 1000  # KJ/K/mol
+    free_energy[:, 0] = 0
+    free_energy = _integrate(free_energy, frequency, temperature) * N_a / 1000  # KJ/K/mol
     return free_energy
 
 
 def get_free_energy_correction_shift(temperature, frequency, dos, shift):
 
-    def n(temp, freq):
-        return pow(np.exp(freq*h_bar/(k_b*temp))-1, -1)
+    x = _get_reduced_frequency(temperature, frequency)
+    free_energy_c = dos * -h_bar/2 * shift * _get_mean_occupation(x)
 
-    free_energy_c = np.nan_to_num([dos[i] * -h_bar/2 *shift*(n(temperature, freq) + 1 / 2.)
-                                   for i, freq in enumerate(frequency)])
-
-    free_energy_c = integrate.simps(free_energy_c, frequency) * N_a / 1000 # KJ/K/mol
+    free_energy_c = _integrate(free_energy_c, frequency, temperature) * N_a / 1000 # KJ/K/mol
     return free_energy_c
 
 
 def get_free_energy_correction_dos(temperature, frequency, dos, dos_r):
 
-    def n(temp, freq):
-        return pow(np.exp(freq*h_bar/(k_b*temp))-1, -1)
-
-    free_energy_1 = np.nan_to_num([ dos_r[i] * -h_bar/2 * freq*(n(temperature, freq) + 1 / 2.)
-                                      for i, freq in enumerate(frequency)])
+    x = _get_reduced_frequency(temperature, frequency)
+    energy = -h_bar/2 * np.array(frequency)[None, :] * _get_mean_occupation(x)
 
-    free_energy_2 = np.nan_to_num([ dos[i] * -h_bar/2 * freq*(n(temperature, freq) + 1 / 2.)
-                                      for i, freq in enumerate(frequency)])
+    free_energy_c = (np.array(dos_r) - np.array(dos)) * energy
 
-    free_energy_c = free_energy_1 - free_energy_2
-
-    free_energy_c = integrate.simps(free_energy_c, frequency) * N_a / 1000 # KJ/K/mol
+    free_energy_c = _integrate(free_energy_c, frequency, temperature) * N_a / 1000 # KJ/K/mol
     return free_energy_c
 
 
 def get_entropy(temperature, frequency, dos):
 
-    def coth(x):
-        return  np.cosh(x)/np.sinh(x)
+    x = _get_reduced_frequency(temperature, frequency)
+
+    # x/2*coth(x/2) - log(2*sinh(x/2)) = x*n(x) - log(1-exp(-x)) for x > 0
+    positive = x > 0
+    entropy = np.zeros_like(x)
+    entropy[positive] = x[positive] * _get_occupation(x[positive]) - np.log(-np.expm1(-x[positive]))
+    entropy *= dos * k_b
 
-    entropy = np.nan_to_num([dos[i]*(1.0 / (2. * temperature) * h_bar * freq * coth(h_bar * freq / (2 * k_b * temperature))
-                                     - k_b * np.log(2 * np.sinh(h_bar * freq / (2 * k_b * temperature))))
-                             for i, freq in enumerate(frequency)])
-    entropy = integrate.simps(entropy, frequency) * N_a # J/K/mol
+    entropy = _integrate(entropy, frequency, temperature) * N_a # J/K/mol
     return entropy
 
 # Alternative way to calculate entropy (not used)
 def get_entropy2(temperature, frequency, dos):
 
-    def n(temp, freq):
-        return pow(np.exp(freq*h_bar/(k_b*temp))-1, -1)
+    x = _get_reduced_frequency(temperature, frequency)
 
-    entropy = np.nan_to_num([dos[i] * k_b * ((n(temperature, freq) + 1) * np.log(n(temperature, freq) + 1)
-                                             - n(temperature, freq) * np.log(n(temperature, freq)))
-                         for i, freq in enumerate(frequency)])
-    entropy = integrate.simps(entropy, frequency) * N_a # J/K/mol
+    positive = x > 0
+    n = _get_occupation(x)
+    entropy = np.zeros_like(x)
+    entropy[positive] = (n[positive] + 1) * np.log1p(n[positive]) - n[positive] * np.log(n[positive])
+    entropy = np.nan_to_num(entropy * dos * k_b)
+
+    entropy = _integrate(entropy, frequency, temperature) * N_a # J/K/mol
     return entropy
 
 
 def get_cv(temperature, frequency, dos):
 
-    def z(temp, freq):
-        return h_bar*freq/(k_b*temp)
+    x = np.abs(_get_reduced_frequency(temperature, frequency))
+
+    # z^2*exp(z)/(exp(z)-1)^2 = z^2*exp(-z)/(1-exp(-z))^2
+    nonzero = x != 0
+    c_v = np.zeros_like(x)
+    c_v[nonzero] = x[nonzero] ** 2 * np.exp(-x[nonzero]) / np.expm1(-x[nonzero]) ** 2
+    c_v *= dos * k_b
 
-    c_v = np.nan_to_num([dos[i] * k_b * pow(z(temperature, freq), 2) * np.exp(z(temperature, freq)) / pow(np.exp(z(temperature, freq)) - 1, 2)
-                         for i, freq in enumerate(frequency)])
-    c_v = integrate.simps(c_v, frequency) * N_a # J/K/mol
+    c_v = _integrate(c_v, frequency, temperature) * N_a # J/K/mol
 
     return c_v
 
@@ -13,7 +13,8 @@ class Dynamics:
                  energy=None,
                  time=None,
                  supercell=None,
-                 memmap=False):
+                 memmap=False,
+                 atom_indices=None):
 
         self._time = time
         self._trajectory = trajectory
@@ -22,6 +23,7 @@ class Dynamics:
         self._velocity = velocity
         self._supercell = supercell
         self._memmap=memmap
+        self._atom_indices = atom_indices  # supercell indices of the atoms stored (None: all atoms)
 
         self._time_step_average = None
         self._velocity_mass_average = None
@@ -50,7 +52,15 @@ class Dynamics:
         except KeyError:
             self._temp_directory = ''
 
+    def close(self):
+        # Close the files of the arrays read lazily from HDF5 files (see hdf5_array)
+        for mapped_array in [self._velocity, self._trajectory]:
+            if hasattr(mapped_array, 'close'):
+                mapped_array.close()
+
     def __del__(self):
+        self.close()
+
         #Clean all temporal files from memmap
         if self._memmap:
             for mapped_array in [self._velocity, self._trajectory, self._relative_trajectory, self._velocity_mass_average]:
@@ -58,6 +68,9 @@ class Dynamics:
                     filename = mapped_array.filename
                 except AttributeError:
                     continue
+                # Read-only maps are not temporal (e.g. trajectory cache files)
+                if mapped_array.mode == 'r':
+                    continue
                 del mapped_array
                 os.remove(filename)
 
@@ -108,9 +121,20 @@ class Dynamics:
 
     def get_number_of_atoms(self):
         if self._number_of_atoms is None:
-            self._number_of_atoms = self.structure.get_number_of_atoms()*np.product(self.get_supercell_matrix())
+            if self._atom_indices is not None:
+                self._number_of_atoms = len(self._atom_indices)
+            else:
+                self._number_of_atoms = self.get_number_of_supercell_atoms()
         return self._number_of_atoms
 
+    def get_number_of_supercell_atoms(self):
+        return self.structure.get_number_of_atoms()*np.product(self.get_supercell_matrix())
+
+    def get_atom_indices(self):
+        if self._atom_indices is None:
+            return np.arange(self.get_number_of_supercell_atoms())
+        return self._atom_indices
+
     def set_time(self, time):
         self._time = time
 
@@ -146,12 +170,12 @@ class Dynamics:
                 self._velocity_mass_average = np.memmap(self._temp_directory+'velocity_mass.{0}'.format(os.getpid()),
                                                         dtype='complex', mode='w+', shape=self.velocity.shape)
             else:
-                self._velocity_mass_average = np.empty_like(self.velocity)
+                self._velocity_mass_average = np.empty(self.velocity.shape, dtype=complex)
 
             supercell = self.get_supercell_matrix()
+            masses = np.array(self.structure.get_masses(supercell=supercell))[self.get_atom_indices()]
             for i in range(self.get_number_of_atoms()):
-                self._velocity_mass_average[:, i, :] = (self.velocity[:, i, :] *
-                                                        np.sqrt(self.structure.get_masses(supercell=supercell)[i]))
+                self._velocity_mass_average[:, i, :] = self.velocity[:, i, :] * np.sqrt(masses[i])
 
         return self._velocity_mass_average
 
@@ -163,7 +187,7 @@ class Dynamics:
             supercell = self.get_supercell()
             number_of_atoms = self.trajectory.shape[1]
             supercell_matrix = self.get_supercell_matrix()
-            position = self.structure.get_positions(supercell=supercell_matrix)
+            position = self.structure.get_positions(supercell=supercell_matrix)[self.get_atom_indices()]
 
 
             if self._memmap:
@@ -208,11 +232,8 @@ class Dynamics:
 
         if self._mean_displacement_matrix is None:
 
-            atom_type = self.structure.get_atom_type_index()
-            number_atom_primitive_equivalent = np.unique(atom_type, return_counts=True)[1]
-
             supercell = self.get_supercell_matrix()
-            atom_type_index = self.structure.get_atom_type_index(supercell=supercell)
+            atom_type_index = np.array(self.structure.get_atom_type_index(supercell=supercell))[self.get_atom_indices()]
             number_of_atom_types = self.structure.get_number_of_atom_types()
             number_of_dimensions = self.structure.get_number_of_dimensions()
             displacements = self.get_relative_trajectory()
@@ -222,19 +243,20 @@ class Dynamics:
             if use_average_positions:
                 position_difference = np.average(displacements, axis=0)
             else:
-                position_difference = np.zeros_like(self.structure.get_positions(supercell=supercell))
+                position_difference = np.zeros(displacements.shape[1:])
 
-            number_of_equivalent_atoms = np.prod(supercell)
+            # Number of atoms of each type (only the atoms stored)
+            number_of_equivalent_atoms = np.bincount(atom_type_index, minlength=number_of_atom_types)
+            number_of_equivalent_atoms[number_of_equivalent_atoms == 0] = 1
 
             mean_displacement_matrix = np.zeros((number_of_atom_types, number_of_dimensions, number_of_dimensions))
 
             for i in range(displacements.shape[1]):
-                primtive_normalization = number_atom_primitive_equivalent[atom_type_index[i]]
                 mean_displacement_matrix[atom_type_index[i], :, :] += np.dot(np.conj(displacements[:, i, :]).T,
                                                                              displacements[:, i, :] - position_difference[i]
-                                                                             ).real / primtive_normalization
+                                                                             ).real
 
-            self._mean_displacement_matrix = mean_displacement_matrix / (number_of_equivalent_atoms * number_of_data)
+            self._mean_displacement_matrix = mean_displacement_matrix / (number_of_equivalent_atoms[:, None, None] * number_of_data)
 
         return self._mean_displacement_matrix
 
@@ -245,7 +267,7 @@ class Dynamics:
 
         cell = self.get_supercell()
         number_of_atoms = self.trajectory.shape[1]
-        positions = self.structure.get_positions(supercell=supercell)
+        positions = self.structure.get_positions(supercell=supercell)[self.get_atom_indices()]
 
         normalized_trajectory = self.get_relative_trajectory()
 
@@ -267,15 +289,19 @@ class Dynamics:
             positions = self.structure.get_positions()
 
             index_type_unitcell = self.structure.get_atom_type_index()
-            index_type = self.structure.get_atom_type_index(supercell=supercell)
+            index_type = np.array(self.structure.get_atom_type_index(supercell=supercell))[self.get_atom_indices()]
 
             number_of_atom_types = self.structure.get_number_of_atom_types()
-            normalization = np.prod(supercell)
+
+            # Number of stored atoms of each type per unit cell atom of that type
+            normalization = (np.bincount(index_type, minlength=number_of_atom_types) /
+                             np.bincount(index_type_unitcell, minlength=number_of_atom_types).astype(float))
+            normalization[normalization == 0] = 1
 
             averaged_unit_cell = np.zeros((number_of_atom_types, number_of_dimensions), dtype=complex)
 
             for i, coordinates  in enumerate(averaged_positions):
-                averaged_unit_cell[index_type[i], :] += coordinates/normalization
+                averaged_unit_cell[index_type[i], :] += coordinates/normalization[index_type[i]]
 
             averaged_positions = []
             for i in range(positions.shape[0]):
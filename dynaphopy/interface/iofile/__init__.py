@@ -1,23 +1,15 @@
 import mmap
 import os
 import numpy as np
+from collections import OrderedDict
 
 import dynaphopy.dynamics as dyn
 import dynaphopy.atoms as atomtest
 from dynaphopy.interface import phonopy_link as pho_interface
 
-
-def diff_matrix(array_1, array_2, cell_size):
-    """
-    :param array_1: supercell scaled positions respect unit cell
-    :param array_2: supercell scaled positions respect unit cell
-    :param cell_size: diference between arrays accounting for periodicity
-    :return:
-    """
-    array_1_norm = np.array(array_1) / np.array(cell_size, dtype=float)[None,:]
-    array_2_norm = np.array(array_2) / np.array(cell_size, dtype=float)[None,:]
-
-    return array_2_norm - array_1_norm
+# Atoms order templates per (structure, supercell) (see get_correct_arrangement)
+_arrangement_cache = OrderedDict()
+_arrangement_cache_size = 8
 
 
 def check_atoms_order(filename, trajectory_reading_function, structure):
@@ -41,103 +33,109 @@ def check_atoms_order(filename, trajectory_reading_function, structure):
 
 
 def get_correct_arrangement(reference, structure):
+    """
+    Find the order of the atoms in an MD supercell respect to the dynaphopy ordering.
+    Each atom is assigned to the closest unit cell atom and to an integer lattice point, and the
+    pair gives the dynaphopy index directly (the cost scales as N * number of unit cell atoms).
+    Templates are cached per (structure, supercell) and reused if they are consistent with
+    the lattice points of the reference positions.
+    :param reference: cartesian positions of the supercell atoms (array Natoms x Ndim)
+    :param structure: unit cell structure object
+    :return: template (index of each atom in dynaphopy order)
+    """
 
-    # print structure.get_scaled_positions()
-    scaled_coordinates = []
-    for coordinate in reference:
-        trans = np.dot(coordinate, np.linalg.inv(structure.get_cell()))
-        #print coordinate.real, trans.real
-        scaled_coordinates.append(np.array(trans.real, dtype=float))
+    reference = np.array(reference).real
+    cell = structure.get_cell()
+    unit_cell_positions = structure.get_scaled_positions()
+
+    scaled_coordinates = np.dot(reference, np.linalg.inv(cell))
 
     number_of_cell_atoms = structure.get_number_of_atoms()
-    number_of_supercell_atoms = len(scaled_coordinates)
+    number_of_supercell_atoms = scaled_coordinates.shape[0]
     supercell_dim = np.array(np.round(np.max(scaled_coordinates, axis=0)), dtype=int)
+    supercell_dim[supercell_dim < 1] = 1
+    number_of_cells = np.prod(supercell_dim)
+
+    if number_of_supercell_atoms != number_of_cells * number_of_cell_atoms:
+        print ('template failed, number of atoms do not match the supercell ({} / {})'.format(
+            number_of_supercell_atoms, number_of_cells * number_of_cell_atoms))
+        return np.arange(number_of_supercell_atoms)
+
+    def get_template(atom_unit_cell_index):
+        # Integer lattice point of each atom wrapped into the supercell
+        lattice_points = np.round(scaled_coordinates - unit_cell_positions[atom_unit_cell_index]).astype(int)
+        lattice_points = np.mod(lattice_points, supercell_dim)
+
+        return (lattice_points[:, 0] +
+                lattice_points[:, 1] * supercell_dim[0] +
+                lattice_points[:, 2] * supercell_dim[0] * supercell_dim[1] +
+                atom_unit_cell_index * number_of_cells)
+
+    # Check if this arrangement has already been calculated (same MD setup)
+    cache_key = (np.array(cell, dtype=float).tobytes(),
+                 np.array(unit_cell_positions, dtype=float).tobytes(),
+                 tuple(supercell_dim))
+
+    if cache_key in _arrangement_cache:
+        template = _arrangement_cache.pop(cache_key)
+        _arrangement_cache[cache_key] = template  # most recently used
+        if np.array_equal(get_template(template // number_of_cells), template):
+            return template.copy()
+
+    # Assign each atom to the closest unit cell atom (accounting for periodicity)
+    diff = scaled_coordinates[:, None, :] - unit_cell_positions[None, :, :]
+    diff -= np.round(diff)
+    atom_unit_cell_index = np.argmin(np.linalg.norm(np.dot(diff, cell), axis=2), axis=1)
+
+    template = get_template(atom_unit_cell_index)
 
-    unit_cell_scaled_coordinates = scaled_coordinates - np.array(scaled_coordinates, dtype=int)
-
-    atom_unit_cell_index = []
-    for coordinate in unit_cell_scaled_coordinates:
-        # Only works for non symmetric cell (must be changed)
-
-        diff = np.abs(np.array([coordinate]*number_of_cell_atoms) - structure.get_scaled_positions())
-
-        diff[diff >= 0.5] -= 1.0
-        diff[diff < -0.5] += 1.0
-
-        # print 'diff', diff
-        # print 'postions', structure.get_scaled_positions()
-        index = np.argmin(np.linalg.norm(diff, axis=1))
-
-        # print 'test', coordinate, index
-        atom_unit_cell_index.append(index)
-    atom_unit_cell_index = np.array(atom_unit_cell_index)
-    # np.savetxt('index.txt', np.sort(atom_unit_cell_index))
-
-    # np.savetxt('test.txt', unit_coordinates)
-    # np.savetxt('test2.txt', np.array([type_0(j, cell_size, number_of_cell_atoms)[:3] for j in range(number_of_supercell_atoms)]))
-
-    # print supercell_dim, number_of_supercell_atoms
-    original_conf = np.array([dynaphopy_order(j, supercell_dim)[:3] for j in range(number_of_supercell_atoms)])
-
-    # np.savetxt('original.txt', original_conf)
-    # np.savetxt('unitcoor.txt', scaled_coordinates)
-
-    # print np.array(scaled_coordinates).shape
-    # print original_conf.shape
-
-    template = []
-    lp_coordinates = []
-    for i, coordinate in enumerate(scaled_coordinates):
-        lattice_points_coordinates = coordinate - structure.get_scaled_positions()[atom_unit_cell_index[i]]
-        # print 'c', i, coordinate, coordinate2
-
-        for k in range(3):
-            if lattice_points_coordinates[k] > supercell_dim[k] - 0.5:
-                lattice_points_coordinates[k] = lattice_points_coordinates[k] - supercell_dim[k]
-            if lattice_points_coordinates[k] < -0.5:
-                lattice_points_coordinates[k] = lattice_points_coordinates[k] + supercell_dim[k]
-
-        comparison_cell = np.array([lattice_points_coordinates]*number_of_supercell_atoms)
-        diference = np.linalg.norm(diff_matrix(original_conf, comparison_cell, supercell_dim), axis=1)
-        template.append(np.argmin(diference) + atom_unit_cell_index[i]*number_of_supercell_atoms/number_of_cell_atoms)
-
-        lp_coordinates.append(lattice_points_coordinates)
-    template = np.array(template)
-    # lp_coordinates = np.array(lp_coordinates)
-    # print original_conf.shape, lp_coordinates.shape, template.shape
-    # np.savetxt('index2.txt', np.sort(template))
-    # np.savetxt('index_tot.txt', np.sort(template*number_of_cell_atoms + atom_unit_cell_index))
+    if len(np.unique(template)) < len(template):
+        print ('template failed, auto-order will not be applied')
+        print ('unique: {} / {}'.format(len(np.unique(template)), len(template)))
+        return np.arange(len(template))
 
-    # inv_template = inverse_template(template)
-    # inv_template = np.argsort(template)
+    _arrangement_cache[cache_key] = template
+    while len(_arrangement_cache) > _arrangement_cache_size:
+        _arrangement_cache.popitem(last=False)
 
-    # dm = diff_matrix(original_conf, lp_coordinates[inv_template], supercell_dim)
-    # dm = diff_matrix(original_conf[template], lp_coordinates, supercell_dim)
+    return template.copy()
 
-    # np.savetxt('template.txt', template)
 
-    # np.savetxt('lp.txt', lp_coordinates[inv_template])
-    # np.savetxt('diff.txt', dm)
+def get_atom_selection(structure, number_of_atoms, atoms=None, atom_types=None):
+    """
+    Get the supercell atom indices (dynaphopy order) of a selection of atoms
+    :param structure: unit cell structure
+    :param number_of_atoms: number of atoms in the MD supercell
+    :param atoms: list of supercell atom indices
+    :param atom_types: list of atom types (as in structure.get_atom_type_index())
+    :return: sorted array of selected atom indices (None if no selection is requested)
+    """
+    if atoms is None and atom_types is None:
+        return None
 
-    if len(np.unique(template)) < len(template):
-        print ('template failed, auto-order will not be applied')
-        print ('unique: {} / {}'.format(len(np.unique(template)), len(template)))
-        return range(len(template))
+    selection = np.arange(number_of_atoms)
 
-    return template
+    if atom_types is not None:
+        if structure is None:
+            print('Structure is needed to select atoms by type')
+            exit()
+        number_of_cells = number_of_atoms // structure.get_number_of_cell_atoms()
+        atom_type_index = np.repeat(structure.get_atom_type_index(), number_of_cells)
+        selection = selection[np.in1d(atom_type_index, atom_types)]
 
+    if atoms is not None:
+        selection = np.intersect1d(selection, atoms)
 
-def dynaphopy_order(i, size):
-    x = np.mod(i, size[0])
-    y = np.mod(i, size[0]*size[1])//size[0]
-    z = np.mod(i, size[0]*size[1]*size[2])//(size[1]*size[0])
-    k = i//(size[1]*size[0]*size[2])
+    if len(selection) == 0:
+        print('No atoms selected')
+        exit()
 
-    return np.array([x, y, z, k])
+    return selection
 
 
-def get_trajectory_parser(file_name, bytes_to_check=1000000):
+def get_trajectory_parser(file_name, bytes_to_check=1000000, cache=False):
     from dynaphopy.interface.iofile import trajectory_parsers as tp
+    from dynaphopy.interface.iofile.file_map import read_file_head
 
     parsers_keywords = {'vasp_outcar': {'function': tp.read_vasp_trajectory,
                                         'keywords': ['NIONS', 'POMASS', 'direct lattice vectors']},
@@ -151,15 +149,17 @@ def get_trajectory_parser(file_name, bytes_to_check=1000000):
         print (file_name + ' file does not exist')
         exit()
 
-    file_size = os.stat(file_name).st_size
+    # Read the beginning of the file (decompressed if needed)
+    file_head = read_file_head(file_name, bytes_to_check)
 
     # Check available parsers
     for parser in parsers_keywords.values():
-        with open(file_name, "r+b") as f:
-            file_map = mmap.mmap(f.fileno(), np.min([bytes_to_check, file_size]))
-            num_test = [file_map.find(keyword.encode()) for keyword in list(parser['keywords'])]
+        num_test = [file_head.find(keyword.encode()) for keyword in list(parser['keywords'])]
 
         if not -1 in num_test:
+            if cache:
+                from dynaphopy.interface.iofile.trajectory_cache import cached_trajectory_parser
+                return cached_trajectory_parser(parser['function'])
             return parser['function']
 
     return None
@@ -634,23 +634,70 @@ def write_xsf_file(file_name,structure):
 
 
 # Save & load HDF5 data file
-def save_data_hdf5(file_name, time, super_cell, trajectory=None, velocity=None, vc=None, reduced_q_vector=None):
+def get_hdf5_chunks(shape, itemsize, chunk_bytes=256*1024):
+    # Time-major chunks of one atom: reading one atom touches only its chunks while
+    # reading a range of time steps for all atoms reads contiguous blocks of each atom
+    steps = int(max(1, min(shape[0], chunk_bytes // (itemsize * int(np.prod(shape[2:]))))))
+    return (steps, 1) + tuple(shape[2:])
+
+
+def create_data_dataset(hdf5_file, name, data, compression=None, real=False, single_precision=False):
+    """
+    Create a time x atoms x dimensions dataset with the requested storage profile
+    :param hdf5_file: h5py file object
+    :param name: dataset name
+    :param data: data array
+    :param compression: None (contiguous storage), 'gzip' or 'lzf' (chunked, shuffled and compressed)
+    :param real: store only the real part of data
+    :param single_precision: store data in single precision
+    :return: h5py dataset
+    """
+    data = np.asarray(data)
+    if real:
+        data = data.real
+
+    if single_precision:
+        data = data.astype(np.complex64 if np.iscomplexobj(data) else np.float32)
+
+    if compression is None:
+        dataset = hdf5_file.create_dataset(name, data=data)
+    else:
+        dataset = hdf5_file.create_dataset(name, data=data,
+                                           chunks=get_hdf5_chunks(data.shape, data.dtype.itemsize),
+                                           shuffle=True,
+                                           compression=compression)
+
+    # Record the storage layout
+    dataset.attrs['layout'] = 'contiguous' if dataset.chunks is None else 'chunked'
+    dataset.attrs['compression'] = str(compression)
+    dataset.attrs['real'] = real
+    dataset.attrs['single_precision'] = single_precision
+
+    return dataset
+
+
+def save_data_hdf5(file_name, time, super_cell, trajectory=None, velocity=None, vc=None, reduced_q_vector=None,
+                   atom_indices=None, compression=None, real=False, single_precision=False):
     import h5py
 
     hdf5_file = h5py.File(file_name, "w")
 
+    storage = {'compression': compression, 'single_precision': single_precision}
+
     if trajectory is not None:
-        hdf5_file.create_dataset('trajectory', data=trajectory)
+        create_data_dataset(hdf5_file, 'trajectory', trajectory, real=real, **storage)
 
     if velocity is not None:
-        hdf5_file.create_dataset('velocity', data=velocity)
+        create_data_dataset(hdf5_file, 'velocity', velocity, real=real, **storage)
 
     if vc is not None:
-        hdf5_file.create_dataset('vc', data=vc)
+        create_data_dataset(hdf5_file, 'vc', vc, **storage)
 
     if reduced_q_vector is not None:
         hdf5_file.create_dataset('reduced_q_vector', data=reduced_q_vector)
 
+    if atom_indices is not None:
+        hdf5_file.create_dataset('atom_indices', data=atom_indices)
 
     hdf5_file.create_dataset('time', data=time)
     hdf5_file.create_dataset('super_cell', data=super_cell)
@@ -659,13 +706,16 @@ def save_data_hdf5(file_name, time, super_cell, trajectory=None, velocity=None,
     hdf5_file.close()
 
 
-def initialize_from_hdf5_file(file_name, structure, read_trajectory=True, initial_cut=1, final_cut=None, memmap=False):
+def initialize_from_hdf5_file(file_name, structure, read_trajectory=True, initial_cut=1, final_cut=None, memmap=False,
+                              atoms=None, atom_types=None):
     import h5py
+    from dynaphopy.interface.iofile.hdf5_array import map_dataset
 
     print("Reading data from hdf5 file: " + file_name)
 
     trajectory = None
     velocity = None
+    energy = None
     vc = None
     reduced_q_vector = None
 
@@ -675,42 +725,66 @@ def initialize_from_hdf5_file(file_name, structure, read_trajectory=True, initia
         exit()
 
     hdf5_file = h5py.File(file_name, "r")
-    if "trajectory" in hdf5_file and read_trajectory is True:
-        trajectory = hdf5_file['trajectory'][:]
-        if final_cut is not None:
-            trajectory = trajectory[initial_cut-1:final_cut]
+    supercell = hdf5_file['super_cell'][:]
+
+    # Atom selection (atoms stored in file are defined by atom_indices)
+    number_of_atoms = structure.get_number_of_cell_atoms() * np.prod(supercell)
+    atom_indices = get_atom_selection(structure, number_of_atoms, atoms=atoms, atom_types=atom_types)
+    columns = atom_indices
+    if "atom_indices" in hdf5_file:
+        stored_indices = hdf5_file['atom_indices'][:]
+        if atom_indices is None:
+            atom_indices = stored_indices
         else:
-            trajectory = trajectory[initial_cut-1:]
+            atom_indices = np.intersect1d(atom_indices, stored_indices)
+            columns = np.searchsorted(stored_indices, atom_indices)
+
+    # Read only the requested hyperslab (or map it from file if memmap)
+    time_slice = slice(initial_cut-1, final_cut)
+
+    def read_dataset(dataset_name):
+        if memmap:
+            return map_dataset(file_name, dataset_name, time_slice=time_slice, columns=columns)
+        if columns is None:
+            return np.asarray(hdf5_file[dataset_name][time_slice], dtype=complex)
+        return np.asarray(hdf5_file[dataset_name][time_slice, list(columns)], dtype=complex)
+
+    if "trajectory" in hdf5_file and read_trajectory is True:
+        trajectory = read_dataset('trajectory')
 
     if "velocity" in hdf5_file:
-        velocity = hdf5_file['velocity'][:]
-        if final_cut is not None:
-            velocity = velocity[initial_cut-1:final_cut]
-        else:
-            velocity = velocity[initial_cut-1:]
+        velocity = read_dataset('velocity')
 
     if "vc" in hdf5_file:
-        vc = hdf5_file['vc'][:]
-        if final_cut is not None:
-            vc = vc[initial_cut-1:final_cut]
-        else:
-            vc = vc[initial_cut-1:]
+        vc = np.asarray(hdf5_file['vc'][time_slice], dtype=complex)
+
+    if "energy" in hdf5_file:
+        energy = hdf5_file['energy'][time_slice]
 
     if "reduced_q_vector" in hdf5_file:
         reduced_q_vector = hdf5_file['reduced_q_vector'][:]
         print("Load trajectory projected onto {0}".format(reduced_q_vector))
 
+    # Files joined with old versions of concath5 only store the time of the first file
     time = hdf5_file['time'][:]
-    supercell = hdf5_file['super_cell'][:]
+    time_step = hdf5_file.attrs.get('time_step')
+    if time_step is None and len(time) > 1:
+        time_step = time[1] - time[0]
+    number_of_steps = [hdf5_file[name].shape[0] for name in ['trajectory', 'velocity', 'vc'] if name in hdf5_file]
+    if number_of_steps and 0 < len(time) < max(number_of_steps) and time_step is not None:
+        time = time[0] + time_step * np.arange(max(number_of_steps))
+    time = time[time_slice]
     hdf5_file.close()
 
     if vc is None:
         return dyn.Dynamics(structure=structure,
                             trajectory=trajectory,
                             velocity=velocity,
+                            energy=energy,
                             time=time,
                             supercell=np.dot(np.diagflat(supercell), structure.get_cell()),
-                            memmap=memmap)
+                            memmap=memmap,
+                            atom_indices=atom_indices)
     else:
         return vc, reduced_q_vector, dyn.Dynamics(structure=structure,
                                                   time=time,
@@ -741,6 +815,24 @@ def save_quasiparticle_data_to_file(quasiparticle_data, filename):
         yaml.dump(output_dict, outfile, default_flow_style=False)
 
 
+def read_quasiparticle_data_from_file(filename):
+
+    import yaml
+
+    # Check file exists
+    if not os.path.isfile(filename):
+        print('Quasiparticle data file does not exist!')
+        exit()
+
+    with open(filename, 'r') as stream:
+        data = yaml.safe_load(stream)
+
+    return {'q_points': np.array([q_point['reduced_wave_vector'] for q_point in data]),
+            'frequencies': np.array([q_point['frequencies'] for q_point in data]),
+            'linewidths': np.array([q_point['linewidths'] for q_point in data]),
+            'frequency_shifts': np.array([q_point['frequency_shifts'] for q_point in data])}
+
+
 def save_mesh_data_to_yaml_file(mesh_data, filename):
 
     import yaml
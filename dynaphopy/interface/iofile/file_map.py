@@ -0,0 +1,251 @@
+import mmap
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Compressed formats recognized by their magic number
+def _gzip_open(file_name):
+    import gzip
+    return gzip.open(file_name, 'rb')
+
+
+def _bz2_open(file_name):
+    import bz2
+    return bz2.BZ2File(file_name, 'rb')
+
+
+def _xz_open(file_name):
+    try:
+        import lzma
+    except ImportError:
+        print('xz compressed files require the lzma module (Python 3)')
+        exit()
+    return lzma.open(file_name, 'rb')
+
+
+compressed_formats = {'gzip': {'magic': b'\x1f\x8b', 'function': _gzip_open},
+                      'bzip2': {'magic': b'BZh', 'function': _bz2_open},
+                      'xz': {'magic': b'\xfd7zXZ\x00', 'function': _xz_open}}
+
+
+def get_compression_format(file_name):
+    with open(file_name, 'rb') as f:
+        header = f.read(8)
+
+    for name, compression in compressed_formats.items():
+        if header.startswith(compression['magic']):
+            return name
+    return None
+
+
+class _MemoryFileMap(mmap.mmap):
+    # mmap objects are not context managers in Python 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_file_map(file_name, read_ahead=True):
+    """
+    Open a trajectory file for reading with the mmap interface (find, seek, readline, read).
+    Uncompressed files are memory-mapped, compressed files (gzip, bzip2, xz) are decompressed
+    on the fly by blocks without writing anything to disk.
+    :param file_name: trajectory file name
+    :param read_ahead: decompress the next blocks in a background thread while the current one is parsed
+    :return: file map object
+    """
+    compression = get_compression_format(file_name)
+    if compression is None:
+        with open(file_name, 'r+b') as f:
+            return _MemoryFileMap(f.fileno(), 0)
+
+    print('Reading {} compressed file'.format(compression))
+    return StreamFileMap(file_name, compressed_formats[compression]['function'], read_ahead=read_ahead)
+
+
+def read_file_head(file_name, number_of_bytes):
+    """
+    Read the first bytes of a (possibly compressed) file. Used to check the file format.
+    """
+    compression = get_compression_format(file_name)
+    if compression is None:
+        with open(file_name, 'rb') as f:
+            return f.read(number_of_bytes)
+
+    stream = compressed_formats[compression]['function'](file_name)
+    try:
+        return stream.read(number_of_bytes)
+    finally:
+        stream.close()
+
+
+class _BlockReader(threading.Thread):
+    # Read-ahead of the decompressed blocks. The decompression of a stream is sequential (one thread),
+    # but it releases the GIL so it overlaps with the parsing of the previous blocks
+
+    def __init__(self, stream, block_size, blocks_ahead=4):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._stream = stream
+        self._block_size = block_size
+        self._queue = queue.Queue(maxsize=blocks_ahead)
+        self._stop_event = threading.Event()
+        self.start()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            block = self._stream.read(self._block_size)
+            while not self._stop_event.is_set():
+                try:
+                    self._queue.put(block, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if not block:
+                break
+
+    def read(self):
+        return self._queue.get()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class StreamFileMap:
+    """
+    Read-only file map over a decompression stream. Only a window of the decompressed data
+    around the current position is kept in memory. Seeking backwards beyond this window
+    restarts the decompression from the beginning of the file.
+    """
+
+    def __init__(self, file_name, open_function, block_size=4*1024*1024, read_ahead=True):
+
+        self._file_name = file_name
+        self._open_function = open_function
+        self._block_size = block_size
+        self._read_ahead = read_ahead
+
+        self._stream = None
+        self._reader = None
+        self._open()
+
+    def _open(self):
+        self.close()
+
+        self._stream = self._open_function(self._file_name)
+        if self._read_ahead:
+            self._reader = _BlockReader(self._stream, self._block_size)
+
+        self._buffer = bytearray()
+        self._offset = 0  # position in file of the first byte in buffer
+        self._position = 0
+        self._eof = False
+
+    def _read_block(self):
+        if self._reader is not None:
+            return self._reader.read()
+        return self._stream.read(self._block_size)
+
+    def _discard(self, position):
+        # Drop the buffered data before position
+        discard = min(position - self._offset, len(self._buffer))
+        if discard > 0:
+            del self._buffer[:discard]
+            self._offset += discard
+
+    def _extend_buffer(self):
+        # Drop the data already read (keep one block to allow short backward seeks)
+        self._discard(self._position - self._block_size)
+
+        block = self._read_block()
+        if not block:
+            self._eof = True
+            return False
+
+        self._buffer += block
+        return True
+
+    def _fill(self, size):
+        # Data before the current position may have been dropped by find
+        if self._position < self._offset:
+            position = self._position
+            self._open()
+            self._position = position
+
+        while self._offset + len(self._buffer) < self._position + size and not self._eof:
+            self._extend_buffer()
+
+    def find(self, sub, start=None):
+        if start is None:
+            start = self._position
+
+        if start < self._offset:
+            position = self._position
+            self._open()
+            self._position = position
+
+        search_from = start
+        while True:
+            index = self._buffer.find(sub, max(0, search_from - self._offset))
+            if index >= 0:
+                return self._offset + index
+
+            search_from = max(start, self._offset + len(self._buffer) - len(sub) + 1)
+
+            # The data already searched is not kept (reading it again restarts the decompression),
+            # except the data after the current position in short searches (as readline)
+            discard = search_from - len(sub)
+            if discard - self._position < 2 * self._block_size:
+                discard = min(discard, self._position)
+            self._discard(discard)
+            if self._eof or not self._extend_buffer():
+                return -1
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self._position
+        elif whence == 2:
+            raise ValueError('seek from end is not supported in compressed files')
+
+        if position < self._offset:
+            self._open()
+
+        self._position = position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size):
+        self._fill(size)
+        start = self._position - self._offset
+        data = bytes(self._buffer[start:start + size])
+        self._position += len(data)
+        return data
+
+    def readline(self):
+        index = self.find(b'\n')
+        if index < 0:
+            return self.read(self._offset + len(self._buffer) - self._position)
+        return self.read(index - self._position + 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.stop()
+            self._reader = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
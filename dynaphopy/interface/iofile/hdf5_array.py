@@ -0,0 +1,127 @@
+import numpy as np
+
+
+def map_dataset(file_name, dataset_name, time_slice=slice(None), columns=None, dtype=complex):
+    """
+    Get a read-only array of a HDF5 dataset without loading it in memory.
+    Contiguous (not chunked nor compressed) datasets are memory-mapped directly,
+    otherwise a lazy array that reads only the requested hyperslabs is returned.
+    :param file_name: HDF5 file name
+    :param dataset_name: dataset name
+    :param time_slice: slice of the first (time) axis
+    :param columns: sorted list of indices of the second (atom) axis (None: all)
+    :param dtype: data type of the returned data
+    :return: numpy memmap or HDF5Array
+    """
+    import h5py
+
+    with h5py.File(file_name, 'r') as hdf5_file:
+        dataset = hdf5_file[dataset_name]
+        offset = dataset.id.get_offset()
+        if (columns is None and offset is not None and dataset.chunks is None and
+                dataset.compression is None and dataset.dtype == np.dtype(dtype)):
+            return np.memmap(file_name, mode='r', dtype=dataset.dtype, offset=offset,
+                             shape=dataset.shape)[time_slice]
+
+    return HDF5Array(file_name, dataset_name, time_slice=time_slice, columns=columns, dtype=dtype)
+
+
+class HDF5Array:
+    """
+    Read-only array backed by a HDF5 dataset. Data is read from file on indexing,
+    so only the accessed elements are loaded in memory.
+    """
+
+    def __init__(self, file_name, dataset_name, time_slice=slice(None), columns=None, dtype=complex):
+        import h5py
+
+        self._file = None
+        self._file = h5py.File(file_name, 'r')
+        self._dataset = self._file[dataset_name]
+
+        # Steps of the dataset stored as (start, step, number of steps)
+        start, stop, step = time_slice.indices(self._dataset.shape[0])
+        self._steps = (start, step, _get_slice_length(start, stop, step))
+        if columns is None:
+            self._columns = np.arange(self._dataset.shape[1])
+        else:
+            self._columns = np.array(columns, dtype=int)
+
+        self.dtype = np.dtype(dtype)
+        self.shape = (self._steps[2], len(self._columns)) + self._dataset.shape[2:]
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # Translate time and atom indices to dataset indices (h5py requires increasing indices)
+        steps, reverse = self._get_steps(key[0])
+
+        columns = self._columns[key[1]]
+        if not np.isscalar(columns):
+            if len(columns) > 0 and np.array_equal(columns, np.arange(columns[0], columns[0] + len(columns))):
+                columns = slice(columns[0], columns[0] + len(columns))
+            else:
+                columns = list(columns)
+
+        data = np.asarray(self._dataset[(steps, columns) + key[2:]], dtype=self.dtype)
+        if reverse:
+            data = data[::-1]
+        return data
+
+    def _get_steps(self, key):
+        # Dataset steps of a time index: integer, increasing slice or list (and if it has to be reversed)
+        start, step, length = self._steps
+
+        if isinstance(key, slice):
+            key_start, key_stop, key_step = key.indices(length)
+            key_length = _get_slice_length(key_start, key_stop, key_step)
+            first = start + key_start * step
+            step *= key_step
+            if key_length == 0:
+                return slice(0, 0), False
+            if step < 0:
+                last = first + (key_length - 1) * step
+                return slice(last, first + 1, -step), True
+            return slice(first, first + key_length * step, step), False
+
+        if np.isscalar(key):
+            if not -length <= key < length:
+                raise IndexError('index {0} is out of bounds for axis 0 with size {1}'.format(key, length))
+            return start + (key % length) * step, False
+
+        indices = np.array(key, dtype=int)
+        if np.any(indices >= length) or np.any(indices < -length):
+            raise IndexError('index out of bounds for axis 0 with size {0}'.format(length))
+        return list(start + (indices % length) * step), False
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self[:]
+        return self[:].astype(dtype)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _get_slice_length(start, stop, step):
+    # Number of elements of range(start, stop, step)
+    if step > 0:
+        return max(0, (stop - start + step - 1) // step)
+    return max(0, (start - stop - step - 1) // -step)
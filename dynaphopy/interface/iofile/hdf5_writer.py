@@ -0,0 +1,159 @@
+import os
+import numpy as np
+
+from dynaphopy.interface.iofile import get_hdf5_chunks
+
+
+class HDF5TrajectoryWriter:
+    """
+    Write MD data into a HDF5 file (readable by initialize_from_hdf5_file) while the MD is running.
+    Steps are stored in memory blocks that are appended to resizable chunked datasets when full.
+    The last atomic positions and velocities are stored to allow resuming interrupted runs.
+    """
+
+    def __init__(self, file_name, supercell, number_of_atoms,
+                 number_of_dimensions=3,
+                 time_step=None,
+                 velocity_only=False,
+                 restart=False,
+                 block_size=1000,
+                 compression=None):
+
+        import h5py
+
+        self._block_size = block_size
+        self._block_steps = 0
+        self._velocity_only = velocity_only
+
+        data_shape = (number_of_atoms, number_of_dimensions)
+
+        if restart and os.path.isfile(file_name):
+            self._file = h5py.File(file_name, 'r+')
+            if self._file['velocity'].shape[1:] != data_shape:
+                print('Restart file {} does not match the MD (atoms/dimensions)'.format(file_name))
+                exit()
+            if velocity_only != ('trajectory' not in self._file):
+                print('Restart file {} does not match the velocity_only option'.format(file_name))
+                exit()
+
+            # Steps stored after the last restart state (interrupted flush) are discarded
+            if self.get_number_of_steps() > 0:
+                number_of_steps = -1
+                if 'restart' in self._file:
+                    number_of_steps = self._file['restart'].attrs.get('number_of_steps', -1)
+                if not 0 <= number_of_steps <= self.get_number_of_steps():
+                    print('Restart file {} has no valid restart state'.format(file_name))
+                    exit()
+                for name in ['time', 'energy', 'velocity', 'trajectory']:
+                    if name in self._file:
+                        self._file[name].resize(number_of_steps, axis=0)
+        else:
+            self._file = h5py.File(file_name, 'w')
+            self._file.create_dataset('super_cell', data=supercell)
+            self._file.attrs['time_step'] = time_step
+
+            names = ['velocity'] if velocity_only else ['velocity', 'trajectory']
+            for name in names:
+                dataset = self._file.create_dataset(name,
+                                                    shape=(0,) + data_shape,
+                                                    maxshape=(None,) + data_shape,
+                                                    dtype=float,
+                                                    chunks=get_hdf5_chunks((block_size,) + data_shape, 8),
+                                                    shuffle=compression is not None,
+                                                    compression=compression)
+                dataset.attrs['layout'] = 'chunked'
+                dataset.attrs['compression'] = str(compression)
+                dataset.attrs['real'] = True
+                dataset.attrs['single_precision'] = False
+
+            for name in ['time', 'energy']:
+                self._file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=float,
+                                          chunks=(block_size,))
+
+        # Memory blocks
+        self._time = np.zeros(block_size)
+        self._energy = np.zeros(block_size)
+        self._velocity = np.zeros((block_size,) + data_shape)
+        if velocity_only:
+            self._trajectory = None
+        else:
+            self._trajectory = np.zeros((block_size,) + data_shape)
+
+    def get_number_of_steps(self):
+        # Steps already stored in file
+        return self._file['velocity'].shape[0]
+
+    def get_block(self):
+        """
+        Get the memory arrays where the next step should be written (see step_done)
+        :return: time, energy, velocity and trajectory (None if velocity_only) views
+        """
+        i = self._block_steps
+        trajectory = None if self._trajectory is None else self._trajectory[i]
+        return self._time[i:i+1], self._energy[i:i+1], self._velocity[i], trajectory
+
+    def step_done(self):
+        """
+        Mark the current step in memory block as written
+        :return: True if the memory block is full and has to be flushed
+        """
+        self._block_steps += 1
+        return self._block_steps == self._block_size
+
+    def append(self, time, velocity, trajectory=None, energy=0.0):
+        block_time, block_energy, block_velocity, block_trajectory = self.get_block()
+        block_time[0] = time
+        block_energy[0] = energy
+        block_velocity[:] = velocity
+        if block_trajectory is not None:
+            block_trajectory[:] = trajectory
+        return self.step_done()
+
+    def flush(self, state=None):
+        """
+        Append the steps stored in memory to the file
+        :param state: positions and velocities (MD order) to be used to resume the run
+        """
+        n = self._block_steps
+        if n > 0:
+            position = self.get_number_of_steps()
+            data = [('time', self._time), ('energy', self._energy), ('velocity', self._velocity)]
+            if self._trajectory is not None:
+                data.append(('trajectory', self._trajectory))
+
+            for name, block in data:
+                dataset = self._file[name]
+                dataset.resize(position + n, axis=0)
+                dataset[position:position + n] = block[:n]
+
+            self._block_steps = 0
+
+        if state is not None:
+            # The state is marked as not valid while it is written
+            if 'restart' not in self._file:
+                restart = self._file.create_group('restart')
+                restart.create_dataset('positions', data=state[0])
+                restart.create_dataset('velocity', data=state[1])
+            else:
+                restart = self._file['restart']
+                restart.attrs['number_of_steps'] = -1
+                self._file.flush()
+                restart['positions'][:] = state[0]
+                restart['velocity'][:] = state[1]
+            # Number of steps stored when the state was taken
+            restart.attrs['number_of_steps'] = self.get_number_of_steps()
+
+        self._file.flush()
+
+    def get_state(self):
+        """
+        Get the stored positions and velocities (MD order) to resume the run after the stored steps
+        :return: positions, velocity (None if not available)
+        """
+        if 'restart' not in self._file or self._file['restart'].attrs.get('number_of_steps', -1) < 0:
+            return None
+        return self._file['restart/positions'][:], self._file['restart/velocity'][:]
+
+    def close(self):
+        self.flush()
+        self._file.close()
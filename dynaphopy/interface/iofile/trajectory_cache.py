@@ -0,0 +1,135 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+import dynaphopy.dynamics as dyn
+
+# Dynamics arrays stored in the cache (one .npy file each)
+_cached_arrays = ['trajectory', 'scaled_trajectory', 'velocity', 'energy', 'time', 'supercell', 'atom_indices']
+
+
+def get_cache_directory(file_name):
+    """
+    Sidecar directory where the parsed data of a trajectory file is stored
+    """
+    directory, base_name = os.path.split(os.path.abspath(file_name))
+    return os.path.join(directory, '.' + base_name + '.dynaphopy_cache')
+
+
+def get_source_key(file_name):
+    """
+    Identifies the version of the trajectory file (path, size and modification time)
+    """
+    file_stat = os.stat(file_name)
+    return hashlib.sha1(repr((os.path.abspath(file_name),
+                              file_stat.st_size,
+                              file_stat.st_mtime)).encode()).hexdigest()[:16]
+
+
+def get_cache_key(file_name, trajectory_reading_function, time_step, initial_cut, end_cut, template, **kwargs):
+    """
+    Cache entries are identified by the trajectory file (see get_source_key)
+    and the reading options that change the parsed data.
+    """
+    key = hashlib.sha1()
+    key.update(repr((trajectory_reading_function.__name__,
+                     time_step,
+                     initial_cut,
+                     end_cut,
+                     sorted((name, np.asarray(value).tolist()) for name, value in kwargs.items()))).encode())
+    if template is not None:
+        key.update(np.ascontiguousarray(template, dtype=int).tobytes())
+
+    return get_source_key(file_name) + '_' + key.hexdigest()
+
+
+def remove_stale_entries(cache_directory, source_key):
+    """
+    Remove the cache entries of previous versions of the trajectory file
+    """
+    if not os.path.isdir(cache_directory):
+        return
+
+    for entry in os.listdir(cache_directory):
+        # Temporary directories are entries being written
+        if entry.startswith('tmp') or entry.startswith(source_key + '_'):
+            continue
+        print('Removing outdated trajectory cache ({})'.format(entry))
+        shutil.rmtree(os.path.join(cache_directory, entry), ignore_errors=True)
+
+
+def load_trajectory_cache(cache_entry, structure, memmap=False):
+    arrays = {}
+    for name in _cached_arrays:
+        array_file = os.path.join(cache_entry, name + '.npy')
+        if os.path.isfile(array_file):
+            arrays[name] = np.load(array_file, mmap_mode='r')
+
+    print('Loading trajectory from cache ({})'.format(cache_entry))
+    return dyn.Dynamics(structure=structure, memmap=memmap, **arrays)
+
+
+def save_trajectory_cache(cache_entry, dynamic):
+    arrays = {'trajectory': dynamic._trajectory,
+              'scaled_trajectory': dynamic._scaled_trajectory,
+              'velocity': dynamic._velocity,
+              'energy': dynamic._energy,
+              'time': dynamic._time,
+              'supercell': dynamic._supercell,
+              'atom_indices': dynamic._atom_indices}
+
+    # Write in a temporary directory first so that incomplete entries are never read
+    cache_directory = os.path.dirname(cache_entry)
+    try:
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory)
+        temp_entry = tempfile.mkdtemp(dir=cache_directory)
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(temp_entry, name + '.npy'), np.asarray(array))
+        os.rename(temp_entry, cache_entry)
+    except OSError as error:
+        print('Warning! Trajectory cache could not be written: {}'.format(error))
+        if 'temp_entry' in locals():
+            shutil.rmtree(temp_entry, ignore_errors=True)
+
+
+def cached_trajectory_parser(trajectory_reading_function):
+    """
+    Wrap a trajectory parser to store the parsed data in a binary sidecar cache next to the
+    trajectory file. Later readings with the same options memory-map the cached arrays
+    instead of parsing the text file again.
+    :param trajectory_reading_function: trajectory parser (see trajectory_parsers)
+    :return: parser function with the same arguments
+    """
+
+    def read_trajectory(file_name, structure=None, time_step=None,
+                        initial_cut=1,
+                        end_cut=None,
+                        memmap=False,
+                        template=None,
+                        **kwargs):
+
+        cache_directory = get_cache_directory(file_name)
+        remove_stale_entries(cache_directory, get_source_key(file_name))
+
+        cache_entry = os.path.join(cache_directory,
+                                   get_cache_key(file_name, trajectory_reading_function,
+                                                 time_step, initial_cut, end_cut, template, **kwargs))
+
+        if os.path.isdir(cache_entry):
+            return load_trajectory_cache(cache_entry, structure, memmap=memmap)
+
+        dynamic = trajectory_reading_function(file_name, structure, time_step,
+                                              initial_cut=initial_cut,
+                                              end_cut=end_cut,
+                                              memmap=memmap,
+                                              template=template,
+                                              **kwargs)
+        save_trajectory_cache(cache_entry, dynamic)
+        return dynamic
+
+    read_trajectory.__name__ = trajectory_reading_function.__name__
+    return read_trajectory
@@ -1,10 +1,26 @@
 import os
 import numpy as np
-import mmap
 import dynaphopy.dynamics as dyn
+from dynaphopy.interface.iofile.file_map import open_file_map
+from dynaphopy.interface.iofile import get_atom_selection
 import warnings
 
 
+def _get_reading_rows(structure, number_of_atoms, template=None, atoms=None, atom_types=None):
+    # Rows of the MD file to decode (in dynaphopy order) and the selected supercell atom indices
+    atom_indices = get_atom_selection(structure, number_of_atoms, atoms=atoms, atom_types=atom_types)
+
+    if template is not None:
+        rows = np.argsort(template)
+    else:
+        rows = np.arange(number_of_atoms)
+
+    if atom_indices is not None:
+        rows = rows[atom_indices]
+
+    return rows, atom_indices
+
+
 # VASP OUTCAR file parser
 def read_vasp_trajectory(file_name, structure=None, time_step=None,
                          limit_number_steps=10000000,  # Maximum number of steps read (for security)
@@ -12,7 +28,9 @@ def read_vasp_trajectory(file_name, structure=None, time_step=None,
                          initial_cut=1,
                          end_cut=None,
                          memmap=False,
-                         template=None):
+                         template=None,
+                         atoms=None,
+                         atom_types=None):
 
     # warning
     warnings.warn('This parser will be deprecated, you can use XDATCAR instead', DeprecationWarning)
@@ -36,10 +54,9 @@ def read_vasp_trajectory(file_name, structure=None, time_step=None,
     # Dimensionality of VASP calculation
     number_of_dimensions = 3
 
-    with open(file_name, "r+") as f:
+    # Memory-map the file (or stream it if compressed)
+    with open_file_map(file_name) as file_map:
 
-        #Memory-map the file
-        file_map = mmap.mmap(f.fileno(), 0)
         position_number=file_map.find(b'NIONS =')
         file_map.seek(position_number+7)
         number_of_atoms = int(file_map.readline())
@@ -67,6 +84,9 @@ def read_vasp_trajectory(file_name, structure=None, time_step=None,
                 print('Warning: Number of atoms not matching, check VASP output files')
     #        structure.set_number_of_atoms(number_of_atoms)
 
+        rows, atom_indices = _get_reading_rows(structure, number_of_atoms, template=template,
+                                               atoms=atoms, atom_types=atom_types)
+
 #       Read coordinates and energy
         trajectory = []
         energy = []
@@ -85,14 +105,9 @@ def read_vasp_trajectory(file_name, structure=None, time_step=None,
             file_map.readline()
             file_map.readline()
 
-            read_coordinates = []
-            for i in range (number_of_atoms):
-                read_coordinates.append(file_map.readline().split()[0:number_of_dimensions])
-
-            read_coordinates = np.array(read_coordinates, dtype=float) # in angstrom
-            if template is not None:
-                indexing = np.argsort(template)
-                read_coordinates = read_coordinates[indexing, :]
+            lines = [file_map.readline() for i in range(number_of_atoms)]
+            read_coordinates = np.array([lines[i].split()[0:number_of_dimensions] for i in rows],
+                                        dtype=float) # in angstrom
 
             position_number=file_map.find(b'energy(')
             file_map.seek(position_number)
@@ -112,7 +127,7 @@ def read_vasp_trajectory(file_name, structure=None, time_step=None,
 
         trajectory = np.array([[[trajectory[i][j*number_of_dimensions+k]
                                  for k in range(number_of_dimensions)]
-                                for j in range(number_of_atoms)]
+                                for j in range(len(rows))]
                                for i in range (len(trajectory))])
 
         if last_steps is not None:
@@ -128,7 +143,8 @@ def read_vasp_trajectory(file_name, structure=None, time_step=None,
                             energy=np.array(energy),
                             time=time,
                             supercell=super_cell,
-                            memmap=memmap)
+                            memmap=memmap,
+                            atom_indices=atom_indices)
 
 
 # LAMMPS custom dump file parser
@@ -138,7 +154,9 @@ def read_lammps_trajectory(file_name, structure=None, time_step=None,
                            initial_cut=1,
                            end_cut=None,
                            memmap=False,
-                           template=None):
+                           template=None,
+                           atoms=None,
+                           atom_types=None):
 
 
     # Time in picoseconds
@@ -185,9 +203,7 @@ def read_lammps_trajectory(file_name, structure=None, time_step=None,
 
     lammps_labels = False
 
-    with open(file_name, "r+") as f:
-
-        file_map = mmap.mmap(f.fileno(), 0)
+    with open_file_map(file_name) as file_map:
 
         while True:
 
@@ -204,7 +220,7 @@ def read_lammps_trajectory(file_name, structure=None, time_step=None,
 
             if number_of_atoms is None:
                 #Read number of atoms
-                file_map = mmap.mmap(f.fileno(), 0)
+                file_map.seek(0)
                 position_number=file_map.find(b'NUMBER OF ATOMS')
                 file_map.seek(position_number)
                 file_map.readline()
@@ -215,9 +231,12 @@ def read_lammps_trajectory(file_name, structure=None, time_step=None,
                     if number_of_atoms % structure.get_number_of_cell_atoms() != 0:
                         print('Warning: Number of atoms not matching, check LAMMPS output file')
 
+                rows, atom_indices = _get_reading_rows(structure, number_of_atoms, template=template,
+                                                       atoms=atoms, atom_types=atom_types)
+
             if bounds is None:
                 #Read cell
-                file_map = mmap.mmap(f.fileno(), 0)
+                file_map.seek(0)
                 position_number=file_map.find(b'BOX BOUNDS')
                 file_map.seek(position_number)
                 file_map.readline()
@@ -264,7 +283,7 @@ def read_lammps_trajectory(file_name, structure=None, time_step=None,
                 # End testing cell
                 if memmap:
                     if end_cut:
-                        data = np.memmap(temp_directory+'trajectory.{0}'.format(os.getpid()), dtype='complex', mode='w+', shape=(end_cut - initial_cut+1, number_of_atoms, number_of_dimensions))
+                        data = np.memmap(temp_directory+'trajectory.{0}'.format(os.getpid()), dtype='complex', mode='w+', shape=(end_cut - initial_cut+1, len(rows), number_of_dimensions))
                     else:
                         print('Memory mapping requires to define reading range (use read_from/read_to option)')
                         exit()
@@ -280,14 +299,9 @@ def read_lammps_trajectory(file_name, structure=None, time_step=None,
                 continue
 
             #Reading coordinates
-            read_coordinates = []
-            for i in range (number_of_atoms):
-                read_coordinates.append(file_map.readline().split()[0:number_of_dimensions])
-            read_coordinates = np.array(read_coordinates, dtype=float)
-
-            if template is not None:
-                indexing = np.argsort(template)
-                read_coordinates = read_coordinates[indexing, :]
+            lines = [file_map.readline() for i in range(number_of_atoms)]
+            read_coordinates = np.array([lines[i].split()[0:number_of_dimensions] for i in rows],
+                                        dtype=float)
 
             try:
                 if memmap:
@@ -326,14 +340,16 @@ def read_lammps_trajectory(file_name, structure=None, time_step=None,
                             velocity=data,
                             time=time,
                             supercell=supercell,
-                            memmap=memmap)
+                            memmap=memmap,
+                            atom_indices=atom_indices)
 
     if b'x y' in lammps_labels:
         return dyn.Dynamics(structure=structure,
                             trajectory=data,
                             time=time,
                             supercell=supercell,
-                            memmap=memmap)
+                            memmap=memmap,
+                            atom_indices=atom_indices)
 
     print('LAMMPS parsing error. Data not recognized: {}'.format(lammps_labels))
     exit()
@@ -345,7 +361,9 @@ def read_VASP_XDATCAR(file_name, structure=None, time_step=None,
                       initial_cut=1,
                       end_cut=None,
                       memmap=False,
-                      template=None):
+                      template=None,
+                      atoms=None,
+                      atom_types=None):
 
     # Time in picoseconds
     # Coordinates in Angstroms
@@ -386,9 +404,7 @@ def read_VASP_XDATCAR(file_name, structure=None, time_step=None,
     data = []
     counter = 0
 
-    with open(file_name, "r+b") as f:
-
-        file_map = mmap.mmap(f.fileno(), 0)
+    with open_file_map(file_name) as file_map:
 
         #Read cell
         for i in range(2): file_map.readline()
@@ -400,6 +416,9 @@ def read_VASP_XDATCAR(file_name, structure=None, time_step=None,
         for i in range(1): file_map.readline()
         number_of_atoms = np.array(file_map.readline().split(), dtype=int).sum()
 
+        rows, atom_indices = _get_reading_rows(structure, number_of_atoms, template=template,
+                                               atoms=atoms, atom_types=atom_types)
+
         while True:
 
             counter += 1
@@ -412,7 +431,7 @@ def read_VASP_XDATCAR(file_name, structure=None, time_step=None,
 
             if memmap:
                 if end_cut:
-                    data = np.memmap(temp_directory+'trajectory.{0}'.format(os.getpid()), dtype='complex', mode='w+', shape=(end_cut - initial_cut+1, number_of_atoms, number_of_dimensions))
+                    data = np.memmap(temp_directory+'trajectory.{0}'.format(os.getpid()), dtype='complex', mode='w+', shape=(end_cut - initial_cut+1, len(rows), number_of_dimensions))
                 else:
                     print('Memory mapping requires to define reading range (use read_from/read_to option)')
                     exit()
@@ -423,14 +442,9 @@ def read_VASP_XDATCAR(file_name, structure=None, time_step=None,
                 continue
 
             #Reading coordinates
-            read_coordinates = []
-            for i in range (number_of_atoms):
-                read_coordinates.append(file_map.readline().split()[0:number_of_dimensions])
-
-            read_coordinates = np.array(read_coordinates, dtype=float)  # in angstroms
-            if template is not None:
-                indexing = np.argsort(template)
-                read_coordinates = read_coordinates[indexing, :]
+            lines = [file_map.readline() for i in range(number_of_atoms)]
+            read_coordinates = np.array([lines[i].split()[0:number_of_dimensions] for i in rows],
+                                        dtype=float)  # in angstroms
 
             try:
                 if memmap:
@@ -467,7 +481,8 @@ def read_VASP_XDATCAR(file_name, structure=None, time_step=None,
                         scaled_trajectory=data,
                         time=time,
                         supercell=super_cell,
-                        memmap=memmap)
+                        memmap=memmap,
+                        atom_indices=atom_indices)
 
 
 if __name__ == "__main__":
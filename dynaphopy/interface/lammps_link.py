@@ -3,8 +3,7 @@
 import dynaphopy.dynamics as dyn
 import numpy as np
 from dynaphopy.power_spectrum import _progress_bar
-from lammps import lammps
-from dynaphopy.interface.iofile import get_correct_arrangement
+from dynaphopy.interface.iofile import get_correct_arrangement, initialize_from_hdf5_file
 
 
 def generate_lammps_trajectory(structure,
@@ -19,7 +18,38 @@ def generate_lammps_trajectory(structure,
                                lammps_log=True,
                                temperature=None,
                                thermostat_mass=0.5,
-                               sampling_interval=1):  # in timesteps
+                               sampling_interval=1,  # in timesteps
+                               output_file=None,
+                               restart=False,
+                               block_size=1000,
+                               in_situ=None,
+                               convergence_tolerance=None,
+                               convergence_window=3,
+                               seed=None):
+    """
+    Run a LAMMPS MD and get the trajectory
+    If output_file is defined, steps are written in a HDF5 file by blocks of block_size steps while
+    running (memory usage does not grow with the run length) and the returned Dynamics reads from this file.
+    If restart is True and output_file exists, the run is resumed from the last block stored
+    (steps stored after the last restart state are discarded, files without restart state are not resumed).
+    (Thermostat internal variables are not restored)
+    If in_situ (InSituAnalysis) is defined, the velocities are projected and accumulated by blocks of
+    block_size steps while running and no trajectory is stored. The in_situ object is returned.
+    If convergence_tolerance (THz) is defined, the in-situ power spectra are fitted after each block and
+    the run is stopped when peak positions and widths change less than the tolerance in
+    convergence_window consecutive blocks (and all the peaks are fitted in these blocks).
+    If seed is defined, initial velocities are always created with this random seed.
+    """
+
+    if in_situ is not None and output_file is not None:
+        print('In-situ analysis cannot be combined with output file')
+        exit()
+
+    if convergence_tolerance is not None and in_situ is None:
+        print('Convergence check requires in-situ analysis')
+        exit()
+
+    from lammps import lammps
 
     cmdargs_lammps = ['-echo','none', '-screen', 'none']
     if not lammps_log:
@@ -44,10 +74,10 @@ def generate_lammps_trajectory(structure,
         exit()
 
     # Check if initial velocities all zero
-    if not np.array(lmp.gather_atoms("v", 1, 3)).any():
+    if seed is not None or not np.ctypeslib.as_array(lmp.gather_atoms("v", 1, 3)).any():
         print('Set lammps initial velocities')
         t = temperature if temperature is not None else 100
-        lmp.command('velocity        all create {} 3627941 dist gaussian mom yes'.format(t))
+        lmp.command('velocity        all create {} {} dist gaussian mom yes'.format(t, seed if seed is not None else 3627941))
         lmp.command('velocity        all scale {}'.format(t))
 
     lmp.command('run 0')
@@ -73,49 +103,111 @@ def generate_lammps_trajectory(structure,
                            [0,  yhi-ylo,  yz],
                            [0,   0,  zhi-zlo]]).T
 
-    positions = []
-    velocity = []
-    energy = []
-
     na = lmp.get_natoms()
-    xc = lmp.gather_atoms("x", 1, 3)
-    reference = np.array([xc[i] for i in range(na*3)]).reshape((na,3))
+    reference = _gather_array(lmp, "x", na)
     template = get_correct_arrangement(reference, structure)
     indexing = np.argsort(template)
 
-    lmp.command('variable energy equal pe'.format(int(relaxation_time/time_step)))
-    lmp.command('run {}'.format(int(relaxation_time/time_step)))
+    supercell_matrix = dyn.Dynamics(structure=structure, supercell=simulation_cell).get_supercell_matrix()
 
-    if not silent:
-        _progress_bar(0, 'lammps')
+    if in_situ is not None:
+        in_situ.initialize(supercell_matrix, time_step * sampling_interval)
+
+    # Write steps in file while running
+    writer = None
+    completed_loops = 0
+    if output_file is not None:
+        from dynaphopy.interface.iofile.hdf5_writer import HDF5TrajectoryWriter
+        writer = HDF5TrajectoryWriter(output_file, supercell_matrix, na,
+                                      time_step=time_step * sampling_interval,
+                                      velocity_only=velocity_only,
+                                      restart=restart,
+                                      block_size=block_size)
+        completed_loops = writer.get_number_of_steps()
+
+    state = None if writer is None or completed_loops == 0 else writer.get_state()
+    if state is not None:
+        print('Resume LAMMPS run from step {}'.format(completed_loops))
+        lmp.scatter_atoms("x", 1, 3, np.ctypeslib.as_ctypes(np.ascontiguousarray(state[0], dtype=float).flatten()))
+        lmp.scatter_atoms("v", 1, 3, np.ctypeslib.as_ctypes(np.ascontiguousarray(state[1], dtype=float).flatten()))
+        lmp.command('run 0')
+    else:
+        completed_loops = 0
+        lmp.command('run {}'.format(int(relaxation_time/time_step)))
 
     n_loops = int(total_time / time_step / sampling_interval)
-    for i in range(n_loops):
-        if not silent:
-            _progress_bar(float((i+1) * time_step * sampling_interval) / total_time, 'lammps', )
 
-        lmp.command('run {}'.format(sampling_interval))
+    # Preallocated arrays (if not written in file)
+    if writer is None:
+        energy = np.zeros(n_loops)
+        if in_situ is not None:
+            positions = None
+            velocity = np.zeros((min(block_size, n_loops), na, 3))
+        else:
+            positions = None if velocity_only else np.zeros((n_loops, na, 3), dtype=complex)
+            velocity = np.zeros((n_loops, na, 3), dtype=complex)
 
-        xc = lmp.gather_atoms("x", 1, 3)
-        vc = lmp.gather_atoms("v", 1, 3)
-        energy.append(lmp.extract_variable('energy', 'all', 0))
+    # Frames are collected by a fix external callback, so LAMMPS runs uninterrupted
+    # (one run per block of samples, only one run if the whole MD is kept in memory)
+    if writer is not None:
+        sampler = _Sampler(lmp, na, indexing, time_step, writer=writer, sampling_interval=sampling_interval)
+        run_block_size = block_size
+    elif in_situ is not None:
+        sampler = _Sampler(lmp, na, indexing, time_step, energy=energy, velocity=velocity, block_buffer=True)
+        run_block_size = len(velocity)
+    else:
+        sampler = _Sampler(lmp, na, indexing, time_step, energy=energy, velocity=velocity, positions=positions)
+        run_block_size = n_loops
 
-        velocity.append(np.array([vc[i] for i in range(na * 3)]).reshape((na, 3))[indexing, :])
+    # fix ave/time requests the potential energy tally at sampled steps (thermo output is left untouched)
+    lmp.command('compute dynaphopy_pe all pe')
+    lmp.command('fix dynaphopy_energy all ave/time {0} 1 {0} c_dynaphopy_pe'.format(sampling_interval))
+    lmp.command('fix dynaphopy_sampler all external pf/callback {} 1'.format(sampling_interval))
+    lmp.set_fix_external_callback('dynaphopy_sampler', sampler, lmp)
 
-        if not velocity_only:
-            positions.append(np.array([xc[i] for i in range(na * 3)]).reshape((na, 3))[indexing, :])
+    if not silent:
+        _progress_bar(0, 'lammps')
+
+    i = completed_loops
+    setup = 'yes'
+    while i < n_loops:
+        block_steps = min(run_block_size, n_loops - i)
+        sampler.set_block(i, block_steps)
+        lmp.command('run {} pre {} post no'.format(block_steps * sampling_interval, setup))
+        setup = 'no'
+        i += block_steps
+
+        if not silent:
+            _progress_bar(float(i * time_step * sampling_interval) / total_time, 'lammps', )
 
-    positions = np.array(positions, dtype=complex)
-    velocity = np.array(velocity, dtype=complex)
-    energy = np.array(energy)
+        if writer is not None:
+            writer.flush(state=(_gather_array(lmp, "x", na), _gather_array(lmp, "v", na)))
 
-    if velocity_only:
-        positions = None
+        if in_situ is not None:
+            in_situ.add_block(velocity[:block_steps])
 
+            if convergence_tolerance is not None and in_situ.check_convergence(convergence_tolerance,
+                                                                               window=convergence_window):
+                if not silent:
+                    _progress_bar(1.0, 'lammps')
+                print('Phonon peaks converged at {} ps'.format(i * time_step * sampling_interval))
+                break
+
+    lmp.command('unfix dynaphopy_sampler')
+    lmp.command('unfix dynaphopy_energy')
+    lmp.command('uncompute dynaphopy_pe')
     lmp.close()
 
-    time = np.array([i * time_step * sampling_interval for i in range(n_loops)], dtype=float)
+    if in_situ is not None:
+        return in_situ
+
+    if writer is not None:
+        writer.close()
+        return initialize_from_hdf5_file(output_file, structure,
+                                         read_trajectory=not velocity_only,
+                                         memmap=memmap)
 
+    time = np.arange(n_loops) * time_step * sampling_interval
 
     return dyn.Dynamics(structure=structure,
                         trajectory=positions,
@@ -126,6 +218,138 @@ def generate_lammps_trajectory(structure,
                         memmap=memmap)
 
 
+def generate_lammps_ensemble(structure,
+                             input_file,
+                             in_situ,
+                             number_of_replicas=4,
+                             processes=None,
+                             seeds=None,
+                             **kwargs):
+    """
+    Run independent LAMMPS replicas (different initial velocities) in parallel with in-situ analysis
+    :param structure: Structure object
+    :param input_file: LAMMPS input file
+    :param in_situ: InSituAnalysis object used as template for all the replicas
+    :param number_of_replicas: number of independent MD runs
+    :param processes: number of parallel processes (default: number of CPUs)
+    :param seeds: list of velocity seeds (one per replica)
+    :param kwargs: generate_lammps_trajectory arguments
+    :return: list of InSituAnalysis objects (one per replica, see average_power_spectra)
+    """
+    from multiprocessing import Pool
+
+    if seeds is None:
+        seeds = np.random.RandomState(3627941).randint(1, 900000000, size=number_of_replicas)
+
+    if len(seeds) != number_of_replicas:
+        print('Number of seeds should be equal to the number of replicas')
+        exit()
+
+    kwargs.update({'silent': True, 'lammps_log': False})
+    replicas = [(structure, input_file, in_situ, int(seed), kwargs) for seed in seeds]
+
+    pool = Pool(processes=processes)
+    try:
+        results = pool.map(_run_replica, replicas)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def _run_replica(replica):
+    structure, input_file, in_situ, seed, kwargs = replica
+    return generate_lammps_trajectory(structure, input_file, in_situ=in_situ, seed=seed, **kwargs)
+
+
+class _Sampler:
+    """
+    fix external callback that stores the sampled frames (dynaphopy atom order) in the preallocated arrays
+    (memory arrays, the HDF5 writer memory block or the in-situ block buffer)
+    Callback is called after the forces are computed, when velocities are still half a time step behind
+    positions. The last half step (velocity Verlet) is added from the current forces so that the stored
+    velocities are those at the end of the step (velocity rescaling by thermostats in this half step,
+    e.g. fix nvt, is not included).
+    """
+
+    def __init__(self, lmp, number_of_atoms, indexing, md_time_step,
+                 energy=None,
+                 velocity=None,
+                 positions=None,
+                 writer=None,
+                 sampling_interval=1,
+                 block_buffer=False):
+        self._lmp = lmp
+        self._number_of_atoms = number_of_atoms
+        self._indexing = indexing
+        self._energy = energy
+        self._velocity = velocity
+        self._positions = positions
+        self._writer = writer
+        self._time_step = md_time_step * sampling_interval
+        self._block_buffer = block_buffer  # velocity only holds the current block
+
+        # Half step velocity increment per unit of force (dynaphopy atom order)
+        if lmp.extract_atom("rmass", 2) is not None:
+            # Per-atom masses (atom styles with rmass)
+            masses = np.array(np.ctypeslib.as_array(lmp.gather_atoms("rmass", 1, 1)))[indexing]
+        else:
+            types = np.ctypeslib.as_array(lmp.gather_atoms("type", 0, 1))
+            type_masses = lmp.extract_atom("mass", 2)
+            if type_masses is None:
+                print('Atom masses are not defined in LAMMPS')
+                exit()
+            masses = np.array([type_masses[t] for t in types])[indexing]
+        self._half_kick = (0.5 * md_time_step * lmp.extract_global("ftm2v", 1) / masses)[:, None]
+
+        self._first_sample = 0
+        self._block_steps = 0
+        self._sampled_steps = 0
+        self._last_timestep = None
+
+    def set_block(self, first_sample, block_steps):
+        self._first_sample = first_sample
+        self._block_steps = block_steps
+        self._sampled_steps = 0
+        self._last_timestep = self._lmp.extract_global("ntimestep", 0)
+
+    def __call__(self, caller, ntimestep, nlocal, tag, x, fext):
+        fext[:] = 0.0
+
+        # Skip the call done during the setup of the run
+        if ntimestep <= self._last_timestep or self._sampled_steps == self._block_steps:
+            return
+
+        i = self._first_sample + self._sampled_steps
+        if self._writer is not None:
+            step_time, step_energy, step_velocity, step_positions = self._writer.get_block()
+            step_time[0] = i * self._time_step
+        elif self._block_buffer:
+            step_energy = self._energy[i:i+1]
+            step_velocity = self._velocity[self._sampled_steps]
+            step_positions = None
+        else:
+            step_energy = self._energy[i:i+1]
+            step_velocity = self._velocity[i]
+            step_positions = None if self._positions is None else self._positions[i]
+
+        step_energy[0] = self._lmp.extract_compute('dynaphopy_pe', 0, 0)
+        step_velocity[:] = (_gather_array(self._lmp, "v", self._number_of_atoms)[self._indexing] +
+                            self._half_kick * _gather_array(self._lmp, "f", self._number_of_atoms)[self._indexing])
+        if step_positions is not None:
+            step_positions[:] = _gather_array(self._lmp, "x", self._number_of_atoms)[self._indexing]
+
+        if self._writer is not None:
+            self._writer.step_done()
+        self._sampled_steps += 1
+
+
+def _gather_array(lmp, name, number_of_atoms):
+    # Numpy view of the data gathered by LAMMPS (no element by element copy)
+    return np.ctypeslib.as_array(lmp.gather_atoms(name, 1, 3)).reshape((number_of_atoms, 3))
+
+
 if __name__ == '__main__':
 
     structure = None
@@ -1,4 +1,8 @@
+import os
+import copy
+import hashlib
 import numpy as np
+from collections import OrderedDict
 from phonopy.api_phonopy import Phonopy
 from phonopy.file_IO import parse_BORN, parse_FORCE_SETS, write_FORCE_CONSTANTS, parse_FORCE_CONSTANTS
 from phonopy.harmonic.dynmat_to_fc import DynmatToForceConstants
@@ -12,14 +16,35 @@ except ImportError:
     from phonopy.structure.atoms import Atoms as PhonopyAtoms
 
 
+# Cache of Phonopy objects (see get_phonon)
+_phonon_cache = OrderedDict()
+_phonon_cache_size = 8
+
+# Cache of q-point symmetry operations (see _get_q_point_operations)
+_symmetry_cache = {}
+
+# Cache of phonon DOS (see obtain_phonopy_dos). Optionally also stored on disk
+_dos_cache = OrderedDict()
+_dos_cache_size = 32
+_dos_cache_directory = None
+_dos_cache_directory_size = 256
+
+
 class ForceConstants:
     def __init__(self, force_constants, supercell=None):
         self._force_constants = np.array(force_constants)
         self._supercell = supercell
+        self._hash = None
 
     def get_array(self):
         return self._force_constants
 
+    def get_hash(self):
+        # Computed once (force constants array should not be modified after it is used)
+        if self._hash is None:
+            self._hash = hashlib.sha1(np.ascontiguousarray(self._force_constants)).hexdigest()
+        return self._hash
+
     def get_supercell(self):
         return self._supercell
 
@@ -78,13 +103,76 @@ def save_force_constants_to_file(force_constants, filename='FORCE_CONSTANTS'):
     write_FORCE_CONSTANTS(force_constants.get_array(), filename=filename)
 
 
-def get_phonon(structure, NAC=False, setup_forces=True, custom_supercell=None):
+def clear_phonon_cache():
+    _phonon_cache.clear()
+    _symmetry_cache.clear()
+    _dos_cache.clear()
+
+
+def set_dos_cache_directory(directory=None, size=256):
+    """
+    Store the phonon DOS calculated by obtain_phonopy_dos on disk, so they are computed only once
+    for each harmonic model and mesh (also in different runs)
+    :param directory: cache directory (default: ~/.dynaphopy_cache/dos)
+    :param size: maximum number of DOS files kept (least recently used ones are removed)
+    """
+    global _dos_cache_directory, _dos_cache_directory_size
+
+    if directory is None:
+        directory = os.path.join(os.path.expanduser('~'), '.dynaphopy_cache', 'dos')
+    _dos_cache_directory = directory
+    _dos_cache_directory_size = size
+
+
+def _get_phonon_key(structure, super_cell_phonon, force_constants, NAC):
+    # Structure, supercell, force constants and NAC define the harmonic model
+    key = [tuple(structure.get_atomic_elements()),
+           np.array(structure.get_cell(), dtype=float).tobytes(),
+           np.array(structure.get_scaled_positions(), dtype=float).tobytes(),
+           np.array(structure.get_primitive_matrix(), dtype=float).tobytes(),
+           np.array(super_cell_phonon, dtype=float).tobytes(),
+           None if force_constants is None else force_constants.get_hash(),
+           NAC]
+
+    # BORN file is read from the working directory (see get_phonon)
+    born_file = os.path.abspath('BORN')
+    if NAC and os.path.isfile(born_file):
+        key += [born_file, os.path.getmtime(born_file), os.path.getsize(born_file)]
+
+    return tuple(key)
+
+
+def get_phonon(structure, NAC=False, setup_forces=True, custom_supercell=None, force_constants=None):
+    """
+    Get the Phonopy object of the harmonic model. Objects are cached by structure, supercell,
+    force constants and NAC (and BORN file), and a copy of the cached object is returned.
+    :param structure: Structure object
+    :param NAC: use non analytical corrections (BORN file)
+    :param setup_forces: set the structure force constants (or force sets)
+    :param custom_supercell: force constants supercell (default: structure phonon supercell)
+    :param force_constants: ForceConstants object used instead of the structure ones
+    :return: Phonopy object
+    """
 
     if custom_supercell is None:
         super_cell_phonon = structure.get_supercell_phonon()
     else:
         super_cell_phonon = custom_supercell
 
+    if force_constants is None and setup_forces:
+        if structure.get_force_constants() is not None:
+            force_constants = structure.get_force_constants()
+        elif structure.get_force_sets() is None:
+            print('No force sets/constants available!')
+            exit()
+
+    key = None
+    if force_constants is not None or not setup_forces:
+        key = _get_phonon_key(structure, super_cell_phonon, force_constants, NAC)
+        if key in _phonon_cache:
+            _phonon_cache[key] = _phonon_cache.pop(key)  # most recently used
+            return copy.deepcopy(_phonon_cache[key])
+
     # Preparing the bulk type object
     bulk = PhonopyAtoms(symbols=structure.get_atomic_elements(),
                         scaled_positions=structure.get_scaled_positions(),
@@ -96,25 +184,27 @@ def get_phonon(structure, NAC=False, setup_forces=True, custom_supercell=None):
 
     # Non Analytical Corrections (NAC) from Phonopy [Frequencies only, eigenvectors no affected by this option]
 
-    if setup_forces:
-        if structure.get_force_constants() is not None:
-            phonon.set_force_constants(structure.get_force_constants().get_array())
-        elif structure.get_force_sets() is not None:
-            phonon.set_displacement_dataset(structure.get_force_sets().get_dict())
-            phonon.produce_force_constants()
-            structure.set_force_constants(ForceConstants(phonon.get_force_constants(),
-                                                         supercell=structure.get_force_sets().get_supercell()))
-        else:
-            print('No force sets/constants available!')
-            exit()
+    if force_constants is not None:
+        phonon.set_force_constants(force_constants.get_array())
+    elif setup_forces:
+        phonon.set_displacement_dataset(structure.get_force_sets().get_dict())
+        phonon.produce_force_constants()
+        structure.set_force_constants(ForceConstants(phonon.get_force_constants(),
+                                                     supercell=structure.get_force_sets().get_supercell()))
+        key = _get_phonon_key(structure, super_cell_phonon, structure.get_force_constants(), NAC)
 
     if NAC:
         print("Warning: Using Non Analytical Corrections")
         primitive = phonon.get_primitive()
-        nac_params = parse_BORN(primitive, is_symmetry=True)
+        nac_params = parse_BORN(primitive, is_symmetry=True, filename=os.path.abspath('BORN'))
         phonon.set_nac_params(nac_params=nac_params)
 
-    return phonon
+    _phonon_cache[key] = phonon
+    while len(_phonon_cache) > _phonon_cache_size:
+        _phonon_cache.popitem(last=False)
+
+    # Callers change the object state (mesh, bands, ...), the cached one is kept untouched
+    return copy.deepcopy(phonon)
 
 
 def obtain_eigenvectors_and_frequencies(structure, q_vector, test_orthonormal=False, print_data=True):
@@ -135,13 +225,7 @@ def obtain_eigenvectors_and_frequencies(structure, q_vector, test_orthonormal=Fa
         np.set_printoptions(suppress=False)
 
     #Arranging eigenvectors by atoms and dimensions
-    number_of_dimensions = structure.get_number_of_dimensions()
-    number_of_primitive_atoms = structure.get_number_of_primitive_atoms()
-
-    arranged_ev = np.array([[[eigenvectors [j*number_of_dimensions+k, i]
-                                    for k in range(number_of_dimensions)]
-                                    for j in range(number_of_primitive_atoms)]
-                                    for i in range(number_of_primitive_atoms*number_of_dimensions)])
+    arranged_ev = _arrange_eigenvectors(structure, eigenvectors[None])[0]
 
     if print_data:
         print("Harmonic frequencies (THz):")
@@ -150,42 +234,182 @@ def obtain_eigenvectors_and_frequencies(structure, q_vector, test_orthonormal=Fa
     return arranged_ev, frequencies
 
 
+def obtain_eigenvectors_and_frequencies_batch(structure, q_vectors, force_constants=None, print_data=True):
+    """
+    Get eigenvectors and frequencies of a list of q-points solved in one phonopy call
+    :param structure: Structure object
+    :param q_vectors: list of q-points in reduced coordinates
+    :param force_constants: ForceConstants object (default: structure force constants)
+    :return: eigenvectors array [q-point, mode, atom, dimension], frequencies array [q-point, mode]
+    """
+
+    if force_constants is None:
+        phonon = get_phonon(structure)
+    else:
+        phonon = get_phonon(structure, custom_supercell=force_constants.get_supercell(),
+                            force_constants=force_constants)
+
+    q_vectors = np.array(q_vectors, dtype=float).reshape((-1, 3))
+
+    # support old phonopy versions
+    try:
+        phonon.run_qpoints(q_vectors, with_eigenvectors=True)
+        qpoints_dict = phonon.get_qpoints_dict()
+        frequencies, eigenvectors = qpoints_dict['frequencies'], qpoints_dict['eigenvectors']
+    except AttributeError:
+        phonon.set_qpoints_phonon(q_vectors, is_eigenvectors=True)
+        frequencies, eigenvectors = phonon.get_qpoints_phonon()
+
+    if print_data:
+        print("Harmonic frequencies (THz):")
+        for q_vector, q_frequencies in zip(q_vectors, frequencies):
+            print('{0}: {1}'.format(q_vector, q_frequencies))
+
+    return _arrange_eigenvectors(structure, np.array(eigenvectors)), np.array(frequencies)
+
+
+def _arrange_eigenvectors(structure, eigenvectors):
+    # Phonopy eigenvectors (columns) [q-point, atom*dimension, mode] to [q-point, mode, atom, dimension]
+    number_of_dimensions = structure.get_number_of_dimensions()
+    number_of_primitive_atoms = structure.get_number_of_primitive_atoms()
+
+    return eigenvectors.transpose((0, 2, 1)).reshape((eigenvectors.shape[0], eigenvectors.shape[2],
+                                                      number_of_primitive_atoms, number_of_dimensions))
+
+
+def _get_dos_key(phonon, force_constants, mesh, freq_min, freq_max, partial):
+    # The DOS is defined by the force constants (hash computed once per object), the supercell,
+    # the primitive cell, NAC and the mesh options
+    primitive = phonon.get_primitive()
+
+    key = hashlib.sha1()
+    key.update(force_constants.get_hash().encode())
+    key.update(np.array(phonon.get_supercell_matrix(), dtype=float).tobytes())
+    key.update(np.array(primitive.get_cell(), dtype=float).tobytes())
+    key.update(np.array(primitive.get_scaled_positions(), dtype=float).tobytes())
+    key.update(np.array(primitive.get_masses(), dtype=float).tobytes())
+
+    nac_params = phonon.get_nac_params()
+    if nac_params is not None:
+        key.update(np.array(nac_params['born'], dtype=float).tobytes())
+        key.update(np.array(nac_params['dielectric'], dtype=float).tobytes())
+
+    key.update(repr((tuple(np.array(mesh, dtype=int).tolist()), freq_min, freq_max, partial)).encode())
+
+    return key.hexdigest()
+
+
+def _load_dos(key):
+    if key in _dos_cache:
+        _dos_cache[key] = _dos_cache.pop(key)
+        return _dos_cache[key]
+
+    if _dos_cache_directory is not None:
+        dos_file = os.path.join(_dos_cache_directory, key + '.npy')
+        if os.path.isfile(dos_file):
+            try:
+                dos = np.load(dos_file)
+                os.utime(dos_file, None)  # most recently used (see _prune_dos_cache_directory)
+            except (IOError, OSError, ValueError):
+                return None
+            _store_dos(key, dos, write=False)
+            return _dos_cache[key]
+
+    return None
+
+
+def _prune_dos_cache_directory():
+    # Remove the least recently used DOS files over the cache directory size
+    dos_files = [os.path.join(_dos_cache_directory, file_name) for file_name in os.listdir(_dos_cache_directory)
+                 if file_name.endswith('.npy') and not file_name.endswith('.tmp.npy')]
+    if len(dos_files) <= _dos_cache_directory_size:
+        return
+
+    dos_files.sort(key=os.path.getmtime)
+    for dos_file in dos_files[:len(dos_files) - _dos_cache_directory_size]:
+        try:
+            os.remove(dos_file)
+        except OSError:
+            pass  # removed by another process
+
+
+def _store_dos(key, dos, write=True):
+    _dos_cache[key] = dos
+    while len(_dos_cache) > _dos_cache_size:
+        _dos_cache.popitem(last=False)
+
+    if write and _dos_cache_directory is not None:
+        # Write in a temporary file first so that incomplete files are never read
+        try:
+            if not os.path.isdir(_dos_cache_directory):
+                os.makedirs(_dos_cache_directory)
+            temp_file = os.path.join(_dos_cache_directory, '{}.{}.tmp.npy'.format(key, os.getpid()))
+            np.save(temp_file, dos)
+            os.rename(temp_file, os.path.join(_dos_cache_directory, key + '.npy'))
+            _prune_dos_cache_directory()
+        except OSError as error:
+            print('Warning! DOS cache could not be written: {}'.format(error))
+
+
 def obtain_phonopy_dos(structure, mesh=(40, 40, 40), force_constants=None,
                        freq_min=None, freq_max=None, projected_on_atom=-1, NAC=False):
+    """
+    Get the (total or partial) phonon DOS normalized to the unit cell. The DOS is cached
+    for each harmonic model and mesh (see set_dos_cache_directory).
+    :return: array [frequencies, DOS]
+    """
 
     if force_constants is None:
         phonon = get_phonon(structure,
                             setup_forces=True,
                             custom_supercell=None,
                             NAC=NAC)
+        # set by get_phonon from the force sets if needed
+        force_constants = structure.get_force_constants()
     else:
         phonon = get_phonon(structure,
-                            setup_forces=False,
                             custom_supercell=force_constants.get_supercell(),
+                            force_constants=force_constants,
                             NAC=NAC)
-        phonon.set_force_constants(force_constants.get_array())
 
-    if projected_on_atom < 0:
-        phonon.set_mesh(mesh)
-        phonon.set_total_DOS(freq_min=freq_min, freq_max=freq_max, tetrahedron_method=True)
-        total_dos = np.array(phonon.get_total_DOS())
+    partial = projected_on_atom >= 0
+    key = _get_dos_key(phonon, force_constants, mesh, freq_min, freq_max, partial)
+    dos = _load_dos(key)
 
-    else:
-        phonon.set_mesh(mesh, is_eigenvectors=True, is_mesh_symmetry=False)
-        phonon.set_partial_DOS(freq_min=freq_min, freq_max=freq_max)
+    if dos is None:
+        if not partial:
+            phonon.set_mesh(mesh)
+            phonon.set_total_DOS(freq_min=freq_min, freq_max=freq_max, tetrahedron_method=True)
+            dos = np.array(phonon.get_total_DOS())
+        else:
+            # Partial DOS of all atoms [frequencies, atom 0, atom 1, ...]
+            phonon.set_mesh(mesh, is_eigenvectors=True, is_mesh_symmetry=False)
+            phonon.set_partial_DOS(freq_min=freq_min, freq_max=freq_max)
+            dos = np.vstack([phonon.get_partial_DOS()[0], phonon.get_partial_DOS()[1]])
 
-        if projected_on_atom >= len(phonon.get_partial_DOS()[1]):
+        _store_dos(key, dos)
+
+    if partial:
+        if projected_on_atom >= len(dos) - 1:
             print('No atom type {0}'.format(projected_on_atom))
             exit()
 
-        total_dos = np.array([phonon.get_partial_DOS()[0], phonon.get_partial_DOS()[1][projected_on_atom]])
-
+        total_dos = np.array([dos[0], dos[projected_on_atom + 1]])
+    else:
+        total_dos = np.array(dos)
 
     #Normalize to unit cell
     total_dos[1, :] *= float(structure.get_number_of_atoms())/structure.get_number_of_primitive_atoms()
     return total_dos
 
 
+def obtain_phonopy_max_frequency(structure, mesh=(40, 40, 40), force_constants=None, NAC=False):
+    """
+    Get the upper limit of the frequencies of the phonon DOS (THz) (from the cached DOS)
+    """
+    return obtain_phonopy_dos(structure, mesh=mesh, force_constants=force_constants, NAC=NAC)[0][-1]
+
+
 def obtain_phonopy_thermal_properties(structure, temperature, mesh=(40, 40, 40), force_constants=None, NAC=False):
 
     if force_constants is None:
@@ -195,10 +419,9 @@ def obtain_phonopy_thermal_properties(structure, temperature, mesh=(40, 40, 40),
                             NAC=NAC)
     else:
         phonon = get_phonon(structure,
-                            setup_forces=False,
                             custom_supercell=force_constants.get_supercell(),
+                            force_constants=force_constants,
                             NAC=NAC)
-        phonon.set_force_constants(force_constants.get_array())
 
     phonon.set_mesh(mesh)
     phonon.set_thermal_properties(t_step=1, t_min=temperature, t_max=temperature)
@@ -216,10 +439,9 @@ def obtain_phonopy_thermal_properties(structure, temperature, mesh=(40, 40, 40),
 def obtain_phonopy_mesh_from_force_constants(structure, force_constants, mesh=(40, 40, 40), NAC=False):
 
     phonon = get_phonon(structure,
-                        setup_forces=False,
                         custom_supercell=force_constants.get_supercell(),
+                        force_constants=force_constants,
                         NAC=NAC)
-    phonon.set_force_constants(force_constants.get_array())
 
     phonon.set_mesh(mesh)
 
@@ -231,25 +453,91 @@ def obtain_phonopy_mesh_from_force_constants(structure, force_constants, mesh=(4
 def obtain_phonon_dispersion_bands(structure, bands_ranges, force_constants=None,
                                    NAC=False, band_resolution=30, band_connection=False):
 
-    if force_constants is not None:
-        # print('Getting renormalized phonon dispersion relations')
-        phonon = get_phonon(structure, NAC=NAC, setup_forces=False,
-                            custom_supercell=force_constants.get_supercell())
-
-        phonon.set_force_constants(force_constants.get_array())
-    else:
-        # print('Getting phonon dispersion relations')
-        phonon = get_phonon(structure, NAC=NAC)
-
-    bands =[]
+    return obtain_phonon_dispersion_bands_batch(structure, bands_ranges, [force_constants],
+                                                NAC=NAC,
+                                                band_resolution=band_resolution,
+                                                band_connection=band_connection)[0]
+
+
+def obtain_phonon_dispersion_bands_batch(structure, bands_ranges, force_constants_list,
+                                         NAC=False, band_resolution=30, band_connection=False):
+    """
+    Get the phonon dispersion bands of several sets of force constants along the same band path
+    :param structure: Structure object
+    :param bands_ranges: list of [q_start, q_end] segments in reduced coordinates
+    :param force_constants_list: list of ForceConstants objects (None: structure force constants)
+    :param NAC: use non analytical corrections
+    :param band_resolution: number of q-point intervals in each segment
+    :param band_connection: connect bands by eigenvectors (as phonopy)
+    :return: list of band structures (q-points, distances, frequencies, eigenvectors) as in phonopy
+    """
+
+    bands = []
     for q_start, q_end in bands_ranges:
         band = []
         for i in range(band_resolution+1):
             band.append(np.array(q_start) + (np.array(q_end) - np.array(q_start)) / band_resolution * i)
-        bands.append(band)
-    phonon.set_band_structure(bands, is_band_connection=band_connection, is_eigenvectors=True)
+        bands.append(np.array(band))
+
+    phonons = []
+    for force_constants in force_constants_list:
+        if force_constants is not None:
+            # print('Getting renormalized phonon dispersion relations')
+            phonons.append(get_phonon(structure, NAC=NAC,
+                                      custom_supercell=force_constants.get_supercell(),
+                                      force_constants=force_constants))
+        else:
+            # print('Getting phonon dispersion relations')
+            phonons.append(get_phonon(structure, NAC=NAC))
 
-    return phonon.get_band_structure()
+    # NAC direction at gamma is handled by phonopy
+    if NAC:
+        band_structures = []
+        for phonon in phonons:
+            phonon.set_band_structure(bands, is_band_connection=band_connection, is_eigenvectors=True)
+            band_structures.append(phonon.get_band_structure())
+        return band_structures
+
+    # Path distances (as phonopy)
+    reciprocal_lattice = np.linalg.inv(phonons[0].get_primitive().get_cell()).T
+    distances = []
+    distance = 0.0
+    for band in bands:
+        steps = np.linalg.norm(np.dot(np.diff(band, axis=0), reciprocal_lattice), axis=1)
+        distances.append(distance + np.append([0.0], np.cumsum(steps)))
+        distance = distances[-1][-1]
+
+    # Diagonalize the dynamical matrices of all sets and q-points at once
+    q_points = np.concatenate(bands)
+    dynamical_matrices = np.array([[phonon.get_dynamical_matrix_at_q(q_point) for q_point in q_points]
+                                   for phonon in phonons])
+    eigenvalues, eigenvectors = np.linalg.eigh(dynamical_matrices)
+    frequencies = np.sign(eigenvalues) * np.sqrt(np.abs(eigenvalues)) * VaspToTHz
+
+    limits = np.cumsum([0] + [len(band) for band in bands])
+
+    # Connect bands along each segment by eigenvector similarity (same procedure as phonopy)
+    if band_connection:
+        from phonopy.phonon.band_structure import estimate_band_connection
+        for set_frequencies, set_eigenvectors in zip(frequencies, eigenvectors):
+            for i, j in zip(limits[:-1], limits[1:]):
+                band_order = range(frequencies.shape[2])
+                previous_eigenvectors = set_eigenvectors[i]
+                for k in range(i + 1, j):
+                    current_eigenvectors = set_eigenvectors[k].copy()
+                    band_order = estimate_band_connection(previous_eigenvectors, current_eigenvectors, band_order)
+                    set_frequencies[k] = set_frequencies[k][band_order]
+                    set_eigenvectors[k] = current_eigenvectors[:, band_order]
+                    previous_eigenvectors = current_eigenvectors
+
+    band_structures = []
+    for set_frequencies, set_eigenvectors in zip(frequencies, eigenvectors):
+        band_structures.append(([band for band in bands],
+                                [band_distances for band_distances in distances],
+                                [set_frequencies[i:j] for i, j in zip(limits[:-1], limits[1:])],
+                                [set_eigenvectors[i:j] for i, j in zip(limits[:-1], limits[1:])]))
+
+    return band_structures
 
 
 def get_commensurate_points(structure, fc_supercell):
@@ -265,28 +553,83 @@ def get_commensurate_points(structure, fc_supercell):
     return com_points
 
 
+def _get_q_point_operations(structure):
+    # Crystal reciprocal operations in primitive cell reduced coordinates (symmetry search done once per structure)
+    key = _get_phonon_key(structure, np.identity(3), None, False)
+    if key not in _symmetry_cache:
+        from phonopy.structure.symmetry import Symmetry
+        bulk = PhonopyAtoms(symbols=structure.get_atomic_elements(),
+                            scaled_positions=structure.get_scaled_positions(),
+                            cell=structure.get_cell())
+
+        primitive_matrix = structure.get_primitive_matrix()
+        _symmetry_cache[key] = np.array([np.dot(np.dot(np.linalg.inv(primitive_matrix), operation_matrix.T),
+                                                primitive_matrix)
+                                         for operation_matrix in Symmetry(bulk).get_reciprocal_operations()])
+    return _symmetry_cache[key]
+
+
 def get_equivalent_q_points_by_symmetry(q_point, structure):
 
-    from phonopy.structure.symmetry import Symmetry
-    bulk = PhonopyAtoms(symbols=structure.get_atomic_elements(),
-                        scaled_positions=structure.get_scaled_positions(),
-                        cell=structure.get_cell())
+    tot_points = np.dot(q_point, _get_q_point_operations(structure))
+    tot_points = tot_points[(tot_points >= 0).all(axis=1)]
 
-    tot_points = []
-    for operation_matrix in Symmetry(bulk).get_reciprocal_operations():
-        operation_matrix_q = np.dot(np.linalg.inv(structure.get_primitive_matrix()), operation_matrix.T)
-        operation_matrix_q = np.dot(operation_matrix_q, structure.get_primitive_matrix())
+    return np.unique(np.around(tot_points, decimals=8), axis=0)
 
-        q_point_test = np.dot(q_point, operation_matrix_q)
 
-        if (q_point_test >= 0).all():
-                tot_points.append(q_point_test)
+def get_commensurate_points_stars(structure, com_points, tolerance=1e-5):
+    """
+    Classify the commensurate points in stars of points equivalent by symmetry
+    (equal within tolerance after a crystal operation, up to a reciprocal lattice vector)
+    :param structure: Structure object
+    :param com_points: list of commensurate points in reduced coordinates
+    :param tolerance: tolerance used to compare points
+    :return: dictionary with irreducible points indices ('irreducible'), index of the irreducible point of
+             each point ('mapping'), indices of the points in each star ('stars') and star sizes ('weights')
+    """
 
-    return np.vstack({tuple(row) for row in tot_points})
+    operations = _get_q_point_operations(structure)
+    com_points = np.array(com_points)
+
+    mapping = np.arange(len(com_points))
+    irreducible = []
+    for i, q_point in enumerate(com_points):
+        if irreducible:
+            difference = np.dot(q_point, operations)[:, None, :] - com_points[irreducible][None, :, :]
+            difference -= np.around(difference)
+            equivalent = (np.abs(difference) < tolerance).all(axis=2).any(axis=0)
+            if equivalent.any():
+                mapping[i] = irreducible[int(np.argmax(equivalent))]
+                continue
+        irreducible.append(i)
+
+    irreducible = np.array(irreducible, dtype=int)
+    stars = [np.where(mapping == i)[0] for i in irreducible]
+
+    return {'irreducible': irreducible,
+            'mapping': mapping,
+            'stars': stars,
+            'weights': np.array([len(star) for star in stars])}
 
 
 def get_renormalized_force_constants(renormalized_frequencies, eigenvectors, structure, fc_supercell, symmetrize=False):
 
+    return get_renormalized_force_constants_batch([renormalized_frequencies], eigenvectors, structure,
+                                                  fc_supercell, symmetrize=symmetrize)[0]
+
+
+def get_renormalized_force_constants_batch(frequency_sets, eigenvectors, structure, fc_supercell, symmetrize=False):
+    """
+    Get the force constants of several sets of frequencies that share the same eigenvectors
+    (setup of the transformation and symmetrization is done only once)
+    :param frequency_sets: list of frequency arrays [q-point, mode] at the commensurate points
+    :param eigenvectors: eigenvectors [q-point, mode, atom, dimension] at the commensurate points
+    :param structure: Structure object
+    :param fc_supercell: force constants supercell
+    :param symmetrize: symmetrize force constants using crystal symmetry
+    :return: list of ForceConstants objects
+    """
+
     phonon = get_phonon(structure, setup_forces=False, custom_supercell=fc_supercell)
 
     primitive = phonon.get_primitive()
@@ -295,30 +638,46 @@ def get_renormalized_force_constants(renormalized_frequencies, eigenvectors, str
     dynmat2fc = DynmatToForceConstants(primitive, supercell)
 
     size = structure.get_number_of_dimensions() * structure.get_number_of_primitive_atoms()
-    eigenvectors = np.array([eigenvector.reshape(size, size, order='C').T for eigenvector in eigenvectors ])
-    renormalized_frequencies = np.array(renormalized_frequencies)
+    eigenvectors = np.array(eigenvectors).reshape((-1, size, size)).transpose((0, 2, 1))
 
-    try:
-        dynmat2fc.set_dynamical_matrices(renormalized_frequencies / VaspToTHz, eigenvectors)
+    if symmetrize:
+        print('Symmetrizing force constants')
+        supercell_cell = phonon.supercell.get_cell()
+        supercell_scaled_positions = phonon.supercell.get_scaled_positions()
+
+    # Dynamical matrices of all sets at once (D = E diag(w^2) E^H, with the sign of the frequencies)
+    frequency_sets = np.array(frequency_sets, dtype=float) / VaspToTHz
+    eigenvalue_sets = np.sign(frequency_sets) * frequency_sets ** 2
+    dynamical_matrix_sets = np.einsum('qim,sqm,qjm->sqij', eigenvectors, eigenvalue_sets, eigenvectors.conj())
+
+    # phonopy transforms one set of dynamical matrices per run (C routine)
+    force_constants_list = []
+    for renormalized_frequencies, dynamical_matrices in zip(frequency_sets, dynamical_matrix_sets):
+        if isinstance(getattr(DynmatToForceConstants, 'dynamical_matrices', None), property):
+            dynmat2fc.dynamical_matrices = dynamical_matrices
+        else:
+            try:
+                dynmat2fc.set_dynamical_matrices(renormalized_frequencies, eigenvectors)
 
-    except TypeError:
-        dynmat2fc.create_dynamical_matrices(frequencies=renormalized_frequencies / VaspToTHz,
-                                            eigenvalues=None,
-                                            eigenvectors=eigenvectors)
+            except TypeError:
+                dynmat2fc.create_dynamical_matrices(frequencies=renormalized_frequencies,
+                                                    eigenvalues=None,
+                                                    eigenvectors=eigenvectors)
 
-    dynmat2fc.run()
+        dynmat2fc.run()
 
-    force_constants = ForceConstants(dynmat2fc.get_force_constants(), supercell=fc_supercell)
+        force_constants = ForceConstants(np.array(dynmat2fc.get_force_constants()), supercell=fc_supercell)
 
-    # Symmetrize force constants using crystal symmetry
-    if symmetrize:
-        print('Symmetrizing force constants')
-        set_tensor_symmetry_PJ(force_constants.get_array(),
-                               phonon.supercell.get_cell(),
-                               phonon.supercell.get_scaled_positions(),
-                               phonon.symmetry)
+        # Symmetrize force constants using crystal symmetry
+        if symmetrize:
+            set_tensor_symmetry_PJ(force_constants.get_array(),
+                                   supercell_cell,
+                                   supercell_scaled_positions,
+                                   phonon.symmetry)
 
-    return force_constants
+        force_constants_list.append(force_constants)
+
+    return force_constants_list
 
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+import numpy as np
+
+from dynaphopy.power_spectrum import unit_conversion
+
+
+class StreamingPowerSpectrum:
+    """
+    Power spectrum accumulated from data received by blocks (Welch method).
+    Data is divided in overlapping segments (Hann window, 50% overlap) of the length
+    needed for the requested resolution. Only the last segment and the running sums of
+    the segment periodograms are kept in memory, so the length of the data is not limited.
+    """
+
+    def __init__(self, time_step, resolution, number_of_channels=1):
+        """
+        :param time_step: time between data points (ps)
+        :param resolution: frequency resolution (THz)
+        :param number_of_channels: number of independent signals (data columns)
+        """
+        self._time_step = time_step
+        self._segment_size = max(int(round(1. / (time_step * resolution))), 2)
+        self._hop = self._segment_size // 2
+        self._window = np.hanning(self._segment_size)
+
+        # Correlation between the periodograms of segments shifted by 1, 2, ... hops (Welch 1967)
+        self._overlap_correlations = [(np.sum(self._window[shift:] * self._window[:self._segment_size - shift]) /
+                                       np.sum(self._window ** 2)) ** 2
+                                      for shift in range(self._hop, self._segment_size, self._hop)]
+
+        self._buffer = np.zeros((self._segment_size, number_of_channels), dtype=complex)
+        self._buffer_steps = 0
+
+        self._psd_sum = np.zeros((self._segment_size, number_of_channels))
+        self._psd_square_sum = np.zeros((self._segment_size, number_of_channels))
+        self._number_of_segments = 0
+
+        self._number_of_samples = 0
+        self._square_sum = np.zeros(number_of_channels)
+
+    def _periodogram(self, data, window):
+        return np.abs(np.fft.fft(data * window[:, None], axis=0)) ** 2 * self._time_step / np.sum(window ** 2)
+
+    def add_data(self, data):
+        """
+        Add a block of data
+        :param data: array of shape (steps, number_of_channels)
+        """
+        data = np.asarray(data).reshape((len(data), -1))
+
+        self._number_of_samples += len(data)
+        self._square_sum += np.sum(np.abs(data) ** 2, axis=0)
+
+        position = 0
+        while position < len(data):
+            n = min(self._segment_size - self._buffer_steps, len(data) - position)
+            self._buffer[self._buffer_steps:self._buffer_steps + n] = data[position:position + n]
+            self._buffer_steps += n
+            position += n
+
+            if self._buffer_steps == self._segment_size:
+                psd = self._periodogram(self._buffer, self._window)
+                self._psd_sum += psd
+                self._psd_square_sum += psd ** 2
+                self._number_of_segments += 1
+
+                # Keep the second half of the segment as the beginning of the next one
+                self._buffer[:self._segment_size - self._hop] = self._buffer[self._hop:]
+                self._buffer_steps = self._segment_size - self._hop
+
+    def get_number_of_samples(self):
+        return self._number_of_samples
+
+    def get_number_of_segments(self):
+        return self._number_of_segments
+
+    def get_mean_square(self):
+        """
+        :return: running average of |data|^2 for each channel
+        """
+        if self._number_of_samples == 0:
+            return self._square_sum
+        return self._square_sum / self._number_of_samples
+
+    def _get_overlap_factor(self):
+        # Variance increase of the average due to the correlation of overlapping segments
+        n = self._number_of_segments
+        return 1 + 2 * sum((1 - float(j) / n) * correlation
+                           for j, correlation in enumerate(self._overlap_correlations[:n - 1], 1))
+
+    def get_power_spectrum(self, frequency_range, error=False):
+        """
+        Get the averaged power spectrum (eV*ps for mass weighted velocities, as power_spectrum_functions)
+        :param frequency_range: frequencies (THz) where the power spectrum is evaluated
+        :param error: if True also return the standard error of the average over segments (corrected
+        for the segment overlap, assuming the signal is not correlated beyond one segment)
+        :return: power spectrum array of shape (frequencies, number_of_channels) [and its error]
+        """
+        if self._number_of_segments > 0:
+            size = self._segment_size
+            psd = self._psd_sum / self._number_of_segments
+            # Sample variance of the segment periodograms
+            variance = ((self._psd_square_sum / self._number_of_segments - psd ** 2) *
+                        self._number_of_segments / max(self._number_of_segments - 1, 1))
+            psd_error = np.sqrt(np.clip(variance, 0, None) / self._number_of_segments * self._get_overlap_factor())
+        else:
+            # Not enough data for a full segment: use all data received (rectangular window,
+            # the Hann window of a few samples is almost zero)
+            size = self._buffer_steps
+            if size < 2:
+                print('Not enough data to calculate the power spectrum')
+                exit()
+            psd = self._periodogram(self._buffer[:size], np.ones(size))
+            psd_error = np.zeros_like(psd)
+
+        freqs = np.fft.fftfreq(size, self._time_step)
+        idx = np.argsort(freqs)
+
+        frequency_range = np.array(frequency_range)
+        power_spectrum = np.array([np.interp(frequency_range, freqs[idx], column[idx]) for column in psd.T]).T
+
+        if error:
+            power_spectrum_error = np.array([np.interp(frequency_range, freqs[idx], column[idx])
+                                             for column in psd_error.T]).T
+            return power_spectrum * unit_conversion, power_spectrum_error * unit_conversion
+
+        return power_spectrum * unit_conversion
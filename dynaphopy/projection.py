@@ -11,8 +11,10 @@ def project_onto_wave_vector(trajectory, q_vector, project_on_atom=-1):
     number_of_dimensions = velocity.shape[2]
     supercell = trajectory.get_supercell_matrix()
 
-    coordinates = trajectory.structure.get_positions(supercell)
-    atom_type = trajectory.structure.get_atom_type_index(supercell=supercell)
+    # Only the atoms stored in trajectory (see Dynamics.get_atom_indices)
+    atom_indices = trajectory.get_atom_indices()
+    coordinates = trajectory.structure.get_positions(supercell)[atom_indices]
+    atom_type = np.array(trajectory.structure.get_atom_type_index(supercell=supercell))[atom_indices]
 
     velocity_projected = np.zeros((velocity.shape[0], number_of_primitive_atoms, number_of_dimensions), dtype=complex)
 
@@ -35,7 +37,7 @@ def project_onto_wave_vector(trajectory, q_vector, project_on_atom=-1):
   #      velocity_projected[:,i,:] /= atom_type.count(i)
 
    #Normalize velocities (method 2)
-    number_of_primitive_cells = number_of_atoms/number_of_primitive_atoms
+    number_of_primitive_cells = trajectory.get_number_of_supercell_atoms()/number_of_primitive_atoms
     velocity_projected /= np.sqrt(number_of_primitive_cells)
     return velocity_projected
 
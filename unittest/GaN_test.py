@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 import numpy as np
 import os
+import shutil
+import tempfile
 import dynaphopy.interface.iofile as io
 import dynaphopy
 from dynaphopy.interface.phonopy_link import get_force_constants_from_file
@@ -9,6 +11,16 @@ import unittest
 
 class TestDynaphopy(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # The test trajectory is generated once in a temporary directory
+        cls.directory = tempfile.mkdtemp()
+        cls.file_name = os.path.join(cls.directory, 'test_gan.h5')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, True)
+
     def setUp(self):
         self.structure = io.read_from_file_structure_poscar('GaN_data/POSCAR')
 
@@ -21,14 +33,14 @@ class TestDynaphopy(unittest.TestCase):
                                                                                        [0, 3, 0],
                                                                                        [0, 0, 3]]))
 
-        if not os.path.exists('test_gan.h5'):
+        if not os.path.exists(self.file_name):
 
             trajectory = io.generate_test_trajectory(self.structure, supercell=[3, 3, 3], total_time=8, silent=False)
             self.calculation = dynaphopy.Quasiparticle(trajectory)
-            self.calculation.save_velocity_hdf5('test_gan.h5', save_trajectory=True)
+            self.calculation.save_velocity_hdf5(self.file_name, save_trajectory=True)
 
     def test_adp(self):
-        trajectory = io.initialize_from_hdf5_file('test_gan.h5',
+        trajectory = io.initialize_from_hdf5_file(self.file_name,
                                                   self.structure,
                                                   read_trajectory=True,
                                                   initial_cut=1,
@@ -49,7 +61,7 @@ class TestDynaphopy(unittest.TestCase):
         self.assertLess(np.max(np.abs(multiples - np.round(multiples))), 1e-4)
 
     def test_thermal_properties(self):
-        trajectory = io.initialize_from_hdf5_file('test_gan.h5',
+        trajectory = io.initialize_from_hdf5_file(self.file_name,
                                                   self.structure,
                                                   read_trajectory=False,
                                                   initial_cut=1000,
@@ -68,7 +80,7 @@ class TestDynaphopy(unittest.TestCase):
         self.assertLess(maximum, 0.4)
 
     def test_force_constants_self_consistency(self):
-        trajectory = io.initialize_from_hdf5_file('test_gan.h5',
+        trajectory = io.initialize_from_hdf5_file(self.file_name,
                                                   self.structure,
                                                   read_trajectory=False,
                                                   initial_cut=1,
@@ -85,7 +97,7 @@ class TestDynaphopy(unittest.TestCase):
 
         import yaml
 
-        trajectory = io.initialize_from_hdf5_file('test_gan.h5',
+        trajectory = io.initialize_from_hdf5_file(self.file_name,
                                                   self.structure,
                                                   read_trajectory=True,
                                                   initial_cut=1,
@@ -130,7 +142,6 @@ if __name__ == '__main__':
 
     unittest.main()
 
-    os.remove('test_gan.h5')
     os.remove('atomic_displacements.dat')
     os.remove('quasiparticles_data.yaml')
     os.remove('bands_data.yaml')
\ No newline at end of file
@@ -72,6 +72,78 @@ class TestDynaphopy(unittest.TestCase):
             for dict_data, dict_reference in zip(data, reference):
                 assertDictAlmostEqual(dict_data, dict_reference, decimal=1)
 
+    def test_commensurate_points_eigenvectors(self):
+        from dynaphopy.interface import phonopy_link
+
+        trajectory = io.generate_test_trajectory(self.structure, supercell=[2, 2, 2], total_time=2, silent=True)
+        calculation = dynaphopy.Quasiparticle(trajectory)
+        calculation.select_power_spectra_algorithm(2)
+
+        q_points = []
+        obtain_eigenvectors_and_frequencies = phonopy_link.obtain_eigenvectors_and_frequencies
+
+        def counted(structure, reduced_q_point, *args, **kwargs):
+            q_points.append(reduced_q_point)
+            return obtain_eigenvectors_and_frequencies(structure, reduced_q_point, *args, **kwargs)
+        phonopy_link.obtain_eigenvectors_and_frequencies = counted
+        self.addCleanup(setattr, phonopy_link, 'obtain_eigenvectors_and_frequencies',
+                        obtain_eigenvectors_and_frequencies)
+
+        # Eigenvectors of the commensurate points (and their equivalent points) are calculated only once
+        data = calculation.get_commensurate_points_data()
+        for q_point in q_points:
+            self.assertFalse(np.any([np.allclose(q_point, com_point) for com_point in data['q_points']]))
+
+    def test_autocorrelation_estimator(self):
+        from dynaphopy.analysis.fitting import phonon_fitting_analysis
+        from dynaphopy.analysis.fitting.estimators import get_autocorrelations
+        from dynaphopy.interface.phonopy_link import get_equivalent_q_points_by_symmetry
+
+        trajectory = io.generate_test_trajectory(self.structure, supercell=[2, 2, 2], total_time=5, silent=True)
+        calculation = dynaphopy.Quasiparticle(trajectory)
+        calculation.select_power_spectra_algorithm(2)
+        calculation.set_reduced_q_vector([0.5, 0.0, 0.5])
+
+        # Equivalent wave vectors are projected without changing the current one (or its cached data)
+        vq = calculation.get_vq()
+        eigenvectors = calculation.get_eigenvectors()
+        autocorrelations = calculation.get_autocorrelation_phonon()
+        self.assertTrue(np.array_equal(calculation.get_reduced_q_vector(), [0.5, 0.0, 0.5]))
+        self.assertIs(calculation.get_vq(), vq)
+        self.assertIs(calculation.get_eigenvectors(), eigenvectors)
+
+        # Average over the equivalent wave vectors (projected one by one)
+        time_step = trajectory.get_time_step_average()
+        reference = []
+        for q_point in get_equivalent_q_points_by_symmetry([0.5, 0.0, 0.5], self.structure):
+            single = dynaphopy.Quasiparticle(trajectory)
+            single.parameters.use_symmetry = False
+            single.set_reduced_q_vector(q_point)
+            reference.append(get_autocorrelations(single.get_vq(), time_step))
+        self.assertGreater(len(reference), 1)
+        self.assertTrue(np.allclose(autocorrelations, np.average(reference, axis=0)))
+
+        # Time domain estimator and Lorentzian fit give the same peak positions (harmonic data:
+        # widths are limited by the resolution)
+        frequencies = calculation.get_frequencies()
+        lorentzian = phonon_fitting_analysis(calculation.get_power_spectrum_phonon(),
+                                             calculation.get_frequency_range(),
+                                             harmonic_frequencies=frequencies,
+                                             fitting_function_type=0,
+                                             show_plots=False,
+                                             print_data=False)
+        envelope = phonon_fitting_analysis(None,
+                                           calculation.get_frequency_range(),
+                                           harmonic_frequencies=frequencies,
+                                           fitting_function_type=4,
+                                           show_plots=False,
+                                           print_data=False,
+                                           autocorrelations=autocorrelations,
+                                           time_step=time_step)
+
+        self.assertTrue(np.allclose(envelope['positions'], lorentzian['positions'], atol=0.05))
+        self.assertTrue(np.allclose(envelope['positions'], frequencies, atol=0.05))
+
 
 if __name__ == '__main__':
 
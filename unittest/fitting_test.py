@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+import numpy as np
+
+import unittest
+
+
+class TestDynaphopy(unittest.TestCase):
+
+    def test_batch_fitting(self):
+        from dynaphopy.analysis.fitting import fitting_functions
+        from dynaphopy.analysis.fitting.batch_fitting import fit_power_spectra
+
+        frequencies = np.arange(0, 20, 0.05)
+        random_state = np.random.RandomState(0)
+        positions = random_state.uniform(2, 17, 10)
+        widths = random_state.uniform(0.1, 1.0, 10)
+        power_spectra = np.array([width / (2 * np.pi * ((frequencies - position) ** 2 + (width / 2) ** 2))
+                                  for position, width in zip(positions, widths)]).T
+        power_spectra *= 1 + 0.1 * random_state.normal(size=power_spectra.shape)
+
+        for fitting_function_type in [0, 2]:
+            batch = [function.get_fitting() for function in fit_power_spectra(frequencies, power_spectra,
+                                                                              fitting_function_type)]
+            for i, data in enumerate(batch):
+                single = fitting_functions.fitting_functions[fitting_function_type](
+                    frequencies, power_spectra[:, i],
+                    guess_position=frequencies[np.argmax(power_spectra[:, i])],
+                    guess_height=np.max(power_spectra[:, i])).get_fitting()
+
+                self.assertTrue(np.allclose([data['peak_position'], data['width']],
+                                            [single['peak_position'], single['width']], rtol=1e-4))
+
+        # Fit-free estimator
+        estimates = [function.get_fitting() for function in fit_power_spectra(frequencies, power_spectra, 3)]
+        self.assertTrue(np.allclose([data['peak_position'] for data in estimates], positions, rtol=1e-2))
+        self.assertTrue(np.allclose([data['width'] for data in estimates], widths, rtol=0.15))
+
+    def test_jacobians(self):
+        from dynaphopy.analysis.fitting import fitting_functions
+
+        frequencies = np.linspace(1, 19, 200)
+        parameters = {fitting_functions.Lorentzian: [8.3, 0.4, 1.2, 0.05],
+                      fitting_functions.Lorentzian_asymmetric: [8.3, 0.4, 1.2, 0.05, 0.3],
+                      fitting_functions.Damped_harmonic: [8.3, 0.4, 1.2, 0.05],
+                      fitting_functions.Gaussian_function: [8.3, 0.4, 1.2, 0.05]}
+
+        for fitting_class, values in parameters.items():
+            function = fitting_class(frequencies, np.zeros_like(frequencies), guess_position=8.0, guess_height=1.0)
+            jacobian = function._jacobian(frequencies, *values)
+
+            # Central finite differences
+            for k in range(len(values)):
+                step = 1e-6 * max(abs(values[k]), 1.0)
+                forward, backward = np.array(values, dtype=float), np.array(values, dtype=float)
+                forward[k] += step
+                backward[k] -= step
+                numerical = (function._function(frequencies, *forward) -
+                             function._function(frequencies, *backward)) / (2 * step)
+                self.assertTrue(np.allclose(jacobian[:, k], numerical,
+                                            rtol=1e-5, atol=1e-7 * np.max(np.abs(numerical))),
+                                msg='{} parameter {}'.format(fitting_class.__name__, k))
+
+    def test_autocorrelation_estimator(self):
+        from scipy.signal import lfilter
+        from dynaphopy.analysis.fitting.estimators import get_autocorrelations, fit_autocorrelations
+
+        # Phonon projections of damped modes (exponentially decaying autocorrelation)
+        time_step = 0.002
+        random_state = np.random.RandomState(0)
+        positions = np.array([3.0, 7.5, 12.0, 15.5])
+        widths = np.array([0.3, 0.2, 0.5, 0.4])
+        noise = random_state.normal(size=(200000, 4)) + 1j * random_state.normal(size=(200000, 4))
+        vq = np.array([lfilter([1], [1, -np.exp((2j * np.pi * position - np.pi * width) * time_step)], noise[:, i])
+                       for i, (position, width) in enumerate(zip(positions, widths))]).T
+
+        autocorrelations = get_autocorrelations(vq, time_step)
+        estimates = [function.get_fitting() for function in fit_autocorrelations(time_step, autocorrelations,
+                                                                                  positions * 1.02)]
+
+        self.assertTrue(np.allclose([data['peak_position'] for data in estimates], positions, atol=0.03))
+        self.assertTrue(np.allclose([data['width'] for data in estimates], widths, rtol=0.2))
+
+    def test_estimators_initial_guess(self):
+        from dynaphopy.analysis.fitting import fitting_functions
+        from dynaphopy.analysis.fitting.estimators import get_moment_estimates
+        from dynaphopy.analysis.fitting.batch_fitting import fit_power_spectra
+
+        # Lorentzian peak and a higher spurious spike
+        frequencies = np.arange(0, 20, 0.05)
+        power_spectrum = 0.5 / (2 * np.pi * ((frequencies - 6.0) ** 2 + 0.25 ** 2))
+        power_spectrum[300] = 2 * np.max(power_spectrum)
+
+        for fitting_function_type in [3, 4]:
+            fitting_class = fitting_functions.fitting_functions[fitting_function_type]
+            data = fitting_class(frequencies, power_spectrum).get_fitting()
+            self.assertFalse(data['all_good'] and np.isclose(data['peak_position'], 6.0, atol=0.05))
+
+            for guess_width in [None, 0.4]:
+                data = fitting_class(frequencies, power_spectrum, guess_position=6.3,
+                                     guess_width=guess_width).get_fitting()
+                self.assertTrue(np.allclose([data['peak_position'], data['width']], [6.0, 0.5], atol=0.05))
+
+            # Batch estimates use the same initial guess
+            batch = fit_power_spectra(frequencies, power_spectrum[:, None], fitting_function_type,
+                                      guess_positions=[6.3], guess_widths=[np.nan])[0].get_fitting()
+            self.assertTrue(np.isclose(batch['peak_position'], data['peak_position']))
+
+        # Moment equations are iterated until convergence
+        power_spectra = np.array([width / (2 * np.pi * ((frequencies - position) ** 2 + (width / 2) ** 2))
+                                  for position, width in [(4.0, 0.3), (9.5, 0.8), (15.0, 1.5)]]).T
+        power_spectra *= 1 + 0.1 * np.random.RandomState(0).normal(size=power_spectra.shape)
+        estimates = get_moment_estimates(frequencies, power_spectra)
+        reference = get_moment_estimates(frequencies, power_spectra, tolerance=0, max_iterations=1000)
+        for key in ['peak_position', 'width', 'area']:
+            self.assertTrue(np.allclose(estimates[key], reference[key], rtol=1e-6))
+
+    def _get_si_structure(self):
+        import dynaphopy.interface.iofile as io
+        from dynaphopy.interface.phonopy_link import get_force_constants_from_file
+
+        structure = io.read_from_file_structure_poscar('Si_data/POSCAR')
+        structure.set_primitive_matrix([[0.0, 0.5, 0.5],
+                                        [0.5, 0.0, 0.5],
+                                        [0.5, 0.5, 0.0]])
+        structure.set_force_constants(get_force_constants_from_file(file_name='Si_data/FORCE_CONSTANTS',
+                                                                     fc_supercell=[[2, 0, 0],
+                                                                                   [0, 2, 0],
+                                                                                   [0, 0, 2]]))
+        return structure
+
+    def test_initial_guess(self):
+        import os
+        import shutil
+        import tempfile
+        import dynaphopy.interface.iofile as io
+        from dynaphopy.analysis.fitting.initial_guess import InitialGuess
+        from dynaphopy.interface.phonopy_link import obtain_eigenvectors_and_frequencies_batch
+
+        structure = self._get_si_structure()
+
+        # stored point, equivalent by symmetry, neighbour, far point and X point (degenerate phonons)
+        q_points = [[0.1, 0.2, 0.3], [0.3, 0.2, 0.1], [0.12, 0.2, 0.3], [0.5, 0.5, 0.5], [0.5, 0.0, 0.5]]
+        harmonic = obtain_eigenvectors_and_frequencies_batch(structure, q_points, print_data=False)[1]
+
+        shifts = np.array([0.1, -0.2, 0.3, -0.4, 0.5, -0.6])
+        widths = np.array([0.2, 0.25, 0.3, 0.35, 0.4, 0.45])
+
+        # Stored results in another phonon order
+        order = np.array([5, 3, 4, 0, 2, 1])
+        quasiparticle_data = {'q_points': np.array([q_points[0], q_points[4]]),
+                              'frequencies': np.array([harmonic[0] + shifts, harmonic[4] + shifts])[:, order],
+                              'linewidths': np.array([widths, widths])[:, order],
+                              'frequency_shifts': np.array([shifts, shifts])[:, order]}
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        io.save_quasiparticle_data_to_file(quasiparticle_data, os.path.join(directory, 'quasiparticles_data.yaml'))
+        read_data = io.read_quasiparticle_data_from_file(os.path.join(directory, 'quasiparticles_data.yaml'))
+        for key, value in quasiparticle_data.items():
+            self.assertTrue(np.allclose(read_data[key], value, atol=1e-8))
+
+        initial_guess = InitialGuess(structure, read_data)
+
+        # Same wave vector (thermal expansion shift is removed) and equivalent by symmetry
+        for i, thermal_expansion_shift in [(0, np.full(6, 0.05)), (1, None)]:
+            positions, guess_widths = initial_guess.get_guess(q_points[i], harmonic[i],
+                                                              thermal_expansion_shift=thermal_expansion_shift)
+            expected = harmonic[i] + shifts
+            if thermal_expansion_shift is not None:
+                expected -= thermal_expansion_shift
+            self.assertTrue(np.allclose(positions, expected, atol=1e-6))
+            self.assertTrue(np.allclose(guess_widths, widths, atol=1e-6))
+
+        # Frequency shifts of the nearest wave vector
+        positions, guess_widths = initial_guess.get_guess(q_points[2], harmonic[2])
+        self.assertTrue(np.allclose(positions, harmonic[2] + shifts, atol=1e-6))
+        self.assertTrue(np.allclose(guess_widths, widths, atol=1e-6))
+
+        # No close results: harmonic frequencies
+        positions, guess_widths = initial_guess.get_guess(q_points[3], harmonic[3],
+                                                          thermal_expansion_shift=np.full(6, 0.05))
+        self.assertTrue(np.allclose(positions, harmonic[3]))
+        self.assertTrue(np.isnan(guess_widths).all())
+
+        # Degenerate phonons get the same guess
+        positions, guess_widths = initial_guess.get_guess(q_points[4], harmonic[4])
+        for i in range(0, 6, 2):
+            self.assertTrue(np.isclose(harmonic[4][i], harmonic[4][i + 1]))
+            self.assertTrue(np.allclose(positions[i:i + 2], harmonic[4][i] + np.average(shifts[i:i + 2]), atol=1e-6))
+            self.assertTrue(np.allclose(guess_widths[i:i + 2], np.average(widths[i:i + 2]), atol=1e-6))
+
+    def test_initial_guess_script(self):
+        import os
+        import sys
+        import yaml
+        import shutil
+        import tempfile
+        import subprocess
+        import dynaphopy.interface.iofile as io
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+
+        structure = self._get_si_structure()
+        trajectory = io.generate_test_trajectory(structure, supercell=[2, 2, 2], total_time=5, silent=True)
+        io.save_data_hdf5(os.path.join(directory, 'trajectory.h5'), trajectory.get_time(),
+                          trajectory.get_supercell_matrix(), velocity=trajectory.velocity)
+
+        with open(os.path.join(directory, 'input_si'), 'w') as f:
+            f.write('STRUCTURE FILE POSCAR\n{0}\n\n'
+                    'FORCE CONSTANTS\n{1}\n\n'
+                    'PRIMITIVE MATRIX\n0.0 0.5 0.5\n0.5 0.0 0.5\n0.5 0.5 0.0\n\n'
+                    'SUPERCELL MATRIX\n2 0 0\n0 2 0\n0 0 2\n\n'
+                    'MESH PHONOPY\n20 20 20\n'.format(os.path.abspath('Si_data/POSCAR'),
+                                                      os.path.abspath('Si_data/FORCE_CONSTANTS')))
+
+        script = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'dynaphopy'))
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(script)),
+                                                     environment.get('PYTHONPATH', '')])
+
+        # Previous results used as initial guess of the peak fittings
+        results = []
+        for options in [[], ['--initial_guess', 'previous.yaml']]:
+            subprocess.check_call([sys.executable, script, 'input_si', '-lv', 'trajectory.h5', '-psm', '2',
+                                   '-sdata', '--silent'] + options,
+                                  cwd=directory, env=environment, stdout=subprocess.PIPE)
+            with open(os.path.join(directory, 'quasiparticles_data.yaml')) as stream:
+                results.append(yaml.safe_load(stream))
+            os.rename(os.path.join(directory, 'quasiparticles_data.yaml'), os.path.join(directory, 'previous.yaml'))
+
+        for data, reference in zip(results[1], results[0]):
+            for key in ['frequencies', 'linewidths']:
+                self.assertTrue(np.allclose(data[key], reference[key], atol=1e-4))
+
+
+if __name__ == '__main__':
+    unittest.main()
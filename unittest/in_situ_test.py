@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+import numpy as np
+import dynaphopy.interface.iofile as io
+from dynaphopy.interface.phonopy_link import get_force_constants_from_file
+
+import unittest
+
+
+class TestDynaphopy(unittest.TestCase):
+
+    def setUp(self):
+        self.structure = io.read_from_file_structure_poscar('Si_data/POSCAR')
+
+        self.structure.set_primitive_matrix([[0.0, 0.5, 0.5],
+                                             [0.5, 0.0, 0.5],
+                                             [0.5, 0.5, 0.0]])
+
+        self.structure.set_force_constants(get_force_constants_from_file(file_name='Si_data/FORCE_CONSTANTS',
+                                                                         fc_supercell=[[2, 0, 0],
+                                                                                       [0, 2, 0],
+                                                                                       [0, 0, 2]]))
+
+    def test_in_situ_projection(self):
+        from dynaphopy import projection
+        from dynaphopy.analysis.in_situ import InSituAnalysis
+        from dynaphopy.interface.phonopy_link import obtain_eigenvectors_and_frequencies
+
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        trajectory = parser('Si_data/XDATCAR', self.structure, time_step=0.0005)
+
+        reduced_q_vector = np.array([0.5, 0.0, 0.5])
+        q_vector = np.dot(reduced_q_vector, 2.0 * np.pi * np.linalg.inv(self.structure.get_primitive_cell()).T)
+        eigenvectors, frequencies = obtain_eigenvectors_and_frequencies(self.structure, reduced_q_vector,
+                                                                        print_data=False)
+        vq = projection.project_onto_phonon(projection.project_onto_wave_vector(trajectory, q_vector),
+                                            eigenvectors)
+
+        in_situ = InSituAnalysis(self.structure, [reduced_q_vector])
+        in_situ.initialize(trajectory.get_supercell_matrix(), trajectory.get_time_step_average())
+        for i in range(0, len(trajectory.velocity), 7):
+            in_situ.add_block(trajectory.velocity[i:i + 7].real)
+
+        self.assertTrue(np.allclose(in_situ.project_block(trajectory.velocity.real)[:, 0], vq))
+        self.assertTrue(np.allclose(in_situ.get_mean_square_velocity()[0], np.average(np.abs(vq) ** 2, axis=0)))
+
+    def test_in_situ_power_spectrum(self):
+        from dynaphopy import projection
+        from dynaphopy.parameters import Parameters
+        from dynaphopy.power_spectrum import get_fft_numpy_spectra, unit_conversion
+        from dynaphopy.analysis.in_situ import InSituAnalysis
+        from dynaphopy.interface.phonopy_link import obtain_eigenvectors_and_frequencies
+
+        trajectory = io.generate_test_trajectory(self.structure, supercell=[2, 2, 2], total_time=2, silent=True)
+
+        # Keep only positive frequencies of the velocities (analytic signal) to check the sign convention
+        velocity_fft = np.fft.fft(trajectory.velocity.real, axis=0)
+        velocity_fft[np.fft.fftfreq(len(velocity_fft)) < 0] = 0
+        velocity = np.fft.ifft(2 * velocity_fft, axis=0)
+
+        reduced_q_vector = np.array([0.5, 0.0, 0.5])
+        q_vector = np.dot(reduced_q_vector, 2.0 * np.pi * np.linalg.inv(self.structure.get_primitive_cell()).T)
+        eigenvectors, frequencies = obtain_eigenvectors_and_frequencies(self.structure, reduced_q_vector,
+                                                                        print_data=False)
+
+        parameters = Parameters(silent=True, frequency_range=np.arange(-20, 20, 0.5))
+        trajectory.velocity = velocity
+        vq = projection.project_onto_phonon(projection.project_onto_wave_vector(trajectory, q_vector),
+                                            eigenvectors)
+        reference = get_fft_numpy_spectra(vq, trajectory, parameters)
+
+        in_situ = InSituAnalysis(self.structure, [reduced_q_vector], frequency_range=parameters.frequency_range)
+        in_situ.initialize(trajectory.get_supercell_matrix(), trajectory.get_time_step_average())
+        for i in range(0, len(velocity), 300):
+            in_situ.add_block(velocity[i:i + 300])
+        power_spectrum = in_situ.get_power_spectra()[0]
+
+        # Same peaks (sign and units of frequency) and peak intensities
+        frequency_range = parameters.frequency_range
+        peaks = frequency_range[np.argmax(power_spectrum, axis=0)]
+        self.assertTrue(np.allclose(peaks, frequency_range[np.argmax(reference, axis=0)]))
+        self.assertTrue(np.allclose(peaks, frequencies, atol=0.5))
+        self.assertTrue(np.allclose(np.max(power_spectrum, axis=0), np.max(reference, axis=0), rtol=0.2))
+
+        # Normalization: the integral of the power spectrum is the mean square of the phonon coordinate velocity
+        self.assertTrue(np.allclose(np.trapz(power_spectrum, frequency_range, axis=0),
+                                    np.average(np.abs(vq) ** 2, axis=0) * unit_conversion, rtol=0.02))
+
+    def test_in_situ_convergence(self):
+        from dynaphopy.analysis.in_situ import InSituAnalysis
+
+        trajectory = io.generate_test_trajectory(self.structure, supercell=[2, 2, 2], total_time=2, silent=True)
+        velocity = trajectory.velocity.real
+
+        # Segments of 500 steps (1 THz resolution)
+        in_situ = InSituAnalysis(self.structure, [[0.5, 0.0, 0.5]], frequency_range=np.arange(0, 20, 1.0))
+        in_situ.initialize(trajectory.get_supercell_matrix(), trajectory.get_time_step_average())
+
+        # Not checked before the first segment is complete
+        in_situ.add_block(velocity[:300])
+        self.assertFalse(in_situ.check_convergence(100, window=2))
+        self.assertEqual(len(in_situ.get_convergence_history()), 0)
+
+        for i in range(300, 1000, 100):
+            in_situ.add_block(velocity[i:i + 100])
+            in_situ.check_convergence(100, window=2)
+
+        history = in_situ.get_convergence_history()
+        self.assertEqual(history.shape, (6, 2, 1, 6))
+        self.assertTrue(np.allclose(history[-1, 0, 0, :2], 3.92, atol=0.5))
+
+        # Converged only when the last window checks change less than the tolerance
+        changes = [10, 5, 0.5, 0.3, 0.2, 0.2, 3]
+        results = iter([{'positions': 5 + change + np.zeros((1, 6)),
+                         'widths': 0.5 + np.zeros((1, 6))} for change in changes])
+        in_situ = InSituAnalysis(self.structure, [[0.5, 0.0, 0.5]], frequency_range=np.arange(0, 20, 1.0))
+        in_situ.initialize(trajectory.get_supercell_matrix(), trajectory.get_time_step_average())
+        in_situ.add_block(velocity[:500])
+        in_situ.get_fitting = lambda fitting_function_type=0: next(results)
+
+        converged = [in_situ.check_convergence(1, window=2) for change in changes]
+        self.assertEqual(converged, [False, False, False, False, True, True, False])
+
+    def test_in_situ_convergence_failed_fittings(self):
+        from dynaphopy.analysis.in_situ import InSituAnalysis
+
+        trajectory = io.generate_test_trajectory(self.structure, supercell=[2, 2, 2], total_time=2, silent=True)
+
+        in_situ = InSituAnalysis(self.structure, [[0.5, 0.0, 0.5]], frequency_range=np.arange(0, 20, 1.0))
+        in_situ.initialize(trajectory.get_supercell_matrix(), trajectory.get_time_step_average())
+        in_situ.add_block(trajectory.velocity[:500].real)
+
+        # Failed fittings (zero positions and widths) do not change, but are not converged
+        in_situ.get_fitting = lambda fitting_function_type=0: {'positions': np.zeros((1, 6)),
+                                                               'widths': np.zeros((1, 6))}
+        converged = [in_situ.check_convergence(100, window=2) for i in range(6)]
+        self.assertFalse(any(converged))
+
+        # A mode failed in one check of the window is not converged
+        results = [{'positions': 5 + np.zeros((1, 6)), 'widths': 0.5 + np.zeros((1, 6))} for i in range(8)]
+        results[3]['widths'][0, 3] = 0
+        results[4]['positions'][0, 2] = np.nan
+        results = iter(results)
+        in_situ.get_fitting = lambda fitting_function_type=0: next(results)
+
+        converged = [in_situ.check_convergence(100, window=2) for i in range(8)]
+        self.assertEqual(converged, [False, False, True, False, False, False, False, True])
+
+    def test_streaming_power_spectrum_error(self):
+        from dynaphopy.power_spectrum.streaming import StreamingPowerSpectrum
+
+        # Less data than one segment
+        accumulator = StreamingPowerSpectrum(0.001, 10)
+        accumulator.add_data(np.ones(2))
+        self.assertTrue(np.all(np.isfinite(accumulator.get_power_spectrum(np.arange(0, 100, 10)))))
+
+        # The error of the average over overlapping segments matches the spread of independent averages
+        random_state = np.random.RandomState(0)
+        power_spectra = []
+        errors = []
+        for i in range(300):
+            accumulator = StreamingPowerSpectrum(0.001, 10)
+            accumulator.add_data(random_state.normal(size=1000))
+            power_spectrum, error = accumulator.get_power_spectrum([120, 300], error=True)
+            power_spectra.append(power_spectrum[:, 0])
+            errors.append(error[:, 0])
+
+        self.assertTrue(np.allclose(np.average(errors, axis=0), np.std(power_spectra, axis=0), rtol=0.1))
+
+    def test_average_power_spectra(self):
+        from dynaphopy.analysis.in_situ import InSituAnalysis, average_power_spectra
+
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        trajectory = parser('Si_data/XDATCAR', self.structure, time_step=0.0005)
+        velocity = trajectory.velocity.real
+
+        # Independent analyses of different parts of the trajectory
+        analyses = []
+        for i in range(3):
+            in_situ = InSituAnalysis(self.structure, [[0.5, 0.0, 0.5], [0.0, 0.0, 0.0]],
+                                     frequency_range=np.arange(0, 20, 0.5))
+            in_situ.initialize(trajectory.get_supercell_matrix(), trajectory.get_time_step_average())
+            in_situ.add_block(velocity[i::3])
+            analyses.append(in_situ)
+
+        power_spectra = np.array([in_situ.get_power_spectra() for in_situ in analyses])
+        average, error = average_power_spectra(analyses)
+        self.assertEqual(len(average), 2)
+        self.assertEqual(len(error), 2)
+        self.assertTrue(np.allclose(average, np.average(power_spectra, axis=0)))
+        self.assertTrue(np.allclose(error, np.std(power_spectra, axis=0, ddof=1) / np.sqrt(3)))
+        self.assertTrue(np.all(error[0] > 0))
+
+        # No error estimate from a single analysis
+        average, error = average_power_spectra(analyses[:1])
+        self.assertTrue(np.allclose(average, power_spectra[0]))
+        self.assertTrue(np.allclose(error, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+import os
+import sys
+import copy
+import shutil
+import ctypes
+import tempfile
+import numpy as np
+import dynaphopy.interface.iofile as io
+
+import unittest
+
+try:
+    import lammps
+    lammps_available = True
+except ImportError:
+    lammps_available = False
+
+
+class MockLammps(object):
+    """
+    Minimal stand-in of the LAMMPS python module (Einstein crystal integrated with velocity Verlet).
+    fix external callbacks are called after the force computation (post_force) as in LAMMPS,
+    when velocities are half a time step behind positions.
+    """
+
+    cell = None  # simulation cell of the input file (before replicate)
+    positions = None  # cartesian positions of the input file
+    mass = 28.0855
+    per_atom_mass = False  # masses defined per atom (rmass) instead of per type
+    spring_constant = 2.0e5
+
+    def __init__(self, cmdargs=None):
+        self._time_step = 0.001
+        self._ntimestep = 0
+        self._fixes = {}
+
+    def file(self, input_file):
+        self._box = np.array(self.cell)
+        self._x0 = np.array(self.positions)
+        self._u = np.zeros_like(self._x0)
+        self._v = np.zeros_like(self._x0)
+
+    def command(self, command):
+        words = command.split()
+        if words[0] == 'timestep':
+            self._time_step = float(words[1])
+        elif words[0] == 'replicate':
+            n = [int(i) for i in words[1:4]]
+            cells = [[i, j, k] for i in range(n[0]) for j in range(n[1]) for k in range(n[2])]
+            x0 = np.concatenate([self._x0 + np.dot(cell, self._box) for cell in cells])
+            # LAMMPS atom order is not the dynaphopy order
+            self._x0 = x0[np.random.RandomState(0).permutation(len(x0))]
+            self._box = self._box * np.array(n)[:, None]
+            self._u = np.zeros_like(self._x0)
+            self._v = np.zeros_like(self._x0)
+        elif words[0] == 'velocity' and words[2] == 'create':
+            self._v = np.random.RandomState(int(words[4])).normal(size=self._x0.shape)
+        elif words[0] == 'fix' and words[3] == 'external':
+            self._fixes[words[1]] = int(words[5])
+        elif words[0] == 'unfix':
+            self._fixes.pop(words[1], None)
+        elif words[0] == 'run':
+            self._post_force()  # setup
+            for i in range(int(words[1])):
+                self._v += 0.5 * self._time_step * self._force() / self.mass
+                self._u += self._time_step * self._v
+                self._ntimestep += 1
+                self._post_force()
+                self._v += 0.5 * self._time_step * self._force() / self.mass
+
+    def _force(self):
+        return -self.spring_constant * self._u
+
+    def _post_force(self):
+        for fix_id, every in self._fixes.items():
+            if self._ntimestep % every == 0:
+                callback, caller = self._callbacks[fix_id]
+                callback(caller, self._ntimestep, len(self._x0), None, None, np.zeros_like(self._x0))
+
+    def set_fix_external_callback(self, fix_id, callback, caller=None):
+        self._callbacks = getattr(self, '_callbacks', {})
+        self._callbacks[fix_id] = (callback, caller)
+
+    def extract_global(self, name, data_type=None):
+        values = {'natoms': len(self._x0), 'ntimestep': self._ntimestep, 'ftm2v': 1.0,
+                  'boxxhi': self._box[0, 0], 'boxyhi': self._box[1, 1], 'boxzhi': self._box[2, 2]}
+        return values.get(name, 0.0)
+
+    def extract_compute(self, compute_id, style, data_type):
+        return 0.5 * self.spring_constant * np.sum(self._u ** 2)
+
+    def extract_atom(self, name, data_type=None):
+        if name == 'rmass':
+            return np.full(len(self._x0), self.mass) if self.per_atom_mass else None
+        return None if self.per_atom_mass else [0.0, self.mass]
+
+    def get_natoms(self):
+        return len(self._x0)
+
+    def gather_atoms(self, name, data_type, count):
+        if name == 'type':
+            return np.ctypeslib.as_ctypes(np.ones(len(self._x0), dtype=ctypes.c_int))
+        if name == 'rmass':
+            return np.ctypeslib.as_ctypes(np.full(len(self._x0), self.mass))
+        data = {'x': self._x0 + self._u, 'v': self._v, 'f': self._force()}[name]
+        return np.ctypeslib.as_ctypes(np.array(data).flatten())
+
+    def scatter_atoms(self, name, data_type, count, data):
+        data = np.ctypeslib.as_array(data).reshape(-1, 3)
+        if name == 'x':
+            self._u = data - self._x0
+        else:
+            self._v = data.copy()
+
+    def close(self):
+        pass
+
+
+class MockLammpsModule(object):
+    lammps = MockLammps
+
+
+class TestDynaphopy(unittest.TestCase):
+
+    def setUp(self):
+        self.structure = io.read_from_file_structure_poscar('Si_data/POSCAR')
+
+        self.structure.set_primitive_matrix([[0.0, 0.5, 0.5],
+                                             [0.5, 0.0, 0.5],
+                                             [0.5, 0.5, 0.0]])
+
+        # Files written by the tests
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def _use_mock_lammps(self, cell_repetitions=(1, 1, 1)):
+        # Input file cell made of several unit cells
+        cells = [[i, j, k] for i in range(cell_repetitions[0])
+                 for j in range(cell_repetitions[1])
+                 for k in range(cell_repetitions[2])]
+        MockLammps.cell = self.structure.get_cell() * np.array(cell_repetitions)[:, None]
+        MockLammps.positions = np.concatenate([self.structure.get_positions() +
+                                               np.dot(cell, self.structure.get_cell()) for cell in cells])
+
+        original_module = sys.modules.get('lammps')
+        if original_module is None:
+            self.addCleanup(sys.modules.pop, 'lammps', None)
+        else:
+            self.addCleanup(sys.modules.__setitem__, 'lammps', original_module)
+        sys.modules['lammps'] = MockLammpsModule
+
+    def _sample_by_runs(self, input_file, supercell, n_steps, sampling_interval, seed):
+        # Frames read between consecutive LAMMPS runs (end of step velocities)
+        from lammps import lammps
+        from dynaphopy.interface.lammps_link import _gather_array
+
+        lmp = lammps(cmdargs=['-echo', 'none', '-screen', 'none', '-log', 'none'])
+        lmp.file(input_file)
+        lmp.command('timestep 0.001')
+        lmp.command('replicate {} {} {}'.format(*supercell))
+        lmp.command('velocity        all create 100 {} dist gaussian mom yes'.format(seed))
+        lmp.command('velocity        all scale 100')
+        lmp.command('run 0')
+
+        na = lmp.get_natoms()
+        indexing = np.argsort(io.get_correct_arrangement(_gather_array(lmp, "x", na), self.structure))
+        positions = []
+        velocity = []
+        for i in range(n_steps):
+            lmp.command('run {}'.format(sampling_interval))
+            positions.append(np.array(_gather_array(lmp, "x", na))[indexing])
+            velocity.append(np.array(_gather_array(lmp, "v", na))[indexing])
+        lmp.close()
+
+        return np.array(positions), np.array(velocity)
+
+    def _check_sampling(self, input_file, supercell):
+        from dynaphopy.interface.lammps_link import generate_lammps_trajectory
+
+        for sampling_interval in [1, 3]:
+            trajectory = generate_lammps_trajectory(self.structure, input_file, total_time=0.03, time_step=0.001,
+                                                    supercell=supercell, sampling_interval=sampling_interval,
+                                                    silent=True, lammps_log=False, seed=1234)
+
+            positions, velocity = self._sample_by_runs(input_file, supercell, len(trajectory.velocity),
+                                                       sampling_interval, 1234)
+            self.assertTrue(np.allclose(trajectory.trajectory.real, positions))
+            self.assertTrue(np.allclose(trajectory.velocity.real, velocity))
+
+    def test_lammps_sampling(self):
+        self._use_mock_lammps()
+        self._check_sampling('in.mock', (2, 2, 2))
+
+    def test_lammps_sampling_per_atom_mass(self):
+        self._use_mock_lammps()
+        MockLammps.per_atom_mass = True
+        self.addCleanup(setattr, MockLammps, 'per_atom_mass', False)
+        self._check_sampling('in.mock', (2, 2, 2))
+
+    def test_lammps_hdf5_output(self):
+        from dynaphopy.interface.lammps_link import generate_lammps_trajectory
+
+        # Supercell is given by the input file cell and the replicate command
+        self._use_mock_lammps(cell_repetitions=(2, 1, 1))
+
+        output_file = os.path.join(self.directory, 'lammps.h5')
+        parameters = {'total_time': 0.02, 'time_step': 0.001, 'supercell': (1, 2, 2), 'sampling_interval': 2,
+                      'silent': True, 'lammps_log': False, 'seed': 1234}
+
+        trajectory = generate_lammps_trajectory(self.structure, 'in.mock', **parameters)
+        h5_trajectory = generate_lammps_trajectory(self.structure, 'in.mock', output_file=output_file,
+                                                   block_size=3, **parameters)
+        h5_trajectory.close()
+
+        h5_trajectory = io.initialize_from_hdf5_file(output_file, self.structure)
+        self.assertTrue(np.allclose(h5_trajectory.get_supercell_matrix(), [2, 2, 2]))
+        self.assertTrue(np.allclose(h5_trajectory.get_supercell_matrix(), trajectory.get_supercell_matrix()))
+        self.assertTrue(np.allclose(h5_trajectory.velocity, trajectory.velocity))
+        self.assertTrue(np.allclose(h5_trajectory.trajectory, trajectory.trajectory))
+        self.assertTrue(np.allclose(h5_trajectory.get_time(), trajectory.get_time()))
+        h5_trajectory.close()
+
+    def test_lammps_hdf5_restart(self):
+        import h5py
+        from dynaphopy.interface.lammps_link import generate_lammps_trajectory
+
+        self._use_mock_lammps()
+
+        output_file = os.path.join(self.directory, 'lammps.h5')
+        parameters = {'time_step': 0.001, 'supercell': (2, 2, 2), 'silent': True, 'lammps_log': False,
+                      'seed': 1234, 'output_file': output_file, 'block_size': 4}
+
+        reference = generate_lammps_trajectory(self.structure, 'in.mock', total_time=0.02, **parameters)
+        reference.close()
+        reference = io.initialize_from_hdf5_file(output_file, self.structure)
+
+        # Interrupted run (last block appended without its restart state) resumed from the last state
+        generate_lammps_trajectory(self.structure, 'in.mock', total_time=0.008, **parameters).close()
+        with h5py.File(output_file, 'r+') as hdf5_file:
+            for name in ['time', 'energy', 'velocity', 'trajectory']:
+                hdf5_file[name].resize(11, axis=0)
+
+        trajectory = generate_lammps_trajectory(self.structure, 'in.mock', total_time=0.02, restart=True,
+                                                **parameters)
+        self.assertEqual(len(trajectory.velocity), 20)
+        self.assertTrue(np.allclose(trajectory.get_time(), reference.get_time()))
+        self.assertTrue(np.allclose(trajectory.velocity, reference.velocity))
+        self.assertTrue(np.allclose(trajectory.trajectory, reference.trajectory))
+        trajectory.close()
+
+        # Files without restart state are not resumed
+        io.save_data_hdf5(output_file, reference.get_time(), reference.get_supercell_matrix(),
+                          velocity=reference.velocity, trajectory=reference.trajectory)
+        with self.assertRaises(SystemExit):
+            generate_lammps_trajectory(self.structure, 'in.mock', total_time=0.02, restart=True, **parameters)
+
+    def test_lammps_ensemble(self):
+        from dynaphopy.interface.phonopy_link import get_force_constants_from_file
+        from dynaphopy.interface.lammps_link import generate_lammps_trajectory, generate_lammps_ensemble
+        from dynaphopy.analysis.in_situ import InSituAnalysis, average_power_spectra
+
+        self._use_mock_lammps()
+        self.structure.set_force_constants(get_force_constants_from_file(file_name='Si_data/FORCE_CONSTANTS',
+                                                                         fc_supercell=[[2, 0, 0],
+                                                                                       [0, 2, 0],
+                                                                                       [0, 0, 2]]))
+
+        in_situ = InSituAnalysis(self.structure, [[0.5, 0.0, 0.5]], frequency_range=np.arange(0, 40, 2.0))
+        parameters = {'total_time': 0.05, 'time_step': 0.001, 'supercell': (2, 2, 2), 'block_size': 20}
+
+        replicas = generate_lammps_ensemble(self.structure, 'in.mock', in_situ, number_of_replicas=3,
+                                            processes=2, seeds=[11, 12, 13], **parameters)
+        self.assertEqual(len(replicas), 3)
+
+        # Each replica is an independent run with its own seed
+        for replica, seed in zip(replicas, [11, 12, 13]):
+            reference = generate_lammps_trajectory(self.structure, 'in.mock', in_situ=copy.deepcopy(in_situ),
+                                                   seed=seed, silent=True, lammps_log=False, **parameters)
+            self.assertEqual(replica.get_number_of_samples(), 50)
+            self.assertTrue(np.allclose(replica.get_power_spectra(), reference.get_power_spectra()))
+
+        self.assertFalse(np.allclose(replicas[0].get_power_spectra(), replicas[1].get_power_spectra()))
+
+        average, error = average_power_spectra(replicas)
+        self.assertTrue(np.allclose(average, np.average([r.get_power_spectra() for r in replicas], axis=0)))
+
+    @unittest.skipUnless(lammps_available, 'LAMMPS python module not available')
+    def test_lammps_sampling_tersoff(self):
+        example_directory = os.path.abspath('../examples/lammps_interface/Si')
+        for file_name in ['data_unitcell.si', 'SiCGe.tersoff']:
+            shutil.copy(os.path.join(example_directory, file_name), self.directory)
+
+        input_file = os.path.join(self.directory, 'in.lammps')
+        with open(input_file, 'w') as f:
+            f.write('units           metal\n'
+                    'boundary        p p p\n'
+                    'box tilt large\n'
+                    'atom_style      atomic\n'
+                    'read_data       {}\n'
+                    'pair_style      tersoff\n'
+                    'pair_coeff      * * {} Si(C)\n'
+                    'neighbor        0.3 bin\n'
+                    'fix             int all nve\n'.format(os.path.join(self.directory, 'data_unitcell.si'),
+                                                           os.path.join(self.directory, 'SiCGe.tersoff')))
+
+        self._check_sampling(input_file, (2, 2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
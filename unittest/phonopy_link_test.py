@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import numpy as np
+import dynaphopy.interface.iofile as io
+from dynaphopy.interface.phonopy_link import get_force_constants_from_file
+
+import unittest
+
+
+class TestDynaphopy(unittest.TestCase):
+
+    def setUp(self):
+        self.structure = io.read_from_file_structure_poscar('Si_data/POSCAR')
+
+        self.structure.set_primitive_matrix([[0.0, 0.5, 0.5],
+                                             [0.5, 0.0, 0.5],
+                                             [0.5, 0.5, 0.0]])
+
+        self.structure.set_force_constants(get_force_constants_from_file(file_name='Si_data/FORCE_CONSTANTS',
+                                                                         fc_supercell=[[2, 0, 0],
+                                                                                       [0, 2, 0],
+                                                                                       [0, 0, 2]]))
+
+    def test_commensurate_points_stars(self):
+        from dynaphopy.interface import phonopy_link
+
+        com_points = phonopy_link.get_commensurate_points(self.structure, np.diag([2, 2, 2]))
+        stars = phonopy_link.get_commensurate_points_stars(self.structure, com_points)
+        eigenvectors, frequencies = phonopy_link.obtain_eigenvectors_and_frequencies_batch(self.structure,
+                                                                                           com_points,
+                                                                                           print_data=False)
+
+        self.assertEqual(np.sum(stars['weights']), len(com_points))
+        self.assertTrue(np.array_equal(stars['mapping'][stars['irreducible']], stars['irreducible']))
+        self.assertTrue(np.allclose(frequencies, frequencies[stars['mapping']]))
+
+    def test_phonon_cache(self):
+        from dynaphopy.interface import phonopy_link
+
+        q_point = [0.5, 0.0, 0.5]
+        phonon = phonopy_link.get_phonon(self.structure)
+        frequencies = phonon.get_frequencies(q_point)
+
+        # Cached objects are not shared with the callers
+        phonon.set_force_constants(np.zeros_like(phonon.get_force_constants()))
+        cached_phonon = phonopy_link.get_phonon(self.structure)
+        self.assertIsNot(cached_phonon, phonon)
+        self.assertTrue(np.allclose(cached_phonon.get_frequencies(q_point), frequencies))
+
+        # BORN files in different directories are different models
+        directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.addCleanup(os.chdir, os.getcwd())
+        keys = []
+        for directory in directories:
+            self.addCleanup(shutil.rmtree, directory, True)
+            with open(os.path.join(directory, 'BORN'), 'w') as f:
+                f.write('14.0\n')
+            os.utime(os.path.join(directory, 'BORN'), (0, 0))
+            os.chdir(directory)
+            keys.append(phonopy_link._get_phonon_key(self.structure, np.identity(3), None, True))
+        self.assertNotEqual(keys[0], keys[1])
+
+    def test_renormalized_force_constants(self):
+        from dynaphopy.interface import phonopy_link
+
+        fc_supercell = np.diag([2, 2, 2])
+        com_points = phonopy_link.get_commensurate_points(self.structure, fc_supercell)
+        eigenvectors, frequencies = phonopy_link.obtain_eigenvectors_and_frequencies_batch(self.structure,
+                                                                                           com_points,
+                                                                                           print_data=False)
+
+        # Force constants scale with the square of the frequencies
+        force_constants = self.structure.get_force_constants().get_array()
+        force_constants_list = phonopy_link.get_renormalized_force_constants_batch([frequencies, frequencies * 1.1],
+                                                                                   eigenvectors,
+                                                                                   self.structure,
+                                                                                   fc_supercell)
+        self.assertTrue(np.allclose(force_constants_list[0].get_array(), force_constants, atol=1e-4))
+        self.assertTrue(np.allclose(force_constants_list[1].get_array(), force_constants * 1.21, atol=1e-4))
+
+        single = phonopy_link.get_renormalized_force_constants(frequencies * 1.1, eigenvectors, self.structure,
+                                                               fc_supercell)
+        self.assertTrue(np.allclose(single.get_array(), force_constants_list[1].get_array()))
+
+    def test_dispersion_bands_batch(self):
+        from dynaphopy.interface import phonopy_link
+
+        fc_supercell = np.diag([2, 2, 2])
+        com_points = phonopy_link.get_commensurate_points(self.structure, fc_supercell)
+        eigenvectors, frequencies = phonopy_link.obtain_eigenvectors_and_frequencies_batch(self.structure,
+                                                                                           com_points,
+                                                                                           print_data=False)
+        force_constants_list = [None] + phonopy_link.get_renormalized_force_constants_batch(
+            [frequencies * 1.05 + np.linspace(0, 0.3, 6), frequencies * 0.9], eigenvectors, self.structure,
+            fc_supercell)
+
+        bands_ranges = [[[0.0, 0.0, 0.0], [0.5, 0.0, 0.5]],
+                        [[0.5, 0.0, 0.5], [0.625, 0.25, 0.625]],
+                        [[0.375, 0.375, 0.75], [0.0, 0.0, 0.0]],
+                        [[0.0, 0.0, 0.0], [0.5, 0.5, 0.5]]]
+        bands = [np.array([np.array(q_start) + (np.array(q_end) - np.array(q_start)) / 30 * i for i in range(31)])
+                 for q_start, q_end in bands_ranges]
+
+        # Same bands as phonopy (with and without band connection)
+        for band_connection in [False, True]:
+            band_structures = phonopy_link.obtain_phonon_dispersion_bands_batch(self.structure, bands_ranges,
+                                                                                force_constants_list,
+                                                                                band_connection=band_connection)
+            for force_constants, band_structure in zip(force_constants_list, band_structures):
+                if force_constants is None:
+                    phonon = phonopy_link.get_phonon(self.structure)
+                else:
+                    phonon = phonopy_link.get_phonon(self.structure, custom_supercell=fc_supercell,
+                                                     force_constants=force_constants)
+                phonon.set_band_structure(bands, is_band_connection=band_connection, is_eigenvectors=True)
+                reference = phonon.get_band_structure()
+
+                for i in range(len(bands)):
+                    self.assertTrue(np.allclose(band_structure[1][i], reference[1][i]))
+                    self.assertTrue(np.allclose(band_structure[2][i], reference[2][i]))
+                    self.assertTrue(np.allclose(np.abs(band_structure[3][i]), np.abs(reference[3][i])))
+
+    def test_dos_cache(self):
+        from dynaphopy.interface import phonopy_link
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.addCleanup(setattr, phonopy_link, '_dos_cache_directory', None)
+        self.addCleanup(setattr, phonopy_link, '_dos_cache_directory_size', phonopy_link._dos_cache_directory_size)
+        phonopy_link.clear_phonon_cache()
+        phonopy_link.set_dos_cache_directory(directory, size=2)
+
+        dos = phonopy_link.obtain_phonopy_dos(self.structure, mesh=(8, 8, 8))
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+        # Cache hits (memory and disk) return the same DOS
+        self.assertTrue(np.array_equal(phonopy_link.obtain_phonopy_dos(self.structure, mesh=(8, 8, 8)), dos))
+        phonopy_link.clear_phonon_cache()
+        self.assertTrue(np.array_equal(phonopy_link.obtain_phonopy_dos(self.structure, mesh=(8, 8, 8)), dos))
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+        # Changed force constants are a cache miss
+        force_constants = self.structure.get_force_constants()
+        scaled_force_constants = phonopy_link.ForceConstants(force_constants.get_array() * 1.5,
+                                                             supercell=force_constants.get_supercell())
+        scaled_dos = phonopy_link.obtain_phonopy_dos(self.structure, mesh=(8, 8, 8),
+                                                     force_constants=scaled_force_constants)
+        self.assertEqual(len(os.listdir(directory)), 2)
+        self.assertFalse(np.allclose(scaled_dos[0], dos[0]))
+        self.assertTrue(np.isclose(phonopy_link.obtain_phonopy_max_frequency(self.structure, mesh=(8, 8, 8),
+                                                                             force_constants=scaled_force_constants),
+                                   scaled_dos[0][-1]))
+
+        # Least recently used files are removed from the cache directory
+        os.utime(os.path.join(directory, phonopy_link._get_dos_key(phonopy_link.get_phonon(self.structure),
+                                                                   force_constants, (8, 8, 8),
+                                                                   None, None, False) + '.npy'), (0, 0))
+        phonopy_link.obtain_phonopy_dos(self.structure, mesh=(10, 10, 10))
+        self.assertEqual(len(os.listdir(directory)), 2)
+        phonopy_link.clear_phonon_cache()
+        self.assertTrue(np.array_equal(phonopy_link.obtain_phonopy_dos(self.structure, mesh=(8, 8, 8),
+                                                                       force_constants=scaled_force_constants),
+                                       scaled_dos))
+        self.assertEqual(len(os.listdir(directory)), 2)
+        self.assertIsNone(phonopy_link._load_dos(phonopy_link._get_dos_key(phonopy_link.get_phonon(self.structure),
+                                                                           force_constants, (8, 8, 8),
+                                                                           None, None, False)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
 #!/usr/bin/env python
+import os
+import shutil
+import tempfile
 import numpy as np
 import dynaphopy.interface.iofile as io
 from dynaphopy.interface.phonopy_link import get_force_constants_from_file
@@ -20,6 +23,10 @@ class TestDynaphopy(unittest.TestCase):
                                                                                        [0, 2, 0],
                                                                                        [0, 0, 2]]))
 
+        # Files written by the tests
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
     def test_XDATCAR(self):
         defined_time_step = 0.0005
         parser = io.get_trajectory_parser('Si_data/XDATCAR')
@@ -101,6 +108,269 @@ class TestDynaphopy(unittest.TestCase):
 
         self.assertEqual(check_traj and check_time and check_mean_matrix, True)
 
+    def test_compressed_XDATCAR(self):
+        import gzip
+
+        file_name = os.path.join(self.directory, 'XDATCAR.gz')
+        with open('Si_data/XDATCAR', 'rb') as f_in, gzip.open(file_name, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+        parser = io.get_trajectory_parser(file_name)
+        trajectory = parser(file_name, self.structure, initial_cut=3, end_cut=14, time_step=0.0005)
+
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        reference = parser('Si_data/XDATCAR', self.structure, initial_cut=3, end_cut=14, time_step=0.0005)
+
+        self.assertTrue(np.allclose(trajectory.trajectory, reference.trajectory))
+
+    def test_compressed_file_map(self):
+        import gzip
+        from dynaphopy.interface.iofile.file_map import StreamFileMap, _gzip_open
+
+        file_name = os.path.join(self.directory, 'XDATCAR.gz')
+        with open('Si_data/XDATCAR', 'rb') as f_in, gzip.open(file_name, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+        with open('Si_data/XDATCAR', 'rb') as f:
+            data = f.read()
+
+        with StreamFileMap(file_name, _gzip_open, block_size=1024, read_ahead=False) as file_map:
+            # Searching is done by blocks without keeping the whole file in memory
+            self.assertEqual(file_map.find(b'Not in the file'), -1)
+            self.assertLess(len(file_map._buffer), 3 * 1024)
+
+            position = data.find(b'Direct configuration=    13')
+            self.assertGreater(position, 10 * 1024)
+            self.assertEqual(file_map.find(b'Direct configuration=    13'), position)
+            self.assertEqual(file_map.readline(), data[:data.find(b'\n') + 1])
+
+            file_map.seek(position)
+            self.assertEqual(file_map.read(100), data[position:position + 100])
+
+    def test_compressed_file_map_lines(self):
+        import gzip
+        from dynaphopy.interface.iofile.file_map import StreamFileMap, _gzip_open
+
+        data = b''.join(['{0} {1}\n'.format(i, 'x' * (i % 37)).encode() for i in range(5000)])
+        file_name = os.path.join(self.directory, 'lines.gz')
+        with gzip.open(file_name, 'wb') as f:
+            f.write(data)
+
+        for read_ahead in [False, True]:
+            opened = []
+            file_map = StreamFileMap(file_name, _gzip_open, block_size=1024, read_ahead=read_ahead)
+            open_function = file_map._open
+
+            def count_open():
+                opened.append(True)
+                open_function()
+            file_map._open = count_open
+
+            # Lines crossing block boundaries do not restart the decompression
+            lines = []
+            line = file_map.readline()
+            while line:
+                lines.append(line)
+                line = file_map.readline()
+            file_map.close()
+
+            self.assertGreater(len(data), 100 * 1024)
+            self.assertEqual(b''.join(lines), data)
+            self.assertEqual(len(opened), 0)
+
+    def test_trajectory_cache(self):
+        from dynaphopy.interface.iofile.trajectory_cache import get_cache_directory
+
+        file_name = os.path.join(self.directory, 'XDATCAR')
+        shutil.copy('Si_data/XDATCAR', file_name)
+        parser = io.get_trajectory_parser(file_name, cache=True)
+        trajectory = parser(file_name, self.structure, initial_cut=3, end_cut=14, time_step=0.0005)
+        cached = parser(file_name, self.structure, initial_cut=3, end_cut=14, time_step=0.0005)
+
+        self.assertTrue(os.path.isdir(get_cache_directory(file_name)))
+        self.assertTrue(np.allclose(trajectory.trajectory, cached.trajectory))
+        self.assertTrue(np.allclose(trajectory.get_time(), cached.get_time()))
+
+        # Entries of a modified file are replaced
+        with open(file_name, 'a') as f:
+            f.write('\n')
+        parser(file_name, self.structure, initial_cut=3, end_cut=14, time_step=0.0005)
+        self.assertEqual(len(os.listdir(get_cache_directory(file_name))), 1)
+
+    def test_atom_selection(self):
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        trajectory = parser('Si_data/XDATCAR', self.structure, initial_cut=3, end_cut=14, time_step=0.0005)
+        selection = parser('Si_data/XDATCAR', self.structure, initial_cut=3, end_cut=14, time_step=0.0005,
+                           atom_types=[1])
+
+        atom_indices = selection.get_atom_indices()
+        self.assertTrue(np.allclose(selection.trajectory, trajectory.trajectory[:, atom_indices]))
+        self.assertTrue(np.allclose(selection.get_mean_displacement_matrix()[1],
+                                    trajectory.get_mean_displacement_matrix()[1]))
+
+    def test_hdf5_hyperslab(self):
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        trajectory = parser('Si_data/XDATCAR', self.structure, time_step=0.0005)
+
+        file_name = os.path.join(self.directory, 'test_si.h5')
+        io.save_data_hdf5(file_name, trajectory.get_time(), trajectory.get_supercell_matrix(),
+                          velocity=trajectory.velocity)
+
+        for atom_types in [None, [1]]:
+            h5_trajectory = io.initialize_from_hdf5_file(file_name, self.structure, initial_cut=3, final_cut=12,
+                                                         memmap=True, atom_types=atom_types)
+            reference = trajectory.velocity[2:12][:, h5_trajectory.get_atom_indices()]
+            self.assertTrue(np.allclose(np.asarray(h5_trajectory.velocity), reference))
+            self.assertTrue(np.allclose(h5_trajectory.velocity[-3:, 1], reference[-3:, 1]))
+            del h5_trajectory
+
+    def test_hdf5_short_time(self):
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        trajectory = parser('Si_data/XDATCAR', self.structure, time_step=0.0005)
+
+        # Time of the first file only (files joined by old versions of concath5)
+        file_name = os.path.join(self.directory, 'test_si.h5')
+        io.save_data_hdf5(file_name, trajectory.get_time()[:10], trajectory.get_supercell_matrix(),
+                          velocity=trajectory.velocity)
+
+        for memmap in [False, True]:
+            h5_trajectory = io.initialize_from_hdf5_file(file_name, self.structure, initial_cut=13, final_cut=18,
+                                                         memmap=memmap)
+            self.assertTrue(np.allclose(np.asarray(h5_trajectory.velocity), trajectory.velocity[12:18]))
+            self.assertTrue(np.allclose(h5_trajectory.get_time(), trajectory.get_time()[12:18]))
+            self.assertAlmostEqual(h5_trajectory.get_time_step_average(), trajectory.get_time_step_average())
+            h5_trajectory.close()
+
+    def test_hdf5_storage(self):
+        import h5py
+
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        trajectory = parser('Si_data/XDATCAR', self.structure, time_step=0.0005)
+        velocity = trajectory.velocity + 1j * trajectory.velocity[::-1]
+
+        file_name = os.path.join(self.directory, 'test_si.h5')
+        for compression in [None, 'gzip']:
+            for real in [False, True]:
+                io.save_data_hdf5(file_name, trajectory.get_time(), trajectory.get_supercell_matrix(),
+                                  velocity=velocity, compression=compression, real=real)
+
+                with h5py.File(file_name, 'r') as hdf5_file:
+                    self.assertEqual(hdf5_file['velocity'].compression, compression)
+                    self.assertEqual(np.iscomplexobj(hdf5_file['velocity']), not real)
+
+                # The imaginary part is only discarded if requested
+                h5_trajectory = io.initialize_from_hdf5_file(file_name, self.structure, initial_cut=3,
+                                                             final_cut=12, memmap=True)
+                reference = velocity[2:12].real if real else velocity[2:12]
+                self.assertTrue(np.allclose(np.asarray(h5_trajectory.velocity), reference))
+                h5_trajectory.close()
+
+    def test_hdf5_lazy_arrays(self):
+        from dynaphopy.interface.iofile.hdf5_array import HDF5Array
+
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        trajectory = parser('Si_data/XDATCAR', self.structure, time_step=0.0005)
+
+        # Chunked datasets are read lazily
+        file_name = os.path.join(self.directory, 'test_si.h5')
+        io.save_data_hdf5(file_name, trajectory.get_time(), trajectory.get_supercell_matrix(),
+                          velocity=trajectory.velocity, compression='gzip')
+
+        h5_trajectory = io.initialize_from_hdf5_file(file_name, self.structure, initial_cut=3, final_cut=12,
+                                                     memmap=True)
+        velocity = h5_trajectory.velocity
+        self.assertTrue(isinstance(velocity, HDF5Array))
+        self.assertEqual(len(h5_trajectory.get_time()), len(velocity))
+        self.assertTrue(np.allclose(h5_trajectory.get_time(), trajectory.get_time()[2:12]))
+
+        reference = trajectory.get_velocity_mass_average()[2:12]
+        self.assertTrue(np.allclose(h5_trajectory.get_velocity_mass_average(), reference))
+
+        h5_trajectory.close()
+        self.assertTrue(velocity._file is None)
+
+    def test_concath5(self):
+        import sys
+        import subprocess
+        import h5py
+
+        parser = io.get_trajectory_parser('Si_data/XDATCAR')
+        trajectory = parser('Si_data/XDATCAR', self.structure, time_step=0.0005)
+        velocity = trajectory.velocity
+
+        for i, part in enumerate([velocity[:10], velocity[10:]]):
+            io.save_data_hdf5(os.path.join(self.directory, 'part{0}.h5'.format(i)), trajectory.get_time(),
+                              trajectory.get_supercell_matrix(), velocity=part, compression='gzip')
+        os.mkdir(os.path.join(self.directory, 'joined'))
+
+        script = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'concath5'))
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(script)),
+                                                     environment.get('PYTHONPATH', '')])
+
+        # Relative input paths with the output file in another directory
+        for options in [['--block_size', '3'], ['--virtual']]:
+            output = os.path.join('joined', 'joined{0}.h5'.format(options[0]))
+            subprocess.check_call([sys.executable, script, 'part0.h5', 'part1.h5', output, '-f', '2'] + options,
+                                  cwd=self.directory, env=environment, stdout=subprocess.PIPE)
+
+            with h5py.File(os.path.join(self.directory, output), 'r') as hdf5_file:
+                self.assertEqual(hdf5_file['velocity'].is_virtual, '--virtual' in options)
+                self.assertTrue(np.allclose(hdf5_file['velocity'][:],
+                                            np.concatenate((velocity[2:10], velocity[12:]))))
+
+            # The time covers all the joined steps
+            h5_trajectory = io.initialize_from_hdf5_file(os.path.join(self.directory, output), self.structure,
+                                                         initial_cut=8)
+            self.assertTrue(np.allclose(np.asarray(h5_trajectory.velocity), velocity[[9, 12, 13, 14]]))
+            self.assertTrue(np.allclose(h5_trajectory.get_time(), trajectory.get_time()[9:13]))
+
+        # Files with a single time entry use the time step of the writer (if stored)
+        for time_step in [None, 0.0005]:
+            for i in range(2):
+                file_name = os.path.join(self.directory, 'single{0}.h5'.format(i))
+                io.save_data_hdf5(file_name, trajectory.get_time()[i:i + 1], trajectory.get_supercell_matrix(),
+                                  velocity=velocity[i:i + 1])
+                if time_step is not None:
+                    with h5py.File(file_name, 'r+') as hdf5_file:
+                        hdf5_file.attrs['time_step'] = time_step
+
+            output = os.path.join('joined', 'single{0}.h5'.format(time_step))
+            subprocess.check_call([sys.executable, script, 'single0.h5', 'single1.h5', output],
+                                  cwd=self.directory, env=environment, stdout=subprocess.PIPE)
+
+            h5_trajectory = io.initialize_from_hdf5_file(os.path.join(self.directory, output), self.structure)
+            self.assertTrue(np.allclose(np.asarray(h5_trajectory.velocity), velocity[:2]))
+            reference = trajectory.get_time()[:2] if time_step is not None else trajectory.get_time()[:1]
+            self.assertTrue(np.allclose(h5_trajectory.get_time(), reference))
+
+    def test_auto_order(self):
+        positions = self.structure.get_positions(supercell=[3, 2, 4])
+
+        random_state = np.random.RandomState(0)
+        order = random_state.permutation(positions.shape[0])
+        reference = positions[order] + random_state.normal(scale=0.05, size=positions.shape)
+
+        template = io.get_correct_arrangement(reference, self.structure)
+        self.assertTrue(np.array_equal(template, order))
+
+        # The second call is taken from the cache, and the cached template can not be modified
+        cached = list(io._arrangement_cache.values())[-1]
+        template[:] = 0
+        template = io.get_correct_arrangement(reference, self.structure)
+        self.assertIs(list(io._arrangement_cache.values())[-1], cached)
+        self.assertIsNot(template, cached)
+        self.assertTrue(np.array_equal(template, order))
+
+        # A different atoms order of the same supercell is not taken from the cache
+        template = io.get_correct_arrangement(reference[::-1], self.structure)
+        self.assertTrue(np.array_equal(template, order[::-1]))
+
+        # Supercell not compatible with the unit cell: order not changed
+        template = io.get_correct_arrangement(reference[:-1], self.structure)
+        self.assertTrue(isinstance(template, np.ndarray))
+        self.assertTrue(np.array_equal(template, np.arange(len(reference) - 1)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import numpy as np
+from scipy import integrate
+from dynaphopy.analysis import thermal_properties
+from dynaphopy.analysis.thermal_properties import N_a, k_b, h_bar
+
+import unittest
+
+
+# Reference (frequency by frequency) implementations
+def _reference_free_energy(temperature, frequency, dos):
+    free_energy = np.nan_to_num([dos[i] * k_b * temperature * np.log(2 * np.sinh(h_bar * freq / (2 * k_b * temperature)))
+                                 for i, freq in enumerate(frequency)])
+    free_energy[0] = 0
+    return integrate.simps(free_energy, frequency) * N_a / 1000
+
+
+def _reference_entropy(temperature, frequency, dos):
+    def coth(x):
+        return np.cosh(x)/np.sinh(x)
+
+    entropy = np.nan_to_num([dos[i]*(1.0 / (2. * temperature) * h_bar * freq * coth(h_bar * freq / (2 * k_b * temperature))
+                                     - k_b * np.log(2 * np.sinh(h_bar * freq / (2 * k_b * temperature))))
+                             for i, freq in enumerate(frequency)])
+    return integrate.simps(entropy, frequency) * N_a
+
+
+def _reference_cv(temperature, frequency, dos):
+    def z(temp, freq):
+        return h_bar*freq/(k_b*temp)
+
+    c_v = np.nan_to_num([dos[i] * k_b * pow(z(temperature, freq), 2) * np.exp(z(temperature, freq)) / pow(np.exp(z(temperature, freq)) - 1, 2)
+                         for i, freq in enumerate(frequency)])
+    return integrate.simps(c_v, frequency) * N_a
+
+
+class TestDynaphopy(unittest.TestCase):
+
+    def setUp(self):
+        # Debye-like DOS (vanishes at zero frequency) with imaginary modes shown as negative frequencies
+        self.frequency = np.linspace(-4, 20, 241)
+        self.frequency[np.argmin(np.abs(self.frequency))] = 0.0
+        self.dos = self.frequency ** 2 * np.exp(-(self.frequency / 8) ** 2)
+
+        self.temperatures = [1.0, 10.0, 300.0, 2000.0]
+
+    def _check_thermal_properties(self, frequency, dos):
+        functions = [(thermal_properties.get_free_energy, _reference_free_energy),
+                     (thermal_properties.get_entropy, _reference_entropy),
+                     (thermal_properties.get_cv, _reference_cv)]
+
+        with np.errstate(all='ignore'):
+            for function, reference_function in functions:
+                reference = [reference_function(temperature, frequency, dos) for temperature in self.temperatures]
+                for temperature, value in zip(self.temperatures, reference):
+                    self.assertTrue(np.isclose(function(temperature, frequency, dos), value, rtol=1e-8, atol=1e-12))
+
+                # Array of temperatures
+                self.assertTrue(np.allclose(function(self.temperatures, frequency, dos), reference,
+                                            rtol=1e-8, atol=1e-12))
+
+    def test_thermal_properties_negative_frequencies(self):
+        self.assertIn(0.0, self.frequency)
+        self._check_thermal_properties(self.frequency, self.dos)
+
+    def test_thermal_properties_zero_frequency(self):
+        # Grid starting at zero frequency with non vanishing DOS (first value is not used by the free energy)
+        frequency = self.frequency[self.frequency >= 0]
+        dos = np.exp(-(frequency / 8) ** 2)
+        self._check_thermal_properties(frequency, dos)
+
+
+if __name__ == '__main__':
+    unittest.main()